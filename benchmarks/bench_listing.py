@@ -0,0 +1,95 @@
+"""Benchmark rendering the list of emails in a mailbox
+
+Fills a mailbox with synthetic messages and times GET /view/<address>/ with
+the fragment cache disabled, on a cold cache and on a warm cache.
+
+    python benchmarks/bench_listing.py --messages 1000
+"""
+import argparse
+import asyncio
+import mailbox
+import os
+import statistics
+import tempfile
+import time
+
+from email.message import EmailMessage
+
+import tornado.httpclient
+import tornado.httpserver
+
+from mailboxzero import WebApplication, services
+from mailboxzero.fragments import FragmentCache
+
+from utils import random_port
+
+
+ADDRESS = "bench@mb0.wtte.ch"
+
+
+def fill_mailbox(base_maildir, n_messages):
+    mail_dir = services.Mailboxes(base_maildir).mail_dir_for(ADDRESS)
+    os.makedirs(os.path.dirname(mail_dir), exist_ok=True)
+    mbox = mailbox.Maildir(mail_dir)
+    for n in range(n_messages):
+        message = EmailMessage()
+        message["From"] = f"sender{n}@example.com"
+        message["To"] = ADDRESS
+        message["Subject"] = f"Newsletter number {n}"
+        message["Date"] = "Mon, 14 May 1984 12:34:56 +0000"
+        message.set_content("Hello there! " * 200)
+        mbox.add(message)
+
+
+async def time_requests(base_maildir, fragment_cache, repeat):
+    port = random_port()
+    server = tornado.httpserver.HTTPServer(
+        WebApplication(base_maildir, fragment_cache=fragment_cache)
+    )
+    server.listen(port, "127.0.0.1")
+    client = tornado.httpclient.AsyncHTTPClient()
+    url = f"http://127.0.0.1:{port}/view/{ADDRESS}/"
+
+    timings = []
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await client.fetch(url)
+            timings.append(time.perf_counter() - start)
+    finally:
+        server.stop()
+    return timings
+
+
+def report(name, timings):
+    print(
+        f"{name:>12}: mean {1000 * statistics.mean(timings):8.2f}ms"
+        f"  p50 {1000 * statistics.median(timings):8.2f}ms"
+        f"  ({len(timings)} requests)"
+    )
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as base_maildir:
+        fill_mailbox(base_maildir, args.messages)
+
+        timings = await time_requests(base_maildir, FragmentCache(0), args.repeat)
+        report("no cache", timings)
+
+        timings = await time_requests(base_maildir, FragmentCache(), 1 + args.repeat)
+        report("cold cache", timings[:1])
+        report("warm cache", timings[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"Listing a mailbox with {args.messages} messages")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Compare injecting email with SMTP over TCP and with LMTP on a Unix socket
+
+Starts a mailboxzero server in a child process with an LMTP socket next to
+its SMTP port. Several client processes then each open one connection and
+deliver their share of the messages over it, first with SMTP and then with
+LMTP. Both use the same minimal client so only the transport and protocol
+differ.
+
+    python benchmarks/bench_lmtp.py --messages 20000 --clients 4 --size 2000
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+from email.message import EmailMessage
+
+from utils import random_port, serve, wait_for_server
+
+
+def _reply(f):
+    """Read one, possibly multi-line, reply and return its code"""
+    while True:
+        line = f.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        if line[3:4] != b"-":
+            return int(line[:3])
+
+
+def _command(sock, f, command, expected):
+    sock.sendall(command + b"\r\n")
+    code = _reply(f)
+    if code != expected:
+        raise RuntimeError(f"{command!r} got {code} instead of {expected}")
+
+
+def _inject(job):
+    """Deliver count messages over one connection, returns the seconds taken"""
+    protocol, address, count, data, recipients = job
+    if protocol == "lmtp":
+        sock = socket.socket(socket.AF_UNIX)
+        greeting = b"LHLO localhost"
+    else:
+        sock = socket.socket()
+        greeting = b"EHLO localhost"
+    sock.connect(address)
+    f = sock.makefile("rb")
+
+    start = time.perf_counter()
+    if _reply(f) != 220:
+        raise RuntimeError("no greeting")
+    _command(sock, f, greeting, 250)
+    for _ in range(count):
+        _command(sock, f, b"MAIL FROM:<bench@remote.example.com>", 250)
+        for recipient in recipients:
+            _command(sock, f, b"RCPT TO:<%s>" % recipient.encode(), 250)
+        _command(sock, f, b"DATA", 354)
+        sock.sendall(data)
+        # LMTP replies once per recipient, SMTP once per message
+        for _ in recipients if protocol == "lmtp" else [None]:
+            code = _reply(f)
+            if code != 250:
+                raise RuntimeError(f"delivery failed with {code}")
+    _command(sock, f, b"QUIT", 221)
+    duration = time.perf_counter() - start
+
+    sock.close()
+    return duration
+
+
+def make_message(size):
+    message = EmailMessage()
+    message["From"] = "bench@remote.example.com"
+    message["Subject"] = f"A message of about {size} bytes"
+    message.set_content(("All work and no play. " * (1 + size // 22))[:size])
+    data = message.as_bytes().replace(b"\n", b"\r\n")
+    # dot-stuffing, the body never starts a line with a dot
+    return data + b".\r\n"
+
+
+def run(pool, protocol, address, args, data):
+    per_client = args.messages // args.clients
+    recipients = [
+        f"bench{i}@mb0.wtte.ch" for i in range(args.recipients)
+    ]
+    jobs = [
+        (protocol, address, per_client, data, recipients)
+        for _ in range(args.clients)
+    ]
+
+    start = time.perf_counter()
+    pool.map(_inject, jobs)
+    duration = time.perf_counter() - start
+
+    messages = per_client * args.clients
+    print(f"{protocol.upper()}:")
+    print(f"  {messages} messages in {duration:.2f}s")
+    print(f"  {messages / duration:8.0f} messages/s")
+    print(f"  {messages * len(recipients) / duration:8.0f} deliveries/s")
+    return messages / duration
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--size", type=int, default=2000, help="bytes of body")
+    parser.add_argument(
+        "--recipients", type=int, default=1, help="recipients of each message"
+    )
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+    data = make_message(args.size)
+
+    with tempfile.TemporaryDirectory() as d:
+        smtp_port = random_port()
+        lmtp_socket = os.path.join(d, "lmtp.sock")
+        server = multiprocessing.Process(
+            target=serve,
+            args=(os.path.join(d, "maildir"),),
+            kwargs={
+                "http_port": random_port(),
+                "smtp_port": smtp_port,
+                "lmtp_socket": lmtp_socket,
+            },
+            daemon=True,
+        )
+        server.start()
+
+        try:
+            wait_for_server(ports=(smtp_port,), unix_socket=lmtp_socket)
+            with multiprocessing.Pool(args.clients) as pool:
+                smtp = run(pool, "smtp", ("127.0.0.1", smtp_port), args, data)
+                lmtp = run(pool, "lmtp", lmtp_socket, args, data)
+            print(f"LMTP is {lmtp / smtp:.2f}x the throughput of SMTP")
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
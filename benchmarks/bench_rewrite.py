@@ -0,0 +1,168 @@
+"""Benchmark rewriting email bodies for display
+
+Compares the single pass rewriter in `mailboxzero.rewrite` with the
+BeautifulSoup based `utils.rewrite_html` and with `bleach.clean` followed by
+`bleach.linkify` for plain text bodies. Every document is rewritten by both
+and the outputs are compared, mismatches are counted and reported.
+
+Point it at a directory of raw emails, for example a Maildir of newsletters.
+Without one a synthetic newsletter of each of the given sizes is used.
+
+    python benchmarks/bench_rewrite.py --corpus ~/Maildir/cur --repeat 5
+"""
+import argparse
+import email
+import email.policy
+import html
+import pathlib
+import time
+
+import bleach
+
+from mailboxzero import rewrite, utils
+
+
+BLOCK = """<tr><td class=" article  wide " style="padding: 12px">
+  <a href="https://example.com/story?utm_source=news&amp;id={n}"><img
+    src="cid:image{n}@example.com" alt="Story {n}" width="560"></a>
+  <h2>Story number {n}</h2>
+  <p>Lorem ipsum&nbsp;dolor sit amet, <b>consectetur</b> adipiscing elit.
+  Read more at <a href="https://example.com/{n}" target="_self">example.com</a></p>
+  <!--[if mso]><table><tr><td width="560"><![endif]-->
+</td></tr>
+"""
+
+TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Newsletter</title>
+<style>td {{ font-family: sans-serif; }}</style></head>
+<body><table role="presentation" width="100%">{blocks}</table>
+<img src="https://tracker.example.com/open.gif" width="1" height="1"></body></html>
+"""
+
+TEXT = """Hello,
+
+this week's stories are at https://example.com/news?id={n}, and the
+archive lives at www.example.org/archive (see example.com/faq).
+
+"""
+
+
+def synthetic_corpus(sizes):
+    html_bodies = []
+    text_bodies = []
+    for size in sizes:
+        blocks = []
+        text = []
+        n = 0
+        while sum(map(len, blocks)) < size:
+            blocks.append(BLOCK.format(n=n))
+            text.append(TEXT.format(n=n))
+            n += 1
+        html_bodies.append(TEMPLATE.format(blocks="".join(blocks)))
+        text_bodies.append("".join(text))
+    return html_bodies, text_bodies
+
+
+def load_corpus(path):
+    """HTML and plain text bodies of the emails in a directory
+
+    The bodies are unescaped like `services.Mailboxes.get_message` does.
+    """
+    html_bodies = []
+    text_bodies = []
+    for message_path in sorted(pathlib.Path(path).iterdir()):
+        if not message_path.is_file():
+            continue
+        with open(message_path, "rb") as f:
+            message = email.message_from_binary_file(f, policy=email.policy.default)
+        for bodies, subtype in ((html_bodies, "html"), (text_bodies, "plain")):
+            body = message.get_body(preferencelist=(subtype,))
+            if body is None:
+                continue
+            try:
+                bodies.append(html.unescape(body.get_content()))
+            except (KeyError, LookupError):
+                continue
+    return html_bodies, text_bodies
+
+
+def compare(name, documents, current, single_pass, repeat):
+    mismatches = errors = 0
+    current_time = single_pass_time = 0
+    for document in documents:
+        try:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                expected = current(document)
+            current_time += time.perf_counter() - start
+        except Exception:
+            # e.g. BeautifulSoup based rewriting fails for <img> without src
+            errors += 1
+            continue
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = single_pass(document)
+        single_pass_time += time.perf_counter() - start
+
+        if result != expected:
+            mismatches += 1
+
+    compared = len(documents) - errors
+    total_bytes = sum(map(len, documents))
+    print(f"{name}: {len(documents)} documents, {total_bytes / 1e6:.1f}MB")
+    if compared:
+        print(f"  current:     {1000 * current_time / repeat / compared:8.2f}ms/doc")
+        single_pass_ms = 1000 * single_pass_time / repeat / compared
+        print(f"  single pass: {single_pass_ms:8.2f}ms/doc")
+        print(f"  speedup:     {current_time / single_pass_time:8.1f}x")
+    print(f"  mismatches: {mismatches}, failed with current implementation: {errors}")
+
+
+def static_url(path):
+    return "/static/" + path
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--corpus", help="directory of raw emails, one message per file"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[10_000, 100_000, 1_000_000],
+        help="sizes in bytes of synthetic newsletters, used without --corpus",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+
+    if args.corpus:
+        html_bodies, text_bodies = load_corpus(args.corpus)
+    else:
+        html_bodies, text_bodies = synthetic_corpus(args.sizes)
+
+    content_url = "/content/bench@mb0.wtte.ch/1/"
+    compare(
+        "HTML",
+        html_bodies,
+        lambda d: utils.rewrite_html(d, content_url, static_url),
+        lambda d: rewrite.rewrite_html(d, content_url, static_url),
+        args.repeat,
+    )
+    compare(
+        "plain text",
+        text_bodies,
+        lambda d: bleach.linkify(bleach.clean(d, strip=True)),
+        rewrite.linkify_text,
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
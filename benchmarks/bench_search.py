@@ -0,0 +1,73 @@
+"""Benchmark query latency of the search index
+
+Fills a single (busy, shared) mailbox with synthetic messages and times a mix
+of rare, common and multi-word queries against it.
+
+    python benchmarks/bench_search.py --messages 100000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from mailboxzero.search import SearchIndex
+
+
+WORDS = [f"word{n}" for n in range(20000)]
+COMMON = ["your", "order", "password", "reset", "account", "welcome"]
+
+
+def make_message(rng, n):
+    subject = " ".join(rng.choices(COMMON, k=2) + [f"#{n}"])
+    sender = f"sender{rng.randrange(500)}@example.com"
+    body = " ".join(rng.choices(WORDS, k=150) + rng.choices(COMMON, k=10))
+    body += f" https://example.com/reset?token=tok{n:08d}"
+    return subject, sender, body
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(p / 100 * len(timings)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = SearchIndex()
+
+    start = time.perf_counter()
+    for n in range(args.messages):
+        index.add_document("mailbox", f"{n:010d}", *make_message(rng, n))
+    duration = time.perf_counter() - start
+    print(
+        f"indexed {args.messages} messages in {duration:.1f}s "
+        f"({args.messages / duration:.0f} msg/s)"
+    )
+
+    kinds = {
+        "rare": lambda: f"tok{rng.randrange(args.messages):08d}",
+        "common": lambda: rng.choice(COMMON),
+        "two words": lambda: f"{rng.choice(COMMON)} {rng.choice(WORDS)}",
+    }
+    for kind, make_query in kinds.items():
+        timings = []
+        for _ in range(args.queries):
+            query = make_query()
+            start = time.perf_counter()
+            index.search("mailbox", query)
+            timings.append(time.perf_counter() - start)
+
+        print(
+            f"{kind:>10} queries: "
+            f"p50 {1000 * statistics.median(timings):.3f}ms "
+            f"p99 {1000 * percentile(timings, 99):.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
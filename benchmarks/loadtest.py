@@ -0,0 +1,268 @@
+"""Measure how long it takes for delivered email to become visible
+
+Starts a mailboxzero server (like `tests/conftest.py` does, but in a child
+process so the load generator doesn't compete with it) on random ports and
+replays a corpus of emails over many concurrent SMTP connections at a target
+rate. Concurrently, pollers read `/api/<address>` until each message shows up.
+
+Reports delivery-to-visible latency (from the SMTP "250 OK" until the message
+is listed by the API), how much of that was spent waiting for a free poller,
+SMTP throughput, HTTP latency and errors and the RSS of the server over time.
+
+    python benchmarks/loadtest.py --rate 200 --messages 5000 --smtp-clients 20
+"""
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import pathlib
+import statistics
+import tempfile
+import time
+
+from email.message import EmailMessage
+
+import tornado.httpclient
+
+from aiosmtplib import SMTP as SMTPClient
+
+from utils import random_port, serve, wait_for_server
+
+
+HERE = pathlib.Path(__file__).parent.absolute()
+TEST_DATA = HERE.parent / "tests" / "data"
+
+
+def load_corpus(sizes):
+    """Raw messages from tests/data plus synthetic ones of the given sizes"""
+    corpus = []
+    if TEST_DATA.exists():
+        for path in sorted(TEST_DATA.iterdir()):
+            if path.is_file():
+                corpus.append(path.read_bytes())
+
+    for size in sizes:
+        message = EmailMessage()
+        message["From"] = "loadtest@remote.example.com"
+        message["Subject"] = f"A message of about {size} bytes"
+        message.set_content(("All work and no play. " * (1 + size // 22))[:size])
+        corpus.append(message.as_bytes())
+
+    return corpus
+
+
+def rss(pid):
+    """Resident set size of a process in MB"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class LoadTest:
+    def __init__(self, args, http_port, smtp_port, server_pid):
+        self.args = args
+        self.base_url = f"http://127.0.0.1:{http_port}/api"
+        self.smtp_port = smtp_port
+        self.server_pid = server_pid
+        self.corpus = load_corpus(args.sizes)
+
+        self.numbers = itertools.count()
+        self.pending = asyncio.Queue()
+        self.sent = 0
+        self.failed = 0
+        self.lost = 0
+        self.http_errors = 0
+        self.visible_latencies = []
+        self.queue_waits = []
+        self.http_latencies = []
+        self.rss_samples = []
+
+    async def smtp_client(self, deadline_for):
+        client = SMTPClient(hostname="127.0.0.1", port=self.smtp_port)
+        await client.connect()
+        try:
+            while True:
+                n = next(self.numbers)
+                if n >= self.args.messages:
+                    return
+
+                # pace clients so that together they send at the target rate
+                delay = deadline_for(n) - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                # the envelope decides where a message is delivered, the
+                # headers of the message don't matter
+                address = f"load-{n}@mb0.wtte.ch"
+                try:
+                    await client.sendmail(
+                        "loadtest@remote.example.com",
+                        [address],
+                        self.corpus[n % len(self.corpus)],
+                    )
+                except Exception:
+                    self.failed += 1
+                    continue
+
+                self.sent += 1
+                await self.pending.put((address, time.perf_counter()))
+        finally:
+            await client.quit()
+
+    async def poller(self, http):
+        while True:
+            address, delivered = await self.pending.get()
+            try:
+                await self.poll(http, address, delivered)
+            except Exception:
+                self.lost += 1
+            finally:
+                self.pending.task_done()
+
+    async def poll(self, http, address, delivered):
+        """Poll the mailbox at address until the message delivered shows up"""
+        polling = time.perf_counter()
+        # with too few pollers messages queue up before we look for them
+        self.queue_waits.append(polling - delivered)
+
+        while True:
+            start = time.perf_counter()
+            response = await http.fetch(
+                f"{self.base_url}/{address}", raise_error=False
+            )
+            now = time.perf_counter()
+            self.http_latencies.append(now - start)
+
+            if response.code != 200:
+                self.http_errors += 1
+            elif b'"emails": []' not in response.body:
+                self.visible_latencies.append(now - delivered)
+                return
+
+            if now - polling > self.args.poll_timeout:
+                self.lost += 1
+                return
+            await asyncio.sleep(self.args.poll_interval)
+
+    async def sample_rss(self):
+        start = time.perf_counter()
+        while True:
+            self.rss_samples.append((time.perf_counter() - start, rss(self.server_pid)))
+            await asyncio.sleep(1)
+
+    async def run(self):
+        http = tornado.httpclient.AsyncHTTPClient(max_clients=self.args.pollers)
+        sampler = asyncio.ensure_future(self.sample_rss())
+        pollers = [
+            asyncio.ensure_future(self.poller(http)) for _ in range(self.args.pollers)
+        ]
+
+        start = time.perf_counter()
+
+        def deadline_for(n):
+            return start + n / self.args.rate
+
+        await asyncio.gather(
+            *(self.smtp_client(deadline_for) for _ in range(self.args.smtp_clients))
+        )
+        smtp_duration = time.perf_counter() - start
+
+        await self.pending.join()
+        for task in pollers + [sampler]:
+            task.cancel()
+
+        self.report(smtp_duration)
+
+    def report(self, smtp_duration):
+        ms = 1000
+        print(f"sent {self.sent} messages ({self.failed} failed)")
+        print(f"never became visible: {self.lost} messages")
+        print(f"SMTP throughput: {self.sent / smtp_duration:.1f} messages/s")
+        print(
+            "delivery to visible: "
+            f"p50 {ms * percentile(self.visible_latencies, 50):.1f}ms "
+            f"p99 {ms * percentile(self.visible_latencies, 99):.1f}ms "
+            f"max {ms * max(self.visible_latencies, default=float('nan')):.1f}ms"
+        )
+        print(
+            "  of which waiting for a poller: "
+            f"p50 {ms * percentile(self.queue_waits, 50):.1f}ms "
+            f"p99 {ms * percentile(self.queue_waits, 99):.1f}ms "
+            f"max {ms * max(self.queue_waits, default=float('nan')):.1f}ms"
+        )
+        print(
+            f"HTTP latency ({len(self.http_latencies)} requests, "
+            f"{self.http_errors} errors): "
+            f"p50 {ms * percentile(self.http_latencies, 50):.1f}ms "
+            f"p99 {ms * percentile(self.http_latencies, 99):.1f}ms "
+            f"mean {ms * statistics.mean(self.http_latencies or [0]):.1f}ms"
+        )
+        print("server RSS over time:")
+        for elapsed, megabytes in self.rss_samples:
+            print(f"  {elapsed:6.1f}s {megabytes:8.1f}MB")
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument(
+        "--rate", type=float, default=100, help="target messages per second"
+    )
+    parser.add_argument("--smtp-clients", type=int, default=10)
+    parser.add_argument("--pollers", type=int, default=10)
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=0.005,
+        help="seconds between polls of a mailbox that is still empty",
+    )
+    parser.add_argument(
+        "--poll-timeout",
+        type=float,
+        default=30,
+        help="seconds after which a message that didn't show up counts as lost",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[1_000, 10_000, 100_000],
+        help="sizes in bytes of synthetic messages added to the corpus",
+    )
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+
+    http_port = random_port()
+    smtp_port = random_port()
+
+    with tempfile.TemporaryDirectory() as base_maildir:
+        server = multiprocessing.Process(
+            target=serve,
+            args=(base_maildir,),
+            kwargs={"http_port": http_port, "smtp_port": smtp_port},
+            daemon=True,
+        )
+        server.start()
+        try:
+            wait_for_server(ports=(http_port, smtp_port))
+            load_test = LoadTest(args, http_port, smtp_port, server.pid)
+            asyncio.run(load_test.run())
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Helpers shared by the benchmarks that run a mailboxzero server"""
+import asyncio
+import logging
+import socket
+import time
+
+
+def random_port():
+    sock = socket.socket()
+    sock.bind(("", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def serve(base_maildir, **kwargs):
+    """Run a mailboxzero server, meant as target of a child process"""
+    import mailboxzero
+
+    mailboxzero.start_all(base_maildir=base_maildir, **kwargs)
+    # logging every request would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.get_event_loop().run_forever()
+
+
+def wait_for_server(ports=(), unix_socket=None, timeout=10):
+    """Wait until the server accepts connections on all ports and the socket"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            for port in ports:
+                socket.create_connection(("127.0.0.1", port)).close()
+            if unix_socket is not None:
+                sock = socket.socket(socket.AF_UNIX)
+                try:
+                    sock.connect(unix_socket)
+                finally:
+                    sock.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("The server didn't start in time")
+            time.sleep(0.1)
@@ -1,73 +1,154 @@
 import argparse
 import asyncio
 import email
+import email.generator
 import email.policy
+import hmac
 import html
+import io
 import json
 import logging
 import mailbox
 import os
 import pathlib
 import random
+import re
 import string
 import time
+import zipfile
 
 from email.message import EmailMessage
 from functools import partial
 from textwrap import dedent
 
-import bleach
+# imported first so it can measure how long the other imports take
+from .startup import Background, preload, profile
 
-import tornado
-import tornado.options
-from tornado.ioloop import IOLoop
-from tornado.log import app_log
-from tornado.web import RequestHandler, HTTPError
+with profile.measure("import tornado"):
+    import tornado
+    import tornado.options
+    from tornado.ioloop import IOLoop
+    from tornado.log import app_log
+    from tornado.web import RequestHandler, HTTPError
 
-from aiosmtpd.smtp import SMTP as SMTPServer
-from aiosmtpd.handlers import COMMASPACE
-
-from urlextract import URLExtract
-
-import friendlywords
+with profile.measure("import aiosmtpd"):
+    from aiosmtpd.lmtp import LMTP as LMTPServer
+    from aiosmtpd.smtp import SMTP as SMTPServer
+    from aiosmtpd.handlers import COMMASPACE
 
+from . import archive
 from . import services
+from . import tracing
 from . import utils
+from . import workers
+from .fragments import FragmentCache, template_version
+from .quota import Quotas
+from .search import SearchIndex
+from .snapshot import Snapshot
+from .waiters import Waiter, Waiters
+from .watchdog import Watchdog
+from .workers import Workers
 
 
 HERE = pathlib.Path(__file__).parent.absolute()
 
 
-def remove_old_email(domain, max_age, base_maildir, gc_interval):
-    """Remove old emails for a given domain"""
+def remove_old_email(
+    domain,
+    max_age,
+    base_maildir,
+    gc_interval,
+    listeners=(),
+    fanout=0,
+    quotas=None,
+    reschedule=True,
+):
+    """Remove old emails for a given domain
+
+    Unless reschedule is false the next run is scheduled before returning.
+    """
     app_log.info(f"Cleaning up old email for {domain}")
     try:
-        maildir = os.path.join(base_maildir, utils.domain_to_path(domain))
-        app_log.debug(f"Checking {maildir} ...")
+        mailboxes = services.Mailboxes(base_maildir, fanout=fanout)
+        app_log.debug(f"Checking {mailboxes.domain_dir(domain)} ...")
 
         now = time.time()
 
-        for entry in os.listdir(maildir):
-            mbox = mailbox.Maildir(os.path.join(maildir, entry))
+        for key, mail_dir in mailboxes.mailbox_dirs(domain):
+            mbox = mailbox.Maildir(mail_dir)
 
+            discarded = []
             for msg_id in mbox.keys():
                 ts, _ = msg_id.split(".", maxsplit=1)
                 ts = int(ts)
                 if now - max_age > ts:
                     mbox.discard(msg_id)
+                    discarded.append(msg_id)
+
+            if discarded:
+                for listener in listeners:
+                    listener.messages_removed(key, discarded)
 
     finally:
-        jitter = 0.3 * (0.5 - random.random())
-        IOLoop.current().call_later(
-            (1 + jitter) * gc_interval,
-            remove_old_email,
-            domain,
-            max_age,
-            base_maildir,
-            gc_interval,
+        if reschedule:
+            # clean up more often when storage is running out
+            interval = gc_interval
+            if quotas is not None:
+                interval = quotas.gc_interval(domain, gc_interval)
+
+            jitter = 0.3 * (0.5 - random.random())
+            IOLoop.current().call_later(
+                (1 + jitter) * interval,
+                remove_old_email,
+                domain,
+                max_age,
+                base_maildir,
+                gc_interval,
+                listeners,
+                fanout,
+                quotas,
+            )
+
+
+def purge(mailboxes, trashed, listeners=()):
+    """Delete trashed mailboxes in a thread and tell listeners about it"""
+
+    def notify(future):
+        for key, message_ids in future.result().items():
+            for listener in listeners:
+                listener.messages_removed(key, message_ids)
+
+    IOLoop.current().add_future(
+        IOLoop.current().run_in_executor(None, mailboxes.empty_trash, trashed),
+        notify,
+    )
+
+
+def migrate_layout(domain, base_maildir, fanout, batch_size=500):
+    """Move the mailboxes of a domain to the sharded layout
+
+    Mailboxes are moved in small batches so that the server keeps handling
+    requests and deliveries while the migration runs.
+    """
+    mailboxes = services.Mailboxes(base_maildir, fanout=fanout)
+    moved = mailboxes.migrate(domain, limit=batch_size)
+
+    if moved:
+        app_log.info(f"Moved {moved} mailboxes of {domain} to the sharded layout")
+        IOLoop.current().add_callback(
+            migrate_layout, domain, base_maildir, fanout, batch_size
         )
 
 
+def random_address():
+    # friendlywords loads its word lists when imported
+    import friendlywords
+
+    predicate = random.choice(friendlywords.predicates)
+    object = random.choice(friendlywords.objects)
+    return f"{predicate}-{object}@qmq.ch"
+
+
 class ViewHandler(RequestHandler):
     def get(self):
         email = self.get_argument("email", default="")
@@ -75,19 +156,12 @@ class ViewHandler(RequestHandler):
             self.redirect(f"/view/{email}/")
 
         else:
-            predicate = random.choice(friendlywords.predicates)
-            object = random.choice(friendlywords.objects)
-            random_email = f"{predicate}-{object}@qmq.ch"
-            self.render("view.html", random_email=random_email)
+            self.render("view.html", random_email=random_address())
 
 
 class QuickHandler(RequestHandler):
     def get(self):
-        predicate = random.choice(friendlywords.predicates)
-        object = random.choice(friendlywords.objects)
-        random_email = f"{predicate}-{object}@qmq.ch"
-
-        self.redirect(f"/view/{random_email}/")
+        self.redirect(f"/view/{random_address()}/")
 
 
 class BaseHandler(RequestHandler):
@@ -95,35 +169,168 @@ class BaseHandler(RequestHandler):
     def base_maildir(self):
         return self.settings["base_maildir"]
 
+    @property
+    def mailboxes(self):
+        return services.Mailboxes(
+            self.base_maildir, fanout=self.settings["layout_fanout"]
+        )
+
     @property
     def url_extractor(self):
         return self.settings["url_extractor"]
 
+    @property
+    def waiters(self):
+        return self.settings["waiters"]
+
+    @property
+    def listeners(self):
+        return self.settings["listeners"]
+
+    @property
+    def search_index(self):
+        return self.settings["search_index"]
+
+    @property
+    def tracer(self):
+        return self.settings["tracer"]
+
+    @property
+    def workers(self):
+        return self.settings["workers"]
+
+    async def coalesce(self, key, func, *args):
+        """Await func(*args), sharing the result with identical requests
+
+        Requests for the same key that arrive while the first one is still
+        being computed wait for it instead of doing the same work again. See
+        `services.SingleFlight`.
+        """
+        return await self.settings["single_flight"].run(key, func, *args)
+
+    def message_size(self, address, message_id):
+        """Size in bytes of message_id as stored, zero if it doesn't exist"""
+        path = self.mailboxes.message_path(address, message_id)
+        try:
+            return os.path.getsize(path) if path is not None else 0
+        except OSError:
+            return 0
+
+    def trace_message(self, address, message_id):
+        """Record this request as a span in the trace of the message it reads"""
+        if not self.tracer.enabled:
+            return
+
+        path = self.mailboxes.message_path(address, message_id)
+        if path is not None:
+            self._trace_span = tracing.Span(
+                f"http {type(self).__name__}",
+                tracing.read_trace_id(path),
+                attributes={"message_id": message_id},
+            )
+
+    def on_finish(self):
+        span = getattr(self, "_trace_span", None)
+        if span is not None and span.trace_id is not None:
+            span.set(status=self.get_status())
+            duration = self.request.request_time()
+            self.tracer.record(span, time.time() - duration, duration)
+
+    async def search(self, address, query):
+        """IDs of emails to address that match the search query"""
+        await self.coalesce(
+            ("ensure_indexed", address),
+            self.search_index.ensure_indexed,
+            address,
+            self.mailboxes,
+        )
+        return self.search_index.search(utils.address_key(address), query)
+
     def force_trailing_slash(self):
-        if not self.request.uri.endswith("/"):
-            self.redirect(self.request.uri + "/", status=301)
+        if not self.request.path.endswith("/"):
+            url = self.request.path + "/"
+            if self.request.query:
+                url += "?" + self.request.query
+            self.redirect(url, status=301)
             raise tornado.web.Finish()
 
 
 class ViewMailBoxHandler(BaseHandler):
-    def get(self, address):
+    async def get(self, address):
         self.force_trailing_slash()
 
-        mailboxes = services.Mailboxes(self.base_maildir)
-        summaries = mailboxes.get_message_summaries(address)
-        email_ids = list(sorted(summaries))
+        query = self.get_argument("q", default="").strip()
+
+        email_ids = await self.coalesce(
+            ("email_ids", address),
+            IOLoop.current().run_in_executor,
+            None,
+            self.mailboxes.email_ids,
+            address,
+        )
+        if query:
+            matches = set(await self.search(address, query))
+            email_ids = [i for i in email_ids if i in matches]
 
         self.render(
             "mailbox.html",
             email_ids=email_ids,
             address=address,
-            summaries=summaries,
+            entries=await self.render_entries(address, email_ids),
+            query=query,
         )
 
+    async def render_entries(self, address, email_ids):
+        """Render the list entry of each email, reusing cached ones"""
+        cache = self.settings["fragment_cache"]
+        version = self.settings["fragment_version"]
+        if self.settings.get("debug"):
+            version = template_version(self.entry_template_path)
+
+        entries = {}
+        for email_id in email_ids:
+            entries[email_id] = cache.get(email_id, version)
+
+        missing = [i for i, entry in entries.items() if entry is None]
+        if missing:
+            summaries = {}
+            snapshot = self.settings["snapshot"]
+            if snapshot is not None:
+                summaries = snapshot.summaries(address, missing)
+            unknown = [i for i in missing if i not in summaries]
+            if unknown:
+                summaries.update(
+                    await self.coalesce(
+                        ("summaries", address, tuple(unknown)),
+                        IOLoop.current().run_in_executor,
+                        None,
+                        self.mailboxes.get_message_summaries,
+                        address,
+                        unknown,
+                    )
+                )
+            for email_id in missing:
+                if email_id not in summaries:
+                    # removed since we listed the mailbox
+                    del entries[email_id]
+                    continue
+
+                entry = self.render_string(
+                    "_email_link.html", email_id=email_id, summary=summaries[email_id]
+                )
+                cache.set(email_id, version, entry)
+                entries[email_id] = entry
+
+        return b"".join(entries.values())
+
+    @property
+    def entry_template_path(self):
+        return os.path.join(self.get_template_path(), "_email_link.html")
+
 
 class ViewEMailHandler(BaseHandler):
-    def get(self, address, message_id):
-        mailboxes = services.Mailboxes(self.base_maildir)
+    async def get(self, address, message_id):
+        mailboxes = self.mailboxes
 
         error_message = {"message": "This email doesn't exist."}
 
@@ -138,25 +345,22 @@ class ViewEMailHandler(BaseHandler):
             self.write(error_message)
             return
 
-        message = mailboxes.get_message(address, message_id)
-        attachments = mailboxes.get_attachment_summaries(address, message_id)
-
+        self.trace_message(address, message_id)
         content_base_url = f"/content/{address}/{message_id}/"
+        message = await self.coalesce(
+            ("render_email", address, message_id),
+            self.workers.run,
+            self.message_size(address, message_id),
+            workers.render_email,
+            self.base_maildir,
+            self.settings["layout_fanout"],
+            address,
+            message_id,
+            content_base_url,
+            self.static_url("dist/main.css"),
+        )
 
-        if message["richestBody"]["content-type"] == "text/html":
-
-            message_html = utils.rewrite_html(
-                message["richestBody"]["content"],
-                content_base_url,
-                make_static_url=self.static_url,
-            )
-
-        else:
-            message_html = bleach.linkify(
-                bleach.clean(message["richestBody"]["content"], strip=True)
-            )
-
-        escaped_message = html.escape(message_html)
+        escaped_message = html.escape(message["html"])
 
         # Try and make loading untrusted content from the email a little less
         # risky and private
@@ -170,15 +374,13 @@ class ViewEMailHandler(BaseHandler):
             subject=message["subject"],
             raw_message_html=escaped_message,
             content_base_url=content_base_url,
-            attachments=attachments,
+            attachments=message["attachments"],
         )
 
 
 class ContentHandler(BaseHandler):
     async def get(self, address, message_id, content_id):
         """Serve content from message_id referred to by content_id"""
-        mailboxes = services.Mailboxes(self.base_maildir)
-
         # if the client has an etag they must have visited before and the
         # content won't have changed for the same message_id and content_id
         # so we can take a shortcut here and reply "not modified"
@@ -186,16 +388,28 @@ class ContentHandler(BaseHandler):
             self.set_status(304)
             return
 
-        content = mailboxes.get_content(address, message_id, content_id)
+        self.trace_message(address, message_id)
+        content = await self.coalesce(
+            ("extract_content", address, message_id, content_id),
+            self.workers.run,
+            self.message_size(address, message_id),
+            workers.extract_content,
+            self.base_maildir,
+            self.settings["layout_fanout"],
+            address,
+            message_id,
+            content_id,
+        )
         if content is None:
             self.set_status(404)
             self.write({"message": "Content does not exist."})
             return
 
+        content_type, payload = content
         self.set_header("cache-control", "public, max-age=0, must-revalidate")
         self.set_header("age", "0")
-        self.set_header("content-type", content.get_content_type())
-        self.write(content.get_content())
+        self.set_header("content-type", content_type)
+        self.write(payload)
 
 
 class BaseAPIHandler(BaseHandler):
@@ -226,20 +440,179 @@ class PingHandler(BaseAPIHandler):
 
 class MailBoxHandler(BaseAPIHandler):
     async def get(self, address):
-        mailboxes = services.Mailboxes(self.base_maildir)
+        mailboxes = self.mailboxes
         emails = mailboxes.email_ids(address)
 
         self.write({"emails": emails})
 
+    async def delete(self, address):
+        """Delete all email of address
+
+        The mailbox is moved out of the way immediately and its contents
+        deleted in the background.
+        """
+        mailboxes = self.mailboxes
+        purge(mailboxes, mailboxes.trash_mailbox(address), self.listeners)
+
+        self.set_status(202)
+        self.write({"message": "All emails will be deleted."})
+
+
+class BaseAdminHandler(BaseAPIHandler):
+    def prepare(self):
+        """Only allow requests with the right admin token"""
+        admin_token = self.settings["admin_token"]
+        authorization = self.request.headers.get("Authorization", "")
+        if not admin_token or not hmac.compare_digest(
+            authorization.encode(), f"token {admin_token}".encode()
+        ):
+            raise HTTPError(403)
+
+
+class DomainAdminHandler(BaseAdminHandler):
+    async def delete(self, domain):
+        """Delete all email of all mailboxes of a domain"""
+        mailboxes = self.mailboxes
+        if not os.path.exists(mailboxes.domain_dir(domain)):
+            self.set_status(404)
+            self.write({"message": "This domain doesn't exist."})
+            return
+
+        purge(mailboxes, mailboxes.trash_domain(domain), self.listeners)
+
+        self.set_status(202)
+        self.write({"message": "All emails will be deleted."})
+
+
+class StallsAdminHandler(BaseAdminHandler):
+    def get(self):
+        """Statistics of the times the event loop was blocked"""
+        watchdog = self.settings["watchdog"]
+        if watchdog is None:
+            self.set_status(404)
+            self.write({"message": "The watchdog is not running."})
+            return
+
+        self.write(watchdog.stats())
+
+
+class CoalescingAdminHandler(BaseAdminHandler):
+    def get(self):
+        """How many requests shared the work done for another one"""
+        self.write(self.settings["single_flight"].stats())
+
+
+class MailboxesAdminHandler(BaseAdminHandler):
+    async def get(self):
+        """List the mailboxes with a key in the range given by start and end
+
+        See `utils.key_in_range`. This is used to find the mailboxes that
+        have to move to another node when the nodes of a cluster change.
+        """
+        start = self.get_argument("start", default="")
+        end = self.get_argument("end", default="")
+
+        def find():
+            return [
+                {"domain": domain_path, "key": key}
+                for domain_path, key, _ in self.mailboxes.all_mailbox_dirs()
+                if utils.key_in_range(key, start, end)
+            ]
+
+        self.write({"mailboxes": await IOLoop.current().run_in_executor(None, find)})
+
+
+class MailboxAdminHandler(BaseAdminHandler):
+    """Move a mailbox, identified by the path of its domain and its key"""
+
+    async def get(self, domain_path, key):
+        """Download all messages of the mailbox as a zip archive"""
+        mailboxes = self.mailboxes
+        if not os.path.exists(mailboxes.mail_dir_for_key(domain_path, key)):
+            self.set_status(404)
+            self.write({"message": "This mailbox doesn't exist."})
+            return
+
+        messages = mailboxes.message_paths_for_key(domain_path, key)
+        self.set_header("Content-Type", "application/zip")
+        for chunk in archive.iter_zip(messages):
+            self.write(chunk)
+            await self.flush()
+
+    async def put(self, domain_path, key):
+        """Add the messages in the zip archive sent as body to the mailbox"""
+        try:
+            added = await IOLoop.current().run_in_executor(
+                None,
+                self.mailboxes.add_messages,
+                domain_path,
+                key,
+                archive.read_zip(self.request.body),
+            )
+        except (zipfile.BadZipFile, ValueError) as e:
+            raise HTTPError(400, f"Invalid archive: {e}")
+
+        for listener in self.listeners:
+            listener.messages_imported(key, added)
+        self.write({"added": len(added)})
+
+    async def delete(self, domain_path, key):
+        """Delete the mailbox and all its messages
+
+        With a JSON body like `{"ids": [...]}` only those messages are
+        deleted, and the mailbox only if no others are left in it. See
+        `services.Mailboxes.remove_messages`.
+        """
+        mailboxes = self.mailboxes
+        if self.request.body:
+            await self.delete_messages(domain_path, key)
+            return
+
+        trashed = mailboxes.trash_key(domain_path, key)
+        if not trashed:
+            self.set_status(404)
+            self.write({"message": "This mailbox doesn't exist."})
+            return
+
+        purge(mailboxes, trashed, self.listeners)
+
+        self.set_status(202)
+        self.write({"message": "All emails will be deleted."})
+
+    async def delete_messages(self, domain_path, key):
+        try:
+            message_ids = json.loads(self.request.body)["ids"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPError(400, f"Invalid message IDs: {e}")
+
+        mailboxes = self.mailboxes
+        if not os.path.exists(mailboxes.mail_dir_for_key(domain_path, key)):
+            self.set_status(404)
+            self.write({"message": "This mailbox doesn't exist."})
+            return
+
+        removed, remaining = await IOLoop.current().run_in_executor(
+            None, mailboxes.remove_messages, domain_path, key, message_ids
+        )
+        for listener in self.listeners:
+            listener.messages_removed(key, removed)
+        self.write({"removed": len(removed), "remaining": remaining})
+
+
+class SearchHandler(BaseAPIHandler):
+    async def get(self, address):
+        query = self.get_argument("q")
+        self.write({"emails": await self.search(address, query)})
+
 
 class EMailHandler(BaseAPIHandler):
-    def add_urls(self, body):
+    def add_urls(self, body, url_extractor):
         """Add list of URLs parsed from the body to the object"""
-        urls = self.url_extractor.find_urls(body["content"])
+        urls = url_extractor.find_urls(body["content"])
         body["urls"] = urls
 
     async def get(self, address, message_id):
-        mailboxes = services.Mailboxes(self.base_maildir)
+        mailboxes = self.mailboxes
 
         error_message = {"message": "This email doesn't exist."}
 
@@ -254,37 +627,248 @@ class EMailHandler(BaseAPIHandler):
             self.write(error_message)
             return
 
-        message = mailboxes.get_message(address, message_id)
-        for body in (message["richestBody"], message["simplestBody"]):
-            self.add_urls(body)
+        self.trace_message(address, message_id)
+        self.write(await self.parse_message(address, message_id))
+
+    async def parse_message(self, address, message_id):
+        """The message as returned by `workers.parse_email` with URLs added
+
+        Parsing is shared with concurrent requests for the same message. This
+        only happens when it runs in a worker process, without them
+        `workers.Workers.run` parses the message before another request
+        has a chance to join in.
+        """
+        message = await self.coalesce(
+            ("parse_email", address, message_id),
+            self.workers.run,
+            self.message_size(address, message_id),
+            workers.parse_email,
+            self.base_maildir,
+            self.settings["layout_fanout"],
+            address,
+            message_id,
+        )
+        url_extractor = await self.url_extractor.get()
+        # the parsed message is shared with concurrent requests for it
+        message = dict(message)
+        for name in ("richestBody", "simplestBody"):
+            message[name] = dict(message[name])
+            self.add_urls(message[name], url_extractor)
+        return message
+
+
+class RawEMailHandler(BaseAPIHandler):
+    async def get(self, address, message_id):
+        """Serve the message exactly as it is stored on disk"""
+        path = self.mailboxes.message_path(address, message_id)
+        if path is None:
+            self.set_status(404)
+            self.write({"message": "This email doesn't exist."})
+            return
+
+        # messages never change so their ID is a good etag
+        self.set_header("Etag", f'"{message_id}"')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        self.trace_message(address, message_id)
+        self.set_header("Content-Type", "message/rfc822")
+        self.set_header("Content-Length", os.path.getsize(path))
+        for chunk in archive.iter_file(path):
+            self.write(chunk)
+            await self.flush()
+
+
+class RawEMailsHandler(BaseAPIHandler):
+    async def get(self, address):
+        """Serve the messages listed in the id arguments as an mbox"""
+        mailboxes = self.mailboxes
+        paths = []
+        for message_id in self.get_arguments("id"):
+            path = mailboxes.message_path(address, message_id)
+            if path is not None:
+                paths.append(path)
+
+        self.set_header("Content-Type", "application/mbox")
+        for chunk in archive.iter_mbox(paths):
+            self.write(chunk)
+            await self.flush()
+
+
+class ExportHandler(BaseAPIHandler):
+    content_types = {"mbox": "application/mbox", "zip": "application/zip"}
+
+    async def get(self, address):
+        """Download all messages of a mailbox as an mbox or zip archive
+
+        The archive is generated while it is sent, waiting for each chunk to
+        be written to the client before the next one is read from disk.
+        """
+        format = self.get_argument("format", default="mbox")
+        if format not in self.content_types:
+            raise HTTPError(400, "format must be one of mbox or zip")
+
+        messages = self.mailboxes.message_paths(address)
+        if format == "zip":
+            chunks = archive.iter_zip(
+                (f"{message_id}.eml", path) for message_id, path in messages
+            )
+        else:
+            chunks = archive.iter_mbox(path for _, path in messages)
+
+        filename = re.sub(r"[^\w.@+-]", "_", address)
+        self.set_header("Content-Type", self.content_types[format])
+        self.set_header(
+            "Content-Disposition", f'attachment; filename="{filename}.{format}"'
+        )
+        for chunk in chunks:
+            self.write(chunk)
+            await self.flush()
+
+
+class WaitHandler(EMailHandler):
+    # upper limit on how long a client can ask us to hold a request open
+    max_timeout = 300
+
+    def get_timeout(self):
+        try:
+            timeout = float(self.get_argument("timeout", default="30"))
+        except ValueError:
+            raise HTTPError(400, "timeout must be a number")
+        return min(max(timeout, 0), self.max_timeout)
+
+    async def get(self, address):
+        """Wait for the next email to `address` that matches the filters"""
+        timeout = self.get_timeout()
+
+        try:
+            self.waiter = self.waiters.add(
+                Waiter(
+                    address,
+                    subject=self.get_argument("subject", default=None),
+                    sender=self.get_argument("from", default=None),
+                    body=self.get_argument("body", default=None),
+                )
+            )
+        except re.error as e:
+            raise HTTPError(400, f"Invalid regular expression: {e}")
+
+        try:
+            message_id = await asyncio.wait_for(self.waiter.future, timeout)
+        except asyncio.TimeoutError:
+            self.set_status(408)
+            self.write({"message": "No matching email arrived in time."})
+            return
+        except asyncio.CancelledError:
+            return
+        finally:
+            self.waiters.remove(self.waiter)
+
+        self.trace_message(address, message_id)
+        message = await self.parse_message(address, message_id)
+        message["id"] = message_id
 
         self.write(message)
 
+    def on_connection_close(self):
+        waiter = getattr(self, "waiter", None)
+        if waiter is not None:
+            self.waiters.remove(waiter)
+            waiter.future.cancel()
+
+
+def _url_extractor():
+    from urlextract import URLExtract
+
+    return URLExtract()
+
 
 class WebApplication(tornado.web.Application):
-    def __init__(self, base_maildir, debug=False):
+    def __init__(
+        self,
+        base_maildir,
+        debug=False,
+        waiters=None,
+        search_index=None,
+        layout_fanout=0,
+        fragment_cache=None,
+        listeners=None,
+        admin_token=None,
+        tracer=None,
+        watchdog=None,
+        workers=None,
+        snapshot=None,
+        single_flight=None,
+    ):
         handlers = [
             (r"/", QuickHandler),
             (r"/q", QuickHandler),
             (r"/view", ViewHandler),
             (r"/api", PingHandler),
             (r"/api/([^/]+)", MailBoxHandler),
+            (r"/api/([^/]+)/wait", WaitHandler),
+            (r"/api/([^/]+)/search", SearchHandler),
+            (r"/api/([^/]+)/raw", RawEMailsHandler),
+            (r"/api/([^/]+)/export", ExportHandler),
+            (r"/api/([^/]+)/([^/]+)/raw", RawEMailHandler),
             (r"/api/([^/]+)/([^/]+)", EMailHandler),
             (r"/view/([^/]+)/?", ViewMailBoxHandler),
             (r"/view/([^/]+)/([^/]+)", ViewEMailHandler),
             (r"/content/([^/]+)/([^/]+)/([^/]+)", ContentHandler),
+            (r"/admin/domains/([^/]+)", DomainAdminHandler),
+            (r"/admin/stalls", StallsAdminHandler),
+            (r"/admin/coalescing", CoalescingAdminHandler),
+            (r"/admin/mailboxes", MailboxesAdminHandler),
+            (
+                r"/admin/mailboxes/([0-9a-f]{40})/([0-9a-f]{40})",
+                MailboxAdminHandler,
+            ),
         ]
 
-        # This performs network I/O when instantiated so we start it once
-        # at the very begining and then keep a reference to it instead of
-        # creating a new instance each time we need it
-        url_extractor = URLExtract()
+        # This performs network I/O when instantiated so we start creating it
+        # in the background at the very begining and then keep a reference to
+        # it instead of creating a new instance each time we need it
+        url_extractor = Background("create URL extractor", _url_extractor)
+        url_extractor.start()
+
+        if waiters is None:
+            waiters = Waiters()
+        if search_index is None:
+            search_index = SearchIndex()
+        if fragment_cache is None:
+            fragment_cache = FragmentCache()
+        if tracer is None:
+            tracer = tracing.Tracer()
+        if workers is None:
+            workers = Workers()
+        if single_flight is None:
+            single_flight = services.SingleFlight()
+        # told about messages removed through the web application
+        if listeners is None:
+            listeners = (waiters, search_index, fragment_cache)
+
+        template_path = os.path.join(HERE, "templates")
 
         settings = dict(
             base_maildir=base_maildir,
+            layout_fanout=layout_fanout,
             debug=debug,
             url_extractor=url_extractor,
-            template_path=os.path.join(HERE, "templates"),
+            waiters=waiters,
+            search_index=search_index,
+            fragment_cache=fragment_cache,
+            listeners=listeners,
+            admin_token=admin_token,
+            tracer=tracer,
+            watchdog=watchdog,
+            workers=workers,
+            snapshot=snapshot,
+            single_flight=single_flight,
+            fragment_version=template_version(
+                os.path.join(template_path, "_email_link.html")
+            ),
+            template_path=template_path,
             static_path=os.path.join(HERE, "static"),
         )
         tornado.web.Application.__init__(self, handlers, **settings)
@@ -306,6 +890,10 @@ def replace_large_parts(message, limit=1024 * 1024):
         # we can't get the size of a multipart message
         # which means we first need to check for that
         if not part.is_multipart():
+            # decoding never makes a part larger, only decode those whose
+            # encoded payload is above the limit already
+            if len(part.get_payload()) <= limit:
+                continue
             size = len(part.get_content())
             if size > limit:
                 part.set_content(
@@ -317,6 +905,13 @@ def replace_large_parts(message, limit=1024 * 1024):
                 )
 
 
+def message_bytes(message):
+    """Serialise message the same way `mailbox.Maildir.add` does"""
+    buffer = io.BytesIO()
+    email.generator.BytesGenerator(buffer, False, 0).flatten(message)
+    return buffer.getvalue().replace(b"\n", os.linesep.encode())
+
+
 def generate_id():
     return "".join(
         [random.choice(string.ascii_lowercase + string.digits) for _ in range(8)]
@@ -338,13 +933,33 @@ def ensure_attachment_cids(message):
 
 # Our own copy of aiosmtpd.handlers.Message so we can set the policy
 class _Message:
-    def __init__(self, message_class=None):
+    def __init__(self, message_class=None, tracer=None):
         self.message_class = EmailMessage
+        self.tracer = tracer if tracer is not None else tracing.Tracer()
+
+    def session_trace_id(self, session):
+        """Trace ID shared by everything that happens in one SMTP session"""
+        if getattr(session, "trace_id", None) is None:
+            session.trace_id = tracing.new_id()
+        return session.trace_id
 
     async def handle_DATA(self, server, session, envelope):
-        envelope = self.prepare_message(session, envelope)
-        self.handle_message(envelope)
-        return "250 OK"
+        trace_id = tracing.new_id()
+        with self.tracer.span(
+            "handle_DATA",
+            trace_id,
+            session_trace_id=self.session_trace_id(session),
+            bytes=len(envelope.content),
+            recipients=len(envelope.rcpt_tos),
+        ) as span:
+            with self.tracer.span("prepare_message", trace_id, parent=span):
+                envelope = self.prepare_message(session, envelope)
+            if self.tracer.enabled:
+                # assigning adds a header, drop one the sender made up
+                del envelope[tracing.TRACE_HEADER]
+                envelope[tracing.TRACE_HEADER] = trace_id
+            reply = self.handle_message(envelope, span)
+        return "250 OK" if reply is None else reply
 
     def prepare_message(self, session, envelope):
         # If the server was created with decode_data True, then data will be a
@@ -366,41 +981,142 @@ class _Message:
         message["X-RcptTo"] = COMMASPACE.join(envelope.rcpt_tos)
         return message
 
-    def handle_message(self, message):
+    def handle_message(self, message, span=None):
+        """Store message, returns the reply to send or `None` to reply 250 OK"""
         raise NotImplementedError
 
 
 class SMTPMailboxHandler(_Message):
-    def __init__(self, base_maildir, domains, message_class=None):
+    def __init__(
+        self,
+        base_maildir,
+        domains,
+        message_class=None,
+        listeners=(),
+        fanout=0,
+        quotas=None,
+        tracer=None,
+    ):
         self.base_maildir = base_maildir
         self.domains = domains
-        super().__init__(message_class)
+        self.quotas = quotas
+        self.mailboxes = services.Mailboxes(base_maildir, fanout=fanout)
+        # notified about every message we store, see `services.MailboxListener`
+        self.listeners = listeners
+        super().__init__(message_class, tracer=tracer)
 
     async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
         address = address.lower()
 
-        if not any(address.endswith(f"@{domain}") for domain in self.domains.keys()):
-            return "550 not relaying to that domain"
+        with self.tracer.span(
+            "handle_RCPT",
+            self.session_trace_id(session),
+            domain=address.rpartition("@")[2],
+        ) as span:
+            if not any(
+                address.endswith(f"@{domain}") for domain in self.domains.keys()
+            ):
+                span.set(accepted=False)
+                return "550 not relaying to that domain"
+
+            envelope.rcpt_tos.append(address)
+            span.set(accepted=True)
+            return "250 OK"
+
+    def handle_message(self, message, span=None):
+        trace_id, data = self.prepare_delivery(message, span)
+        for recipient in message["X-RcptTo"].split(COMMASPACE):
+            self.deliver(recipient, message, data, trace_id, span)
+
+    def prepare_delivery(self, message, span=None):
+        """Get message ready to be stored, returns its trace ID and bytes"""
+        trace_id = span.trace_id if span is not None else tracing.new_id()
+
+        with self.tracer.span("replace_large_parts", trace_id, parent=span):
+            replace_large_parts(message)
+        with self.tracer.span("ensure_attachment_cids", trace_id, parent=span):
+            ensure_attachment_cids(message)
+
+        # serialise once instead of once per recipient
+        return trace_id, message_bytes(message)
+
+    def deliver(self, recipient, message, data, trace_id, span=None):
+        """Store data, the serialised message, in the mailbox of recipient"""
+        with self.tracer.span(
+            "deliver",
+            trace_id,
+            parent=span,
+            mailbox=utils.address_key(recipient),
+            bytes=len(data),
+        ) as deliver_span:
+            mail_dir = self.mailboxes.mail_dir_for(recipient)
+            os.makedirs(os.path.dirname(mail_dir), exist_ok=True)
+            mbox = mailbox.Maildir(mail_dir)
+
+            if self.quotas is not None:
+                evicted = self.quotas.make_room(recipient, mail_dir, len(data))
+                for key, message_ids in evicted.items():
+                    for listener in self.listeners:
+                        listener.messages_removed(key, message_ids)
+                deliver_span.set(evicted=sum(map(len, evicted.values())))
+
+            message_id = mbox.add(data)
+            deliver_span.set(message_id=message_id)
+
+            for listener in self.listeners:
+                listener.message_added(recipient, message_id, message)
 
-        envelope.rcpt_tos.append(address)
-        return "250 OK"
 
-    def handle_message(self, message):
-        replace_large_parts(message)
-        ensure_attachment_cids(message)
+class LMTPMailboxHandler(SMTPMailboxHandler):
+    """Deliver email handed over with LMTP, with a reply for each recipient
+
+    A recipient whose delivery failed is told to try again later without
+    affecting the others, so a client injecting lots of email only has to
+    retry those.
+    """
+
+    async def handle_DATA(self, server, session, envelope):
+        # the client waits for a reply for each recipient, even when the
+        # message couldn't be prepared for delivery to any of them
+        try:
+            return await super().handle_DATA(server, session, envelope)
+        except (LookupError, ValueError):
+            app_log.exception("Failed to process email")
+            reply = "554 5.6.0 <{}> Message can't be processed"
+        except Exception:
+            app_log.exception("Failed to prepare email for delivery")
+            reply = "451 4.3.0 <{}> Try again later"
+        return "\r\n".join(reply.format(r) for r in envelope.rcpt_tos)
+
+    def handle_message(self, message, span=None):
+        trace_id, data = self.prepare_delivery(message, span)
 
+        replies = []
         for recipient in message["X-RcptTo"].split(COMMASPACE):
-            mail_dir = os.path.join(
-                self.base_maildir, utils.adddress_to_path(recipient)
-            )
-            mbox = mailbox.Maildir(mail_dir)
-            mbox.add(message)
+            try:
+                self.deliver(recipient, message, data, trace_id, span)
+            except Exception:
+                app_log.exception(f"Failed to deliver email to {recipient}")
+                replies.append(f"451 4.3.0 <{recipient}> Try again later")
+            else:
+                replies.append(f"250 2.0.0 <{recipient}> OK")
+        return "\r\n".join(replies)
 
 
 # configuration per domain for which we will accept emails
 _DEFAULT_DOMAINS = {
-    "mb0.wtte.ch": {"max_email_age": 600},
-    "qmq.ch": {"max_email_age": 600},
+    "mb0.wtte.ch": {
+        "max_email_age": 600,
+        "max_messages": 500,
+        "max_mailbox_bytes": 50 * 1024 * 1024,
+        "max_domain_bytes": 5 * 1024 * 1024 * 1024,
+    },
+    "qmq.ch": {
+        "max_email_age": 600,
+        "max_messages": 500,
+        "max_mailbox_bytes": 50 * 1024 * 1024,
+        "max_domain_bytes": 5 * 1024 * 1024 * 1024,
+    },
 }
 
 
@@ -411,6 +1127,17 @@ def start_all(
     http_port=8880,
     smtp_port=25,
     domains=_DEFAULT_DOMAINS,
+    layout_fanout=0,
+    disk_high_water=None,
+    admin_token=None,
+    trace_file=None,
+    trace_sample_rate=1.0,
+    stall_threshold=None,
+    worker_processes=0,
+    worker_threshold=256 * 1024,
+    lmtp_socket=None,
+    lmtp_socket_mode=0o660,
+    lmtp_backlog=1024,
 ):
     # Setup mailbox directories for all the domains we handle
     for domain in domains:
@@ -424,25 +1151,145 @@ def start_all(
     else:
         logging.getLogger().setLevel(logging.INFO)
 
-    http_server = tornado.httpserver.HTTPServer(
-        WebApplication(base_maildir, debug=debug),
-        xheaders=True,
+    # State shared between the web and SMTP side that is kept up to date as
+    # messages are delivered and removed
+    waiters = Waiters()
+    search_index = SearchIndex()
+    fragment_cache = FragmentCache()
+    quotas = Quotas(
+        services.Mailboxes(base_maildir, fanout=layout_fanout),
+        domains,
+        disk_high_water=disk_high_water,
+    )
+    snapshot = Snapshot(services.Mailboxes(base_maildir, fanout=layout_fanout), domains)
+    listeners = (waiters, search_index, fragment_cache, quotas, snapshot)
+
+    tracer = tracing.Tracer(
+        tracing.JSONLinesExporter(trace_file) if trace_file else None,
+        sample_rate=trace_sample_rate,
     )
-    http_server.listen(http_port, "127.0.0.1")
 
     loop = asyncio.get_event_loop()
 
-    coro = loop.create_server(
-        partial(
-            SMTPServer,
-            SMTPMailboxHandler(base_maildir, domains, message_class=EmailMessage),
-            enable_SMTPUTF8=True,
-            hostname="mail.mb0.wtte.ch",
-        ),
-        "0.0.0.0",
-        smtp_port,
+    watchdog = None
+    if stall_threshold is not None:
+        watchdog = Watchdog(stall_threshold)
+        watchdog.start()
+
+    # Start accepting email first so that restarts lose as little as possible
+    with profile.measure("start SMTP server"):
+        coro = loop.create_server(
+            partial(
+                SMTPServer,
+                SMTPMailboxHandler(
+                    base_maildir,
+                    domains,
+                    message_class=EmailMessage,
+                    listeners=listeners,
+                    fanout=layout_fanout,
+                    quotas=quotas,
+                    tracer=tracer,
+                ),
+                enable_SMTPUTF8=True,
+                hostname="mail.mb0.wtte.ch",
+            ),
+            "0.0.0.0",
+            smtp_port,
+        )
+        loop.run_until_complete(coro)
+    profile.mark("SMTP server listening")
+
+    # For injecting lots of email from the same host without the overhead of
+    # TCP, replies tell the client which recipients to retry
+    if lmtp_socket is not None:
+        with profile.measure("start LMTP server"):
+            coro = loop.create_unix_server(
+                partial(
+                    LMTPServer,
+                    LMTPMailboxHandler(
+                        base_maildir,
+                        domains,
+                        message_class=EmailMessage,
+                        listeners=listeners,
+                        fanout=layout_fanout,
+                        quotas=quotas,
+                        tracer=tracer,
+                    ),
+                    enable_SMTPUTF8=True,
+                    hostname="mail.mb0.wtte.ch",
+                ),
+                lmtp_socket,
+                # injectors open many connections at once, more than the
+                # default of 100 would be refused while we are busy
+                backlog=lmtp_backlog,
+            )
+            loop.run_until_complete(coro)
+            # the umask decides who may connect otherwise
+            os.chmod(lmtp_socket, lmtp_socket_mode)
+        profile.mark("LMTP server listening")
+
+    workers = Workers(worker_processes, threshold=worker_threshold)
+    workers.start()
+
+    with profile.measure("start HTTP server"):
+        http_server = tornado.httpserver.HTTPServer(
+            WebApplication(
+                base_maildir,
+                debug=debug,
+                waiters=waiters,
+                search_index=search_index,
+                layout_fanout=layout_fanout,
+                fragment_cache=fragment_cache,
+                listeners=listeners,
+                admin_token=admin_token,
+                tracer=tracer,
+                watchdog=watchdog,
+                workers=workers,
+                snapshot=snapshot,
+            ),
+            xheaders=True,
+        )
+        http_server.listen(http_port, "127.0.0.1")
+    profile.mark("HTTP server listening")
+
+    # Only needed to display emails, load them before the first visitor arrives
+    preload("bleach")
+
+    # Finish deleting mailboxes that were purged before a restart
+    mailboxes = services.Mailboxes(base_maildir, fanout=layout_fanout)
+    purge(mailboxes, mailboxes.trashed(), listeners)
+
+    def snapshot_loaded(future):
+        snapshot.restore(future.result())
+        app_log.info(f"Restored metadata of {len(snapshot)} messages")
+
+        # remove email that expired while we were down right away
+        now = time.time()
+        for domain, config in domains.items():
+            expires = snapshot.next_expiry(domain)
+            interval = config.get("gc_interval", gc_interval)
+            if expires is None or expires - now > interval:
+                continue
+            IOLoop.current().call_later(
+                max(expires - now, 0),
+                partial(
+                    remove_old_email,
+                    domain,
+                    config["max_email_age"],
+                    base_maildir,
+                    gc_interval,
+                    listeners,
+                    layout_fanout,
+                    quotas,
+                    reschedule=False,
+                ),
+            )
+
+        snapshot.verify()
+
+    IOLoop.current().add_future(
+        Background("load metadata snapshot", snapshot.load).start(), snapshot_loaded
     )
-    loop.run_until_complete(coro)
 
     for domain, config in domains.items():
         IOLoop.current().call_later(
@@ -452,8 +1299,31 @@ def start_all(
             config["max_email_age"],
             base_maildir,
             gc_interval,
+            listeners,
+            layout_fanout,
+            quotas,
+        )
+
+        # measure how much space is used by the email we already have
+        IOLoop.current().add_future(
+            Background(
+                f"measure storage used by {domain}",
+                partial(quotas.scan_domain, domain),
+            ).start(),
+            lambda future: quotas.merge(future.result()),
         )
 
+        # move mailboxes stored in the flat layout to the configured one
+        if layout_fanout:
+            IOLoop.current().add_callback(
+                migrate_layout, domain, base_maildir, layout_fanout
+            )
+
+
+async def report_startup_profile():
+    await profile.background_done()
+    app_log.info(profile.report())
+
 
 def get_argparser():
     parser = argparse.ArgumentParser(
@@ -462,6 +1332,104 @@ def get_argparser():
     parser.add_argument(
         "--debug", help="Enable debug mode", action="store_true", default=False
     )
+    parser.add_argument(
+        "--base-maildir",
+        help="Directory the mailboxes of all domains are stored in",
+        default="/tmp/mb0",
+    )
+    parser.add_argument(
+        "--http-port", help="Port the web interface listens on", type=int, default=8880
+    )
+    parser.add_argument(
+        "--smtp-port", help="Port to accept email on", type=int, default=25
+    )
+    parser.add_argument(
+        "--lmtp-socket",
+        help="Also accept email with LMTP on a Unix domain socket at this path",
+        default=None,
+    )
+    parser.add_argument(
+        "--lmtp-socket-mode",
+        help=(
+            "Permissions of the LMTP socket in octal, clients need write"
+            " permission to connect"
+        ),
+        type=partial(int, base=8),
+        default=0o660,
+    )
+    parser.add_argument(
+        "--lmtp-backlog",
+        help="Connections to the LMTP socket that may wait to be accepted",
+        type=int,
+        default=1024,
+    )
+    parser.add_argument(
+        "--layout-fanout",
+        help=(
+            "Number of directory levels to spread the mailboxes of a domain over."
+            " Existing mailboxes are migrated in the background."
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--disk-high-water",
+        help=(
+            "Fraction of the disk that may be used before the oldest email is"
+            " evicted to make room for new email, for example 0.9"
+        ),
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--admin-token",
+        help=(
+            "Token that has to be sent as 'Authorization: token <admin-token>'"
+            " to use the admin API. The admin API is disabled without it."
+        ),
+        default=os.environ.get("MAILBOXZERO_ADMIN_TOKEN"),
+    )
+    parser.add_argument(
+        "--trace-file",
+        help="Write traces of messages as JSON lines to this file",
+        default=None,
+    )
+    parser.add_argument(
+        "--trace-sample-rate",
+        help="Fraction of messages to trace",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--stall-threshold",
+        help=(
+            "Log what blocks the event loop for longer than this many seconds,"
+            " for example 0.1. Statistics are available from /admin/stalls."
+        ),
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--worker-processes",
+        help=(
+            "Number of processes to parse and render large emails in. Without"
+            " them all emails are processed by the main process."
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--worker-threshold",
+        help="Emails smaller than this many bytes are processed by the main process",
+        type=int,
+        default=256 * 1024,
+    )
+    parser.add_argument(
+        "--profile-startup",
+        help="Log how long each component takes to import and initialise",
+        action="store_true",
+        default=False,
+    )
     return parser
 
 
@@ -469,7 +1437,25 @@ def main():
     parser = get_argparser()
     args = parser.parse_args()
 
-    start_all(debug=args.debug)
+    start_all(
+        base_maildir=args.base_maildir,
+        http_port=args.http_port,
+        smtp_port=args.smtp_port,
+        debug=args.debug,
+        layout_fanout=args.layout_fanout,
+        disk_high_water=args.disk_high_water,
+        admin_token=args.admin_token,
+        trace_file=args.trace_file,
+        trace_sample_rate=args.trace_sample_rate,
+        stall_threshold=args.stall_threshold,
+        worker_processes=args.worker_processes,
+        worker_threshold=args.worker_threshold,
+        lmtp_socket=args.lmtp_socket,
+        lmtp_socket_mode=args.lmtp_socket_mode,
+        lmtp_backlog=args.lmtp_backlog,
+    )
 
     loop = asyncio.get_event_loop()
+    if args.profile_startup:
+        loop.create_task(report_startup_profile())
     loop.run_forever()
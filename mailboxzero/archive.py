@@ -0,0 +1,114 @@
+"""Stream messages as they are stored on disk, without parsing them"""
+import io
+import os
+import re
+import time
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+
+# mboxrd quoting: lines that look like a "From " separator, even when already
+# quoted, get one more ">" so they can be unquoted unambiguously
+_FROM_LINE = re.compile(rb"^(>*From )", re.MULTILINE)
+
+
+def iter_file(path, chunk_size=CHUNK_SIZE):
+    """Generate the contents of a file in chunks"""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _mbox_separator(path):
+    mtime = time.gmtime(os.path.getmtime(path))
+    return b"From MAILER-DAEMON " + time.asctime(mtime).encode() + b"\n"
+
+
+def iter_mbox(paths, chunk_size=CHUNK_SIZE):
+    """Generate an mbox (mboxrd flavour) of the messages stored in paths"""
+    for path in paths:
+        try:
+            separator = _mbox_separator(path)
+        except FileNotFoundError:
+            # removed since the caller looked it up
+            continue
+        yield separator
+
+        rest = b""
+        ends_with_newline = True
+        for chunk in iter_file(path, chunk_size):
+            # only quote complete lines, the rest waits for the next chunk
+            data = rest + chunk
+            complete, newline, rest = data.rpartition(b"\n")
+            if newline:
+                yield _FROM_LINE.sub(rb">\1", complete + newline)
+            ends_with_newline = data.endswith(b"\n")
+
+        if rest:
+            yield _FROM_LINE.sub(rb">\1", rest)
+        yield b"\n" if ends_with_newline else b"\n\n"
+
+
+class _Chunks:
+    """File object that collects what is written to it until it is taken"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(files, chunk_size=CHUNK_SIZE):
+    """Generate a zip archive of the (name, path) pairs in files
+
+    The archive is written without seeking, the size and checksum of each
+    file follow its compressed data.
+    """
+    out = _Chunks()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, path in files:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                # removed since the caller looked it up
+                continue
+
+            with f:
+                mtime = time.localtime(os.fstat(f.fileno()).st_mtime)
+                info = zipfile.ZipInfo(name, date_time=mtime[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, "w") as entry:
+                    while True:
+                        chunk = f.read(chunk_size)
+                        if not chunk:
+                            break
+                        entry.write(chunk)
+                        data = out.take()
+                        if data:
+                            yield data
+            yield out.take()
+
+    yield out.take()
+
+
+def read_zip(data):
+    """Generate (name, modification time, contents) of the files in a zip"""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            yield info.filename, mtime, archive.read(info)
@@ -0,0 +1,642 @@
+"""Spread mailboxes over several nodes by the key of their address
+
+Each node is a normal mailboxzero server that stores the mailboxes whose key
+(see `utils.address_key`) is in its range. The router accepts the HTTP
+requests and the email for all of them and passes each one on to the node
+that owns the mailbox.
+
+The layout of a cluster is a JSON file that lists its nodes:
+
+    {"nodes": [
+        {"name": "a", "start": "0", "http": "http://127.0.0.1:8881",
+         "smtp": "127.0.0.1:2501"},
+        {"name": "b", "start": "8", "http": "http://127.0.0.1:8882",
+         "smtp": "127.0.0.1:2502"}
+    ]}
+
+A node owns the keys from its `start` up to the `start` of the next node, the
+last node also owns the keys below the first `start`. Adding a node splits
+the range of an existing node so only the mailboxes in that part of the range
+have to move. Send the new layout to the router with `PUT /admin/cluster` and
+it moves them in the background. Until they are all moved the layout file
+also lists the mailboxes that are still on their old node, so a restarted
+router finds them and finishes moving them.
+"""
+import argparse
+import asyncio
+import bisect
+import hmac
+import io
+import json
+import logging
+import os
+import random
+import re
+import smtplib
+import zipfile
+
+from collections import defaultdict
+from functools import partial
+from urllib.parse import urlencode
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.httputil
+import tornado.log
+import tornado.web
+
+from aiosmtpd.smtp import SMTP as SMTPServer
+from tornado.log import app_log
+from tornado.web import HTTPError, RequestHandler
+
+from . import utils
+
+
+_START = re.compile(r"[0-9a-f]*")
+
+# headers that only apply to one connection and are not passed on
+_HOP_BY_HOP_HEADERS = {
+    "Connection",
+    "Keep-Alive",
+    "Proxy-Connection",
+    "Te",
+    "Trailer",
+    "Transfer-Encoding",
+    "Upgrade",
+}
+
+
+class Node:
+    def __init__(self, name, start, http, smtp):
+        if not _START.fullmatch(start):
+            raise ValueError(f"start of node {name} must be lower case hex")
+        self.name = name
+        self.start = start
+        self.http = http.rstrip("/")
+        self.smtp = smtp
+        host, _, port = smtp.rpartition(":")
+        self.smtp_address = (host, int(port))
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "http": self.http,
+            "smtp": self.smtp,
+        }
+
+
+class Layout:
+    """Which node owns which range of mailbox keys"""
+
+    def __init__(self, nodes):
+        if not nodes:
+            raise ValueError("A cluster needs at least one node")
+        self.nodes = sorted(nodes, key=lambda node: node.start)
+        self._starts = [node.start for node in self.nodes]
+        if len(set(self._starts)) != len(self._starts):
+            raise ValueError("Each node needs a different start")
+        if len({node.name for node in self.nodes}) != len(self.nodes):
+            raise ValueError("Each node needs a different name")
+
+    @classmethod
+    def from_json(cls, config):
+        return cls([Node(**node) for node in config["nodes"]])
+
+    def to_json(self):
+        return {"nodes": [node.to_json() for node in self.nodes]}
+
+    def owner(self, key):
+        # index -1, the last node, for keys below the first start
+        return self.nodes[bisect.bisect_right(self._starts, key) - 1]
+
+    def moves(self, new):
+        """(start, end, old owner, new owner) for the ranges that change owner
+
+        An empty end means there is no upper bound, see `utils.key_in_range`.
+        """
+        boundaries = sorted(set(self._starts) | set(new._starts) | {""})
+        moves = []
+        for start, end in zip(boundaries, boundaries[1:] + [""]):
+            old_owner = self.owner(start)
+            new_owner = new.owner(start)
+            if old_owner.name != new_owner.name:
+                moves.append((start, end, old_owner, new_owner))
+        return moves
+
+
+class Router:
+    """Find the node for a mailbox and move mailboxes when the layout changes"""
+
+    # seconds to wait before trying to move mailboxes that failed again
+    retry_interval = 10
+    max_retry_interval = 600
+    # times a mailbox is copied to catch email that arrived during the copy
+    move_rounds = 3
+
+    def __init__(self, layout, admin_token=None, layout_file=None, moving=()):
+        self.layout = layout
+        self.admin_token = admin_token
+        # the layout is saved here when it changes
+        self.layout_file = layout_file
+        self.http_client = tornado.httpclient.AsyncHTTPClient()
+
+        # mailboxes still stored on the node that owned them before the
+        # layout changed, mapped to their domain path and that node
+        self.moving = {
+            entry["key"]: (entry["domain"], Node(**entry["node"]))
+            for entry in moving
+        }
+        self.rebalancing = None
+        self.moved = 0
+        self.failed = 0
+
+    def node_for_key(self, key):
+        moving = self.moving.get(key)
+        if moving is not None:
+            return moving[1]
+        return self.layout.owner(key)
+
+    def node_for(self, address):
+        return self.node_for_key(utils.address_key(address))
+
+    def status(self):
+        return {
+            "layout": self.layout.to_json(),
+            "rebalancing": self.rebalancing is not None
+            and not self.rebalancing.done(),
+            "moving": len(self.moving),
+            "moved": self.moved,
+            "failed": self.failed,
+        }
+
+    async def _admin(self, node, path, **kwargs):
+        """Call the admin API of a node"""
+        return await self.http_client.fetch(
+            node.http + path,
+            headers={"Authorization": f"token {self.admin_token}"},
+            **kwargs,
+        )
+
+    def _save_layout(self):
+        """Save the layout and the mailboxes that still have to be moved"""
+        if self.layout_file is None:
+            return
+        config = self.layout.to_json()
+        if self.moving:
+            config["moving"] = [
+                {"key": key, "domain": domain_path, "node": node.to_json()}
+                for key, (domain_path, node) in self.moving.items()
+            ]
+        tmp_file = self.layout_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(config, f, indent=2)
+        os.replace(tmp_file, self.layout_file)
+
+    def start_rebalance(self, layout):
+        self.rebalancing = asyncio.ensure_future(self.rebalance(layout))
+        return self.rebalancing
+
+    def resume_rebalance(self):
+        """Move the mailboxes a previous router left behind"""
+        self.rebalancing = asyncio.ensure_future(self.move_pending())
+        return self.rebalancing
+
+    async def _list_moving(self, moves):
+        """Add the mailboxes stored in ranges that change owner to `moving`
+
+        Returns False if a node couldn't be asked for its mailboxes.
+        """
+        responses = await asyncio.gather(
+            *(
+                self._admin(
+                    source,
+                    "/admin/mailboxes?" + urlencode({"start": start, "end": end}),
+                )
+                for start, end, source, _ in moves
+            ),
+            return_exceptions=True,
+        )
+
+        listed = True
+        for (_, _, source, _), response in zip(moves, responses):
+            if isinstance(response, Exception):
+                app_log.error(
+                    f"Failed to list mailboxes on node {source.name}: {response}"
+                )
+                self.failed += 1
+                listed = False
+                continue
+
+            for mailbox in json.loads(response.body)["mailboxes"]:
+                self.moving.setdefault(mailbox["key"], (mailbox["domain"], source))
+        return listed
+
+    async def rebalance(self, layout):
+        """Switch to a new layout and move mailboxes to their new owner
+
+        Mailboxes that do not exist yet are created on their new owner right
+        away. Existing mailboxes are read from their old owner until they
+        are moved one by one.
+        """
+        moves = self.layout.moves(layout)
+
+        # existing mailboxes have to be known before switching, otherwise
+        # requests for them would go to a node that doesn't have them
+        if not await self._list_moving(moves):
+            app_log.error("Not changing the layout")
+            self.moving.clear()
+            return
+
+        self.layout = layout
+        # look again for mailboxes the old owners created while we listed
+        await self._list_moving(moves)
+        # a router restarted before the moves finish picks up from here
+        self._save_layout()
+
+        await self.move_pending()
+
+    async def move_pending(self):
+        """Move all mailboxes in `moving` to the node that owns them now
+
+        Mailboxes that fail to move stay in `moving`, so they are still read
+        from their old node, and are tried again with increasing delays
+        until they all moved.
+        """
+        delay = self.retry_interval
+        while True:
+            app_log.info(f"Moving {len(self.moving)} mailboxes")
+            for key, (domain_path, source) in list(self.moving.items()):
+                target = self.layout.owner(key)
+                try:
+                    await self.move(domain_path, key, source, target)
+                except Exception:
+                    app_log.exception(f"Failed to move mailbox {key}")
+                    self.failed += 1
+                    self.moving.setdefault(key, (domain_path, source))
+                else:
+                    self.moved += 1
+
+            self._save_layout()
+            if not self.moving:
+                return
+
+            app_log.warning(
+                f"Moving {len(self.moving)} mailboxes again in {delay:.0f}s"
+            )
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, self.max_retry_interval)
+
+    async def move(self, domain_path, key, source, target):
+        """Copy a mailbox to target and delete the copied messages from source
+
+        Email that was already on its way to source when the mailbox left
+        `moving` can arrive after it was copied. Only the copied messages
+        are deleted and the mailbox is copied again until source has none
+        left.
+        """
+        path = f"/admin/mailboxes/{domain_path}/{key}"
+        for _ in range(self.move_rounds):
+            try:
+                response = await self._admin(source, path)
+            except tornado.httpclient.HTTPClientError as e:
+                if e.code == 404:
+                    # deleted since we listed it, or moved before a restart
+                    self.moving.pop(key, None)
+                    return
+                raise
+
+            await self._admin(target, path, method="PUT", body=response.body)
+            # email for this mailbox is delivered to the new owner from now on,
+            # the messages copied are added to what arrives there
+            self.moving.pop(key, None)
+
+            with zipfile.ZipFile(io.BytesIO(response.body)) as copied:
+                message_ids = copied.namelist()
+            response = await self._admin(
+                source,
+                path,
+                method="DELETE",
+                body=json.dumps({"ids": message_ids}),
+                allow_nonstandard_methods=True,
+            )
+            if not json.loads(response.body)["remaining"]:
+                return
+
+        raise RuntimeError(f"Email keeps arriving on node {source.name}")
+
+
+class RouterHandler(RequestHandler):
+    @property
+    def router(self):
+        return self.settings["router"]
+
+
+class ProxyHandler(RouterHandler):
+    """Pass requests on to a node and stream its response back"""
+
+    SUPPORTED_METHODS = ("GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS")
+
+    # long enough for the longest request a node holds open, see WaitHandler
+    request_timeout = 330
+
+    def compute_etag(self):
+        # the node decides about etags
+        return None
+
+    def node(self, *args):
+        # any node can serve requests that don't belong to a mailbox
+        return random.choice(self.router.layout.nodes)
+
+    def _on_header(self, line):
+        if line.startswith("HTTP/"):
+            start_line = tornado.httputil.parse_response_start_line(line.strip())
+            self.set_status(start_line.code, start_line.reason)
+            self._node_headers = tornado.httputil.HTTPHeaders()
+        elif line.strip():
+            self._node_headers.parse_line(line)
+        else:
+            for name in self._node_headers:
+                if name not in _HOP_BY_HOP_HEADERS:
+                    self.clear_header(name)
+            for name, value in self._node_headers.get_all():
+                if name not in _HOP_BY_HOP_HEADERS:
+                    self.add_header(name, value)
+
+    def _on_chunk(self, chunk):
+        self.write(chunk)
+        self.flush()
+
+    async def proxy(self, node):
+        headers = self.request.headers.copy()
+        for name in _HOP_BY_HOP_HEADERS | {"Host", "Content-Length"}:
+            headers.pop(name, None)
+        headers["X-Real-Ip"] = self.request.remote_ip
+
+        body = self.request.body
+        if not body and self.request.method not in ("POST", "PUT"):
+            body = None
+
+        try:
+            await self.router.http_client.fetch(
+                node.http + self.request.uri,
+                method=self.request.method,
+                headers=headers,
+                body=body,
+                follow_redirects=False,
+                allow_nonstandard_methods=True,
+                decompress_response=False,
+                header_callback=self._on_header,
+                streaming_callback=self._on_chunk,
+                request_timeout=self.request_timeout,
+                raise_error=False,
+            )
+        except (OSError, tornado.httpclient.HTTPClientError) as e:
+            app_log.error(f"Request to node {node.name} failed: {e}")
+            if self._headers_written:
+                raise
+            self.clear()
+            self.set_status(502)
+            self.write({"message": f"Node {node.name} is not available."})
+
+    async def get(self, *args):
+        await self.proxy(self.node(*args))
+
+    head = post = put = delete = options = get
+
+
+class MailboxProxyHandler(ProxyHandler):
+    def node(self, address):
+        return self.router.node_for(address)
+
+
+class DomainAdminHandler(RouterHandler):
+    async def delete(self, domain):
+        """Delete all email of a domain on all nodes"""
+        nodes = self.router.layout.nodes
+        responses = await asyncio.gather(
+            *(
+                self.router.http_client.fetch(
+                    node.http + self.request.uri,
+                    method="DELETE",
+                    headers={
+                        "Authorization": self.request.headers.get("Authorization", "")
+                    },
+                    raise_error=False,
+                )
+                for node in nodes
+            ),
+            return_exceptions=True,
+        )
+
+        # nodes that weren't reached may still have email for the domain
+        unavailable = []
+        for node, response in zip(nodes, responses):
+            if isinstance(response, Exception):
+                app_log.error(f"Request to node {node.name} failed: {response}")
+                unavailable.append(node.name)
+        if unavailable:
+            self.set_status(502)
+            self.write(
+                {"message": f"Node {', '.join(unavailable)} is not available."}
+            )
+            return
+
+        # 202 if any node had email for the domain, otherwise 403 or 404
+        response = min(responses, key=lambda response: response.code)
+        self.set_status(response.code)
+        content_type = response.headers.get("Content-Type")
+        if content_type is not None:
+            self.set_header("Content-Type", content_type)
+        self.write(response.body)
+
+
+class ClusterAdminHandler(RouterHandler):
+    def prepare(self):
+        """Only allow requests with the right admin token"""
+        admin_token = self.router.admin_token
+        authorization = self.request.headers.get("Authorization", "")
+        if not admin_token or not hmac.compare_digest(
+            authorization.encode(), f"token {admin_token}".encode()
+        ):
+            raise HTTPError(403)
+
+    def get(self):
+        self.write(self.router.status())
+
+    def put(self):
+        """Change the layout of the cluster and move mailboxes accordingly"""
+        try:
+            layout = Layout.from_json(json.loads(self.request.body))
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPError(400, f"Invalid layout: {e}")
+
+        if self.router.status()["rebalancing"]:
+            self.set_status(409)
+            self.write({"message": "Wait for the current rebalancing to finish."})
+            return
+
+        self.router.start_rebalance(layout)
+        self.set_status(202)
+        self.write(self.router.status())
+
+
+class RouterApplication(tornado.web.Application):
+    def __init__(self, router, debug=False):
+        handlers = [
+            (r"/admin/cluster", ClusterAdminHandler),
+            (r"/admin/domains/([^/]+)", DomainAdminHandler),
+            (r"/(?:api|view|content)/([^/]+)(?:/.*)?", MailboxProxyHandler),
+            (r".*", ProxyHandler),
+        ]
+        tornado.web.Application.__init__(self, handlers, router=router, debug=debug)
+
+
+def _forward(node, mail_from, recipients, data, smtp_utf8):
+    mail_options = ["SMTPUTF8"] if smtp_utf8 else []
+    with smtplib.SMTP(*node.smtp_address, timeout=60) as client:
+        client.sendmail(mail_from, recipients, data, mail_options=mail_options)
+
+
+class SMTPRouterHandler:
+    """Pass each message on to the nodes that own its recipients"""
+
+    def __init__(self, router, domains):
+        self.router = router
+        self.domains = domains
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        address = address.lower()
+        if not any(address.endswith(f"@{domain}") for domain in self.domains.keys()):
+            return "550 not relaying to that domain"
+
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        recipients = defaultdict(list)
+        for address in envelope.rcpt_tos:
+            recipients[self.router.node_for(address)].append(address)
+
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    None,
+                    _forward,
+                    node,
+                    envelope.mail_from,
+                    addresses,
+                    envelope.original_content,
+                    envelope.smtp_utf8,
+                )
+                for node, addresses in recipients.items()
+            ),
+            return_exceptions=True,
+        )
+
+        failed = False
+        for node, result in zip(recipients, results):
+            if isinstance(result, Exception):
+                app_log.error(f"Forwarding email to node {node.name} failed: {result}")
+                failed = True
+
+        # the sender retries all recipients, those on nodes that accepted the
+        # message get it twice
+        if failed:
+            return "451 Requested action aborted: local error in processing"
+        return "250 OK"
+
+
+def start_router(
+    layout,
+    http_port=8880,
+    smtp_port=25,
+    domains=None,
+    admin_token=None,
+    layout_file=None,
+    moving=(),
+    debug=False,
+):
+    if domains is None:
+        from . import _DEFAULT_DOMAINS as domains
+
+    tornado.log.enable_pretty_logging()
+    logging.getLogger().setLevel(logging.DEBUG if debug else logging.INFO)
+
+    router = Router(
+        layout, admin_token=admin_token, layout_file=layout_file, moving=moving
+    )
+    if router.moving:
+        router.resume_rebalance()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        loop.create_server(
+            partial(
+                SMTPServer,
+                SMTPRouterHandler(router, domains),
+                enable_SMTPUTF8=True,
+                hostname="mail.mb0.wtte.ch",
+            ),
+            "0.0.0.0",
+            smtp_port,
+        )
+    )
+
+    http_server = tornado.httpserver.HTTPServer(
+        RouterApplication(router, debug=debug), xheaders=True
+    )
+    http_server.listen(http_port, "127.0.0.1")
+    return router
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        description="Mailbox Zero router - spread mailboxes over several servers"
+    )
+    parser.add_argument(
+        "--layout",
+        help="JSON file with the nodes of the cluster, updated when it changes",
+        required=True,
+    )
+    parser.add_argument(
+        "--http-port", help="Port the web interface listens on", type=int, default=8880
+    )
+    parser.add_argument(
+        "--smtp-port", help="Port to accept email on", type=int, default=25
+    )
+    parser.add_argument(
+        "--admin-token",
+        help=(
+            "Admin token of the nodes, also needed to change the layout with"
+            " PUT /admin/cluster"
+        ),
+        default=os.environ.get("MAILBOXZERO_ADMIN_TOKEN"),
+    )
+    parser.add_argument(
+        "--debug", help="Enable debug mode", action="store_true", default=False
+    )
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+
+    with open(args.layout) as f:
+        config = json.load(f)
+
+    start_router(
+        Layout.from_json(config),
+        http_port=args.http_port,
+        smtp_port=args.smtp_port,
+        admin_token=args.admin_token,
+        layout_file=args.layout,
+        moving=config.get("moving", ()),
+        debug=args.debug,
+    )
+    asyncio.get_event_loop().run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import hashlib
+
+from collections import OrderedDict
+
+from .services import MailboxListener
+
+
+def template_version(path):
+    """Version of a template, changes whenever its contents change"""
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class FragmentCache(MailboxListener):
+    """Cache of rendered HTML fragments for individual messages
+
+    A message never changes once it has been delivered, so the fragment
+    rendered for it only changes when the template changes. Fragments are
+    dropped when their message is removed and the least recently used ones
+    are dropped once there are more than `max_entries`.
+    """
+
+    def __init__(self, max_entries=50_000):
+        self.max_entries = max_entries
+        self._fragments = OrderedDict()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def get(self, message_id, version):
+        try:
+            cached_version, fragment = self._fragments[message_id]
+        except KeyError:
+            return None
+        if cached_version != version:
+            return None
+
+        self._fragments.move_to_end(message_id)
+        return fragment
+
+    def set(self, message_id, version, fragment):
+        if not self.max_entries:
+            return
+        self._fragments[message_id] = (version, fragment)
+        self._fragments.move_to_end(message_id)
+        while len(self._fragments) > self.max_entries:
+            self._fragments.popitem(last=False)
+
+    def messages_removed(self, key, message_ids):
+        for message_id in message_ids:
+            self._fragments.pop(message_id, None)
@@ -0,0 +1,283 @@
+import heapq
+import mailbox
+import os
+import shutil
+
+from collections import defaultdict
+
+from . import utils
+from .services import MailboxListener
+
+
+def _age(message_id):
+    """Sort key for message IDs that orders them from old to new"""
+    ts, _, rest = message_id.partition(".")
+    return int(ts), rest
+
+
+class _Usage:
+    """Messages and bytes stored in one mailbox"""
+
+    def __init__(self, domain, mail_dir):
+        self.domain = domain
+        self.mail_dir = mail_dir
+        self.sizes = {}
+        self.bytes = 0
+
+    @classmethod
+    def scan(cls, domain, mail_dir):
+        usage = cls(domain, mail_dir)
+        for sub_dir in ("new", "cur"):
+            path = os.path.join(mail_dir, sub_dir)
+            if not os.path.exists(path):
+                continue
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # messages in cur/ have flags appended to their name
+                    message_id = entry.name.split(":", maxsplit=1)[0]
+                    usage.sizes[message_id] = entry.stat().st_size
+        usage.bytes = sum(usage.sizes.values())
+        return usage
+
+
+class Quotas(MailboxListener):
+    """Enforce storage limits when email is delivered
+
+    The limits are configured per domain with `max_messages` and
+    `max_mailbox_bytes` for each mailbox and `max_domain_bytes` for all
+    mailboxes of a domain together. On top of that the fraction of the disk
+    that may be used is limited to `disk_high_water`. When a limit would be
+    exceeded the oldest messages are evicted to make room for the new one.
+    """
+
+    # upper limit on how many messages are evicted to free disk space for
+    # one delivery so that a full disk can't stall the server
+    max_disk_evictions = 100
+
+    def __init__(self, mailboxes, domains, disk_high_water=None):
+        self.mailboxes = mailboxes
+        self.domains = domains
+        self.disk_high_water = disk_high_water
+
+        self._usage = {}
+        self._domain_bytes = defaultdict(int)
+        # heap of (age, message ID, key) per domain, entries for messages that
+        # were removed are skipped when they reach the top
+        self._oldest = defaultdict(list)
+        self._stale = defaultdict(int)
+
+    def domain_bytes(self, domain):
+        return self._domain_bytes[domain]
+
+    def _track(self, key, usage, heapify=True):
+        """Start accounting for a mailbox
+
+        With `heapify=False` the messages are only appended to the domain's
+        heap, the caller has to restore the heap invariant.
+        """
+        self._usage[key] = usage
+        self._domain_bytes[usage.domain] += usage.bytes
+        heap = self._oldest[usage.domain]
+        for message_id in usage.sizes:
+            entry = (_age(message_id), message_id, key)
+            if heapify:
+                heapq.heappush(heap, entry)
+            else:
+                heap.append(entry)
+
+    def scan_domain(self, domain):
+        """Measure the usage of all mailboxes of a domain
+
+        This only reads from disk and is safe to run in a thread, pass the
+        result to `merge` on the IOLoop.
+        """
+        usages = {}
+        for key, mail_dir in self.mailboxes.mailbox_dirs(domain):
+            try:
+                usages[key] = _Usage.scan(domain, mail_dir)
+            except FileNotFoundError:
+                # removed or moved to the sharded layout while we were looking
+                continue
+        return usages
+
+    def merge(self, usages):
+        """Add usage measured by `scan_domain` for mailboxes we don't know yet"""
+        domains = set()
+        for key, usage in usages.items():
+            if key not in self._usage:
+                self._track(key, usage, heapify=False)
+                domains.add(usage.domain)
+
+        for domain in domains:
+            heapq.heapify(self._oldest[domain])
+
+    def _usage_for(self, address, mail_dir):
+        key = utils.address_key(address)
+        usage = self._usage.get(key)
+        if usage is None or usage.mail_dir != mail_dir:
+            if usage is not None:
+                self._forget(key)
+            domain = address.rpartition("@")[2]
+            self._track(key, _Usage.scan(domain, mail_dir))
+        return key, self._usage[key]
+
+    def _forget(self, key):
+        usage = self._usage.pop(key)
+        self._domain_bytes[usage.domain] -= usage.bytes
+        self._stale[usage.domain] += len(usage.sizes)
+
+    def _remove(self, key, message_id):
+        usage = self._usage.get(key)
+        if usage is None or message_id not in usage.sizes:
+            return
+        size = usage.sizes.pop(message_id)
+        usage.bytes -= size
+        self._domain_bytes[usage.domain] -= size
+
+        # rebuild the heap once most of its entries refer to removed messages
+        self._stale[usage.domain] += 1
+        heap_size = len(self._oldest[usage.domain])
+        if self._stale[usage.domain] > max(1000, heap_size // 2):
+            self._rebuild_heap(usage.domain)
+
+    def _rebuild_heap(self, domain):
+        heap = [
+            (_age(message_id), message_id, key)
+            for key, usage in self._usage.items()
+            if usage.domain == domain
+            for message_id in usage.sizes
+        ]
+        heapq.heapify(heap)
+        self._oldest[domain] = heap
+        self._stale[domain] = 0
+
+    def _evict(self, key, message_ids):
+        mail_dir = self._usage[key].mail_dir
+        mbox = None
+        for message_id in message_ids:
+            # messages stay in new/ unless a mail client moved them, removing
+            # them directly saves `mailbox.Maildir` listing the whole mailbox
+            try:
+                os.remove(os.path.join(mail_dir, "new", message_id))
+            except FileNotFoundError:
+                if mbox is None:
+                    mbox = mailbox.Maildir(mail_dir, create=False)
+                mbox.discard(message_id)
+            self._remove(key, message_id)
+
+    def _evict_oldest(self, domains, evicted):
+        """Evict the oldest message stored for any of the domains"""
+        while True:
+            candidates = [
+                (self._oldest[domain][0], domain)
+                for domain in domains
+                if self._oldest[domain]
+            ]
+            if not candidates:
+                return False
+
+            (_, message_id, key), domain = min(candidates)
+            heapq.heappop(self._oldest[domain])
+            usage = self._usage.get(key)
+            if usage is not None and message_id in usage.sizes:
+                self._evict(key, [message_id])
+                evicted[key].append(message_id)
+                return True
+
+    def disk_usage(self):
+        """Fraction of the disk the mailboxes are stored on that is in use"""
+        usage = shutil.disk_usage(self.mailboxes.base_maildir)
+        return usage.used / usage.total
+
+    def pressure(self, domain):
+        """How close a domain is to its limits, 1 means at the limit
+
+        Only the limits on the domain and disk are considered, the ones on
+        individual mailboxes don't matter for how much space is left.
+        """
+        pressure = 0
+        max_domain_bytes = self.domains.get(domain, {}).get("max_domain_bytes")
+        if max_domain_bytes:
+            pressure = self._domain_bytes[domain] / max_domain_bytes
+        if self.disk_high_water:
+            pressure = max(pressure, self.disk_usage() / self.disk_high_water)
+        return pressure
+
+    def gc_interval(self, domain, interval):
+        """Run the GC more often as a domain gets closer to its limits
+
+        Up to half way to a limit the GC runs every `interval` seconds, at the
+        limit it runs ten times as often.
+        """
+        pressure = min(max(self.pressure(domain) - 0.5, 0) / 0.5, 1)
+        return interval * (1 - 0.9 * pressure)
+
+    def make_room(self, address, mail_dir, size):
+        """Evict old email so a message of `size` bytes can be delivered
+
+        Returns a dictionary mapping mailbox keys to the IDs of the messages
+        that were evicted.
+        """
+        domain = address.rpartition("@")[2]
+        config = self.domains.get(domain, {})
+        key, usage = self._usage_for(address, mail_dir)
+        evicted = defaultdict(list)
+
+        max_messages = config.get("max_messages")
+        max_mailbox_bytes = config.get("max_mailbox_bytes")
+
+        def mailbox_full():
+            if max_messages is not None and len(usage.sizes) >= max_messages:
+                return True
+            if max_mailbox_bytes is not None:
+                return usage.bytes + size > max_mailbox_bytes
+            return False
+
+        if mailbox_full():
+            for message_id in sorted(usage.sizes, key=_age):
+                self._evict(key, [message_id])
+                evicted[key].append(message_id)
+                if not mailbox_full():
+                    break
+
+        max_domain_bytes = config.get("max_domain_bytes")
+        if max_domain_bytes is not None:
+            while self._domain_bytes[domain] + size > max_domain_bytes:
+                if not self._evict_oldest([domain], evicted):
+                    break
+
+        if self.disk_high_water is not None:
+            for _ in range(self.max_disk_evictions):
+                if self.disk_usage() < self.disk_high_water:
+                    break
+                if not self._evict_oldest(list(self._oldest), evicted):
+                    break
+
+        return dict(evicted)
+
+    def message_added(self, address, message_id, message):
+        key = utils.address_key(address)
+        usage = self._usage.get(key)
+        if usage is None or message_id in usage.sizes:
+            return
+        self._add(key, usage, message_id)
+
+    def messages_imported(self, key, message_ids):
+        # mailboxes we don't know yet are measured when first delivered to
+        usage = self._usage.get(key)
+        if usage is None:
+            return
+        for message_id in message_ids:
+            if message_id not in usage.sizes:
+                self._add(key, usage, message_id)
+
+    def _add(self, key, usage, message_id):
+        size = os.stat(os.path.join(usage.mail_dir, "new", message_id)).st_size
+        usage.sizes[message_id] = size
+        usage.bytes += size
+        self._domain_bytes[usage.domain] += size
+        heapq.heappush(self._oldest[usage.domain], (_age(message_id), message_id, key))
+
+    def messages_removed(self, key, message_ids):
+        for message_id in message_ids:
+            self._remove(key, message_id)
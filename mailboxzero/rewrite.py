@@ -0,0 +1,327 @@
+"""Rewrite the body of an email for display in a single pass
+
+`rewrite_html` produces exactly the same output as `utils.rewrite_html` but
+instead of building a BeautifulSoup tree, searching it and serialising it
+again, it rewrites the stream of tags coming out of the tokenizer as it goes.
+This means it has to mimic how BeautifulSoup builds its tree from the events
+of `html.parser` and how it serialises it with `formatter=None`.
+
+`linkify_text` does the same for the bleach based sanitising of plain text
+bodies, for text that contains no markup at all.
+"""
+import html.entities
+import re
+
+from collections import defaultdict
+from html.parser import HTMLParser
+
+
+# elements that never have content, BeautifulSoup writes them as <br/>
+VOID_ELEMENTS = frozenset(
+    [
+        "area",
+        "base",
+        "basefont",
+        "bgsound",
+        "br",
+        "col",
+        "command",
+        "embed",
+        "frame",
+        "hr",
+        "image",
+        "img",
+        "input",
+        "isindex",
+        "keygen",
+        "link",
+        "menuitem",
+        "meta",
+        "nextid",
+        "param",
+        "source",
+        "spacer",
+        "track",
+        "wbr",
+    ]
+)
+
+# attributes whose value is a whitespace separated list, BeautifulSoup
+# normalises the whitespace between the values
+_LIST_ATTRIBUTES = {
+    "*": {"accesskey", "dropzone", "class"},
+    "a": {"rel", "rev"},
+    "link": {"rel", "rev"},
+    "td": {"headers"},
+    "th": {"headers"},
+    "form": {"accept-charset"},
+    "object": {"archive"},
+    "area": {"rel"},
+    "icon": {"sizes"},
+    "iframe": {"sandbox"},
+    "output": {"for"},
+}
+
+# whitespace only text is collapsed to one character outside of these
+_PRESERVE_WHITESPACE = frozenset(["pre", "textarea"])
+_ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+_ENTITIES = {
+    name[:-1]: value for name, value in html.entities.html5.items() if name[-1] == ";"
+}
+
+_NON_WHITESPACE = re.compile(r"\S+")
+_CHARSET = re.compile(r"((^|;)\s*charset=)([^;]*)", re.M)
+
+# the charset mentioned in <meta> tags is replaced with the encoding the
+# document is serialised to
+_OUTPUT_ENCODING = "utf-8"
+
+
+def _charref(name):
+    """Character for a numeric character reference like &#160; or &#xa0;"""
+    try:
+        if name[:1] in ("x", "X"):
+            number = int(name[1:], 16)
+        else:
+            number = int(name)
+    except ValueError:
+        return name
+
+    if number == 0 or number > 0x10FFFF or 0xD800 <= number <= 0xDFFF:
+        return "\ufffd"
+    if 0x80 <= number <= 0x9F:
+        # references to characters that only exist in windows-1252
+        try:
+            return bytes([number]).decode("cp1252")
+        except UnicodeDecodeError:
+            pass
+    return chr(number)
+
+
+def _quote(value):
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', "&quot;") + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+def _start_tag(name, attributes, void):
+    parts = ["<", name]
+    for key in sorted(attributes):
+        parts.append(f" {key}={_quote(attributes[key])}")
+    parts.append("/>" if void else ">")
+    return "".join(parts)
+
+
+class _Rewriter(HTMLParser):
+    def __init__(self, content_url, stylesheet):
+        super().__init__(convert_charrefs=False)
+        self.content_url = content_url
+        self.stylesheet = stylesheet
+
+        self.out = []
+        # text is collected until the next tag so that whitespace only text
+        # can be collapsed like BeautifulSoup does
+        self.text = []
+        # names of open elements, innermost last
+        self.open = []
+        self.open_count = defaultdict(int)
+        self.preserve_whitespace = 0
+        # void elements closed at their start tag whose end tag is ignored
+        self.closed_void = []
+        self.seen_head = False
+
+    def _flush(self, prefix="", suffix=""):
+        if not self.text:
+            return
+        data = "".join(self.text)
+        self.text = []
+        if not self.preserve_whitespace and not data.strip(_ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        self.out.append(prefix + data + suffix)
+
+    def _special(self, prefix, data, suffix):
+        self._flush()
+        self.text.append(data)
+        self._flush(prefix, suffix)
+
+    def _attributes(self, tag, attrs):
+        attributes = {}
+        for key, value in attrs:
+            attributes[key] = "" if value is None else value
+
+        list_attributes = _LIST_ATTRIBUTES.get(tag, ())
+        for key, value in attributes.items():
+            if key in _LIST_ATTRIBUTES["*"] or key in list_attributes:
+                attributes[key] = " ".join(_NON_WHITESPACE.findall(value))
+
+        if tag == "meta":
+            if "charset" in attributes:
+                attributes["charset"] = _OUTPUT_ENCODING
+            elif (
+                "content" in attributes
+                and attributes.get("http-equiv", "").lower() == "content-type"
+            ):
+                attributes["content"] = _CHARSET.sub(
+                    lambda m: m.group(1) + _OUTPUT_ENCODING, attributes["content"]
+                )
+
+        elif tag == "a":
+            attributes["target"] = "_blank"
+
+        elif tag == "img":
+            attributes["loading"] = "lazy"
+            attributes["decoding"] = "async"
+            src = attributes.get("src")
+            if src is not None and src.startswith("cid:"):
+                attributes["src"] = self.content_url + src[4:]
+
+        return attributes
+
+    def _start(self, tag, attrs):
+        self._flush()
+        void = tag in VOID_ELEMENTS
+        self.out.append(_start_tag(tag, self._attributes(tag, attrs), void))
+
+        if tag == "head" and not self.seen_head:
+            self.seen_head = True
+            self.out.append(self.stylesheet)
+
+        if not void:
+            self.open.append(tag)
+            self.open_count[tag] += 1
+            if tag in _PRESERVE_WHITESPACE:
+                self.preserve_whitespace += 1
+        return void
+
+    def _pop_to(self, tag):
+        if not self.open_count[tag]:
+            return
+        while self.open:
+            name = self.open.pop()
+            self.open_count[name] -= 1
+            if name in _PRESERVE_WHITESPACE:
+                self.preserve_whitespace -= 1
+            self.out.append(f"</{name}>")
+            if name == tag:
+                return
+
+    def handle_starttag(self, tag, attrs):
+        if self._start(tag, attrs):
+            self.closed_void.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if not self._start(tag, attrs):
+            self._flush()
+            self._pop_to(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.closed_void:
+            self.closed_void.remove(tag)
+            return
+        self._flush()
+        self._pop_to(tag)
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_charref(self, name):
+        self.text.append(_charref(name))
+
+    def handle_entityref(self, name):
+        self.text.append(_ENTITIES.get(name, "&" + name))
+
+    def handle_comment(self, data):
+        self._special("<!--", data, "-->")
+
+    def handle_decl(self, decl):
+        self._special("<!DOCTYPE ", decl[len("DOCTYPE ") :], ">\n")
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA["):
+            self._special("<![CDATA[", data[len("CDATA[") :], "]]>")
+        else:
+            self._special("<?", data, "?>")
+
+    def handle_pi(self, data):
+        self._special("<?", data, ">")
+
+    def close(self):
+        super().close()
+        self._flush()
+        while self.open:
+            self.out.append(f"</{self.open.pop()}>")
+        if not self.seen_head:
+            self.out.insert(0, "<head>" + self.stylesheet + "</head>")
+
+
+def rewrite_html(html_document, content_url, make_static_url):
+    """Rewrite input HTML to make it more privacy friendly
+
+    Links open in a new window, images are loaded lazily, images attached to
+    the email are loaded from `content_url` and our stylesheet is added.
+    """
+    stylesheet = _start_tag(
+        "link", {"href": make_static_url("dist/main.css"), "rel": "stylesheet"}, True
+    )
+    rewriter = _Rewriter(content_url, stylesheet)
+    rewriter.feed(html_document)
+    rewriter.close()
+    return "".join(rewriter.out)
+
+
+# text that bleach leaves alone apart from adding links
+_PLAIN_TEXT = re.compile(r"[^<>&\r\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f]*")
+
+
+def linkify_text(text):
+    """Sanitise a plain text body and turn URLs in it into links
+
+    The result is the same as `bleach.linkify(bleach.clean(text, strip=True))`.
+    Text without any markup or entities, which is most of it, is linkified
+    with one pass of bleach's URL pattern instead of parsing it twice.
+    """
+    import bleach
+
+    if _PLAIN_TEXT.fullmatch(text) is None:
+        return bleach.linkify(bleach.clean(text, strip=True))
+
+    from bleach.linkifier import PROTO_RE, URL_RE
+
+    parts = []
+    end = 0
+    for match in URL_RE.finditer(text):
+        parts.append(text[end : match.start()])
+        url, prefix, suffix = _strip_non_url_bits(match.group(0))
+        href = url if PROTO_RE.search(url) else "http://" + url
+        rel = "" if href.startswith("mailto:") else ' rel="nofollow"'
+        parts.append(f'{prefix}<a href="{href}"{rel}>{url}</a>{suffix}')
+        end = match.end()
+    parts.append(text[end:])
+    return "".join(parts)
+
+
+def _strip_non_url_bits(fragment):
+    """Split parentheses and punctuation the URL pattern matched too eagerly
+
+    Works like `bleach.linkifier.LinkifyFilter.strip_non_url_bits`.
+    """
+    prefix = suffix = ""
+    while fragment:
+        if fragment.startswith("("):
+            prefix = prefix + "("
+            fragment = fragment[1:]
+            if fragment.endswith(")"):
+                suffix = ")" + suffix
+                fragment = fragment[:-1]
+        elif fragment.endswith(")") and "(" not in fragment:
+            suffix = ")" + suffix
+            fragment = fragment[:-1]
+        elif fragment[-1] in ",.":
+            suffix = fragment[-1] + suffix
+            fragment = fragment[:-1]
+        else:
+            break
+    return fragment, prefix, suffix
@@ -0,0 +1,221 @@
+import html
+import re
+
+from tornado.ioloop import IOLoop
+
+from . import utils
+from .services import MailboxListener
+
+
+_TOKEN = re.compile(r"\w+")
+_TAG = re.compile(r"<[^>]*>")
+
+# Bound the memory used per message: tokens longer than this are truncated
+# and only this many distinct tokens of a message are indexed. Subject and
+# sender are tokenised first so they always make it into the index.
+MAX_TOKEN_LENGTH = 64
+MAX_TOKENS_PER_MESSAGE = 2000
+
+
+def tokenize(text):
+    """Split text into lower case search tokens"""
+    return [t[:MAX_TOKEN_LENGTH] for t in _TOKEN.findall(text.lower())]
+
+
+def message_tokens(subject, sender, body):
+    """Distinct tokens of a message, at most `MAX_TOKENS_PER_MESSAGE`"""
+    tokens = {}
+    for text in (subject, sender, body):
+        for token in tokenize(text or ""):
+            tokens[token] = None
+            if len(tokens) >= MAX_TOKENS_PER_MESSAGE:
+                return tuple(tokens)
+    return tuple(tokens)
+
+
+def _plain_text(message):
+    content = utils.body_text(message)
+    if message.get_body(preferencelist=("plain",)) is None:
+        # the body is HTML
+        content = html.unescape(_TAG.sub(" ", content))
+    return content
+
+
+def _scan_mailbox(address, mailboxes, known):
+    """Tokens of all messages of the mailbox whose IDs are not in `known`
+
+    Blocks on reading and parsing the messages, run it in an executor.
+    Returns None if the mailbox doesn't exist.
+    """
+    if not mailboxes.exists(address):
+        return None
+
+    mbox = mailboxes.mbox(address)
+    documents = []
+    for message_id in mbox.keys():
+        if message_id in known:
+            continue
+        try:
+            message = mbox[message_id]
+        except KeyError:
+            # removed since we listed the mailbox
+            continue
+        tokens = message_tokens(
+            message["subject"], message["from"], _plain_text(message)
+        )
+        documents.append((message_id, tokens))
+    return documents
+
+
+class _Scan:
+    """Changes to a mailbox made while it is indexed in the background"""
+
+    def __init__(self):
+        self.removed = set()
+        self.imported = False
+
+
+class _MailboxIndex:
+    def __init__(self):
+        # token -> message IDs containing it
+        self.postings = {}
+        # message ID -> tokens, needed to prune postings on removal
+        self.documents = {}
+        # set once all messages already on disk have been indexed
+        self.complete = False
+
+    def add(self, message_id, tokens):
+        if message_id in self.documents:
+            return
+        self.documents[message_id] = tokens
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(message_id)
+
+    def remove(self, message_id):
+        tokens = self.documents.pop(message_id, ())
+        for token in tokens:
+            ids = self.postings.get(token)
+            if ids is None:
+                continue
+            ids.discard(message_id)
+            if not ids:
+                del self.postings[token]
+
+    def search(self, tokens):
+        matches = []
+        for token in tokens:
+            ids = self.postings.get(token)
+            if not ids:
+                return set()
+            matches.append(ids)
+        matches.sort(key=len)
+
+        result = set(matches[0])
+        for ids in matches[1:]:
+            result &= ids
+            if not result:
+                break
+        return result
+
+
+class SearchIndex(MailboxListener):
+    """In-memory inverted index of subject, sender and body of each message
+
+    The index is updated as messages are delivered and removed. Mailboxes
+    that already contained email when the server started are indexed the
+    first time they are searched.
+    """
+
+    def __init__(self):
+        self._mailboxes = {}
+        # mailbox key -> background scans currently running for it
+        self._scans = {}
+
+    def __len__(self):
+        return sum(len(m.documents) for m in self._mailboxes.values())
+
+    def add_document(self, key, message_id, subject, sender, body):
+        index = self._mailboxes.get(key)
+        if index is None:
+            index = self._mailboxes[key] = _MailboxIndex()
+        index.add(message_id, message_tokens(subject, sender, body))
+
+    def message_added(self, address, message_id, message):
+        self.add_document(
+            utils.address_key(address),
+            message_id,
+            message["subject"],
+            message["from"],
+            _plain_text(message),
+        )
+
+    def messages_removed(self, key, message_ids):
+        for scan in self._scans.get(key, ()):
+            scan.removed.update(message_ids)
+
+        index = self._mailboxes.get(key)
+        if index is None:
+            return
+
+        for message_id in message_ids:
+            index.remove(message_id)
+
+        if not index.documents:
+            del self._mailboxes[key]
+
+    def messages_imported(self, key, message_ids):
+        # index them the next time the mailbox is searched
+        for scan in self._scans.get(key, ()):
+            scan.imported = True
+
+        index = self._mailboxes.get(key)
+        if index is not None:
+            index.complete = False
+
+    async def ensure_indexed(self, address, mailboxes):
+        """Index all messages of the mailbox that we do not know about yet
+
+        Only messages missing from the index are read and parsed, in an
+        executor so that large mailboxes don't block the IOLoop.
+        """
+        key = utils.address_key(address)
+        index = self._mailboxes.get(key)
+        if index is not None and index.complete:
+            return
+
+        known = frozenset(index.documents) if index is not None else frozenset()
+        scan = _Scan()
+        self._scans.setdefault(key, []).append(scan)
+        try:
+            documents = await IOLoop.current().run_in_executor(
+                None, _scan_mailbox, address, mailboxes, known
+            )
+        finally:
+            self._scans[key].remove(scan)
+            if not self._scans[key]:
+                del self._scans[key]
+
+        if documents is None:
+            return
+
+        # the index may have been dropped while scanning if the mailbox was
+        # emptied, messages delivered meanwhile are already in it
+        index = self._mailboxes.get(key)
+        if index is None:
+            index = self._mailboxes[key] = _MailboxIndex()
+        for message_id, tokens in documents:
+            if message_id not in scan.removed:
+                index.add(message_id, tokens)
+
+        if not index.documents:
+            del self._mailboxes[key]
+        elif not scan.imported:
+            index.complete = True
+
+    def search(self, key, query):
+        """IDs of messages in mailbox `key` that contain all words of query"""
+        index = self._mailboxes.get(key)
+        tokens = set(tokenize(query))
+        if index is None or not tokens:
+            return []
+        return sorted(index.search(tokens))
@@ -1,8 +1,11 @@
+import asyncio
 import email
 import email.policy
 import html
 import mailbox
 import os
+import shutil
+import uuid
 
 from email.message import EmailMessage
 from email.utils import parsedate_to_datetime
@@ -10,15 +13,396 @@ from email.utils import parsedate_to_datetime
 from . import utils
 
 
+class MailboxListener:
+    """Base class for things that want to know when emails come and go
+
+    Messages are added one recipient address at a time. When they are removed
+    we only know the key of the mailbox (see `utils.address_key`) as the
+    address can not be recovered from what is stored on disk. The same goes
+    for messages imported from another server, for example when mailboxes
+    are moved between the nodes of a cluster.
+    """
+
+    def message_added(self, address, message_id, message):
+        pass
+
+    def messages_removed(self, key, message_ids):
+        pass
+
+    def messages_imported(self, key, message_ids):
+        pass
+
+
+def _walk_mailbox_dirs(path, fanout, level=0):
+    """Generate (key, path) for all mailboxes below the domain directory path"""
+    for entry in os.scandir(path):
+        if not entry.is_dir():
+            continue
+        if len(entry.name) == utils.KEY_LENGTH:
+            yield entry.name, entry.path
+        elif level < fanout:
+            yield from _walk_mailbox_dirs(entry.path, fanout, level + 1)
+
+
+def _message_ids(mail_dir):
+    """IDs of the messages in a Maildir, without parsing them"""
+    message_ids = []
+    for sub_dir in ("new", "cur"):
+        path = os.path.join(mail_dir, sub_dir)
+        if os.path.isdir(path):
+            message_ids.extend(
+                name.split(":", maxsplit=1)[0] for name in os.listdir(path)
+            )
+    return message_ids
+
+
+def _message_paths(mail_dir):
+    """(ID, path) of the messages in a Maildir, sorted by ID"""
+    paths = []
+    for sub_dir in ("new", "cur"):
+        path = os.path.join(mail_dir, sub_dir)
+        if not os.path.isdir(path):
+            continue
+        for name in os.listdir(path):
+            if name.startswith("."):
+                continue
+            # messages in cur/ have flags appended to their name
+            message_id = name.split(":", maxsplit=1)[0]
+            paths.append((message_id, os.path.join(path, name)))
+    return sorted(paths)
+
+
+def _remove_empty_maildir(mail_dir):
+    """Remove a Maildir without messages, returns whether it was removed
+
+    Deliveries write to tmp/ first, so once it is gone they fail instead of
+    adding a message to a mailbox that is about to disappear. If a message
+    arrived before that the mailbox is kept.
+    """
+    try:
+        os.rmdir(os.path.join(mail_dir, "tmp"))
+    except OSError:
+        return False
+
+    try:
+        for sub_dir in ("new", "cur"):
+            os.rmdir(os.path.join(mail_dir, sub_dir))
+        os.rmdir(mail_dir)
+    except OSError:
+        for sub_dir in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(mail_dir, sub_dir), exist_ok=True)
+        return False
+    return True
+
+
+def _date_string(message):
+    date = parsedate_to_datetime(message["date"])
+    if date.tzinfo is None:
+        date = date.isoformat() + "+00:00"
+    else:
+        date = date.isoformat()
+    return date
+
+
+def _header(message, name):
+    """Value of a header as plain `str`, `None` if the header is missing
+
+    The header objects of `email.policy.default` hold on to the parsed
+    header and are expensive to pickle, results of jobs should not contain
+    them.
+    """
+    value = message[name]
+    return None if value is None else str(value)
+
+
+def message_summary(message_id, message):
+    """Summary of a message as shown in the list of emails of a mailbox
+
+    Only the headers of message are used.
+    """
+    return {
+        "date": _date_string(message),
+        "id": message_id,
+        "from": message["from"],
+        "subject": message["subject"],
+    }
+
+
+def _merge_maildir(source, target):
+    """Move all messages from the Maildir at source to target"""
+    for sub_dir in ("new", "cur", "tmp"):
+        source_dir = os.path.join(source, sub_dir)
+        if not os.path.exists(source_dir):
+            continue
+        os.makedirs(os.path.join(target, sub_dir), exist_ok=True)
+        for name in os.listdir(source_dir):
+            os.rename(
+                os.path.join(source_dir, name), os.path.join(target, sub_dir, name)
+            )
+    shutil.rmtree(source)
+
+
+class SingleFlight:
+    """Share one computation between concurrent requests for the same thing
+
+    `Mailboxes` is created for each request, so one of these is kept for the
+    whole application instead. Results are shared between all callers and
+    must not be modified.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        # computations that were started and requests that joined one
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    async def run(self, key, func, *args):
+        """Return the result of `await func(*args)`
+
+        If a computation for key is already running its result is returned
+        instead of starting another one.
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            self.started += 1
+            future = asyncio.ensure_future(func(*args))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key))
+        else:
+            self.coalesced += 1
+
+        # one of the callers going away doesn't cancel it for the others
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "in_flight": len(self),
+        }
+
+
 class Mailboxes:
-    def __init__(self, base_maildir):
+    def __init__(self, base_maildir, fanout=0):
         # Path at which we can find all the domains we host
         self.base_maildir = base_maildir
+        # Number of directory levels mailboxes are nested in below their
+        # domain, zero is the original flat layout
+        self.fanout = fanout
 
     def mail_dir_for(self, address):
-        mail_dir = os.path.join(self.base_maildir, utils.adddress_to_path(address))
+        domain = address.partition("@")[2]
+        return self.mail_dir_for_key(
+            utils.domain_to_path(domain), utils.address_key(address)
+        )
+
+    def mail_dir_for_key(self, domain_path, key):
+        """Directory of the mailbox `key` in the domain directory domain_path"""
+        domain_dir = os.path.join(self.base_maildir, domain_path)
+        mail_dir = os.path.join(
+            domain_dir, *utils.key_to_shards(key, self.fanout), key
+        )
+
+        # mailboxes that haven't been migrated yet are still in the flat layout
+        if self.fanout and not os.path.exists(mail_dir):
+            flat_mail_dir = os.path.join(domain_dir, key)
+            if os.path.exists(flat_mail_dir):
+                return flat_mail_dir
+
         return mail_dir
 
+    @property
+    def trash_dir(self):
+        return os.path.join(self.base_maildir, ".trash")
+
+    def _move_to_trash(self, path):
+        """Atomically move path out of the way, returns its new location"""
+        trash_dir = os.path.join(self.trash_dir, uuid.uuid4().hex)
+        os.makedirs(trash_dir)
+        trashed = os.path.join(trash_dir, os.path.basename(path))
+        try:
+            os.rename(path, trashed)
+        except FileNotFoundError:
+            os.rmdir(trash_dir)
+            return None
+        return trashed
+
+    def trashed(self):
+        """Paths of everything in the trash, for example after a crash"""
+        if not os.path.exists(self.trash_dir):
+            return []
+        return [
+            os.path.join(self.trash_dir, trash_dir, name)
+            for trash_dir in os.listdir(self.trash_dir)
+            for name in os.listdir(os.path.join(self.trash_dir, trash_dir))
+        ]
+
+    def trash_mailbox(self, address):
+        """Move the mailbox of address to the trash
+
+        New email for address is delivered to a fresh mailbox right away. Use
+        `empty_trash` to delete the contents of the returned paths.
+        """
+        domain = address.partition("@")[2]
+        return self.trash_key(utils.domain_to_path(domain), utils.address_key(address))
+
+    def trash_key(self, domain_path, key):
+        """Move the mailbox `key` to the trash, see `trash_mailbox`"""
+        domain_dir = os.path.join(self.base_maildir, domain_path)
+        paths = [
+            os.path.join(domain_dir, *utils.key_to_shards(key, fanout), key)
+            for fanout in {self.fanout, 0}
+        ]
+        trashed = [self._move_to_trash(path) for path in paths]
+        return [path for path in trashed if path is not None]
+
+    def trash_domain(self, domain):
+        """Move all mailboxes of domain to the trash, see `trash_mailbox`"""
+        domain_dir = self.domain_dir(domain)
+        trashed = self._move_to_trash(domain_dir)
+        os.makedirs(domain_dir, exist_ok=True)
+        return [] if trashed is None else [trashed]
+
+    def empty_trash(self, trashed):
+        """Delete trashed mailboxes, returns the messages that were deleted
+
+        The result maps the key of each mailbox to a list of message IDs.
+        This reads and deletes lots of files, run it in a thread.
+        """
+        removed = {}
+        for path in trashed:
+            if os.path.isdir(os.path.join(path, "new")):
+                mail_dirs = [(os.path.basename(path), path)]
+            else:
+                mail_dirs = _walk_mailbox_dirs(path, self.fanout)
+
+            for key, mail_dir in mail_dirs:
+                removed.setdefault(key, []).extend(_message_ids(mail_dir))
+            # remove the directory created by `_move_to_trash` as well
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+        return removed
+
+    def domain_dir(self, domain):
+        return os.path.join(self.base_maildir, utils.domain_to_path(domain))
+
+    def mailbox_dirs(self, domain):
+        """Generate (key, path) for all mailboxes of a domain
+
+        Mailboxes in the flat layout and in the sharded layout are both
+        included so that this keeps working while a migration is underway.
+        """
+        domain_dir = self.domain_dir(domain)
+        if os.path.exists(domain_dir):
+            yield from _walk_mailbox_dirs(domain_dir, self.fanout)
+
+    def all_mailbox_dirs(self):
+        """Generate (domain path, key, path) for the mailboxes of all domains"""
+        with os.scandir(self.base_maildir) as entries:
+            domain_dirs = [
+                entry
+                for entry in entries
+                if len(entry.name) == utils.KEY_LENGTH and entry.is_dir()
+            ]
+        for entry in domain_dirs:
+            for key, mail_dir in _walk_mailbox_dirs(entry.path, self.fanout):
+                yield entry.name, key, mail_dir
+
+    def remove_messages(self, domain_path, key, message_ids):
+        """Delete message_ids from the mailbox `key`, and it once it is empty
+
+        Other messages, for example ones delivered after message_ids were
+        copied elsewhere, stay. Returns the IDs of the messages that were
+        deleted and the number of messages left.
+        """
+        mail_dir = self.mail_dir_for_key(domain_path, key)
+        message_ids = set(message_ids)
+
+        removed = []
+        for message_id, path in _message_paths(mail_dir):
+            if message_id not in message_ids:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed.append(message_id)
+
+        remaining = len(_message_ids(mail_dir))
+        if not remaining and not _remove_empty_maildir(mail_dir):
+            remaining = len(_message_ids(mail_dir))
+        return removed, remaining
+
+    def add_messages(self, domain_path, key, messages):
+        """Store messages in the mailbox `key` under their existing IDs
+
+        messages is an iterable of (message ID, modification time, bytes),
+        for example from `archive.read_zip`. Messages that are already in the
+        mailbox are skipped. Returns the IDs of the messages that were added.
+        """
+        mail_dir = self.mail_dir_for_key(domain_path, key)
+        os.makedirs(os.path.dirname(mail_dir), exist_ok=True)
+        # creates the new/, cur/ and tmp/ directories
+        mailbox.Maildir(mail_dir)
+        existing = set(_message_ids(mail_dir))
+
+        added = []
+        for message_id, mtime, data in messages:
+            if message_id.startswith(".") or os.sep in message_id:
+                raise ValueError(f"Invalid message ID {message_id!r}")
+            if message_id in existing:
+                continue
+
+            # write to tmp/ first so readers never see a partial message
+            tmp_path = os.path.join(mail_dir, "tmp", message_id)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            # keep the time the message was delivered at
+            os.utime(tmp_path, (mtime, mtime))
+            os.rename(tmp_path, os.path.join(mail_dir, "new", message_id))
+            existing.add(message_id)
+            added.append(message_id)
+        return added
+
+    def migrate(self, domain, limit=None):
+        """Move up to `limit` mailboxes of domain from the flat layout
+
+        Returns the number of mailboxes that were moved.
+        """
+        if not self.fanout:
+            return 0
+
+        domain_dir = self.domain_dir(domain)
+        moved = 0
+
+        # scandir() reads the directory lazily so a batch only costs as much
+        # as the number of entries it moves
+        with os.scandir(domain_dir) as entries:
+            keys = []
+            for entry in entries:
+                if limit is not None and len(keys) >= limit:
+                    break
+                if len(entry.name) == utils.KEY_LENGTH and entry.is_dir():
+                    keys.append(entry.name)
+
+        for key in keys:
+            source = os.path.join(domain_dir, key)
+            target = os.path.join(
+                domain_dir, *utils.key_to_shards(key, self.fanout), key
+            )
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            if os.path.exists(target):
+                _merge_maildir(source, target)
+            else:
+                os.rename(source, target)
+            moved += 1
+
+        return moved
+
     def exists(self, address):
         """Determine if a mailbox for address exists"""
         mail_dir = self.mail_dir_for(address)
@@ -33,6 +417,26 @@ class Mailboxes:
             ),
         )
 
+    def message_path(self, address, message_id):
+        """Path of the file message_id is stored in, without parsing it
+
+        Returns `None` if there is no such message.
+        """
+        if message_id.startswith("."):
+            return None
+
+        mail_dir = self.mail_dir_for(address)
+        # we deliver to new/ and never move messages, so look there first
+        path = os.path.join(mail_dir, "new", message_id)
+        if os.path.isfile(path):
+            return path
+
+        cur_dir = os.path.join(mail_dir, "cur")
+        if os.path.isdir(cur_dir):
+            for name in os.listdir(cur_dir):
+                if name.split(":", maxsplit=1)[0] == message_id:
+                    return os.path.join(cur_dir, name)
+
     def _get_email(self, address, message_id):
         mbox = self.mbox(address)
 
@@ -113,11 +517,11 @@ class Mailboxes:
         return {
             "richestBody": richest_body,
             "simplestBody": simplest_body,
-            "subject": message["subject"],
+            "subject": _header(message, "subject"),
             "date": date,
-            "from": message["from"],
-            "x-mailfrom": message["x-mailfrom"],
-            "headers": [(k, v) for k, v in message.items()],
+            "from": _header(message, "from"),
+            "x-mailfrom": _header(message, "x-mailfrom"),
+            "headers": [(k, str(v)) for k, v in message.items()],
         }
 
     def email_ids(self, address):
@@ -130,15 +534,18 @@ class Mailboxes:
         mbox = mailbox.Maildir(mail_dir)
         return list(sorted(mbox.keys()))
 
+    def message_paths(self, address):
+        """IDs and paths of all messages of address, without parsing them"""
+        return _message_paths(self.mail_dir_for(address))
+
+    def message_paths_for_key(self, domain_path, key):
+        return _message_paths(self.mail_dir_for_key(domain_path, key))
+
     def _date_string(self, message):
-        date = parsedate_to_datetime(message["date"])
-        if date.tzinfo is None:
-            date = date.isoformat() + "+00:00"
-        else:
-            date = date.isoformat()
-        return date
+        return _date_string(message)
 
-    def get_message_summaries(self, address):
+    def get_message_summaries(self, address, message_ids=None):
+        """Get summaries of all messages, or only those in message_ids"""
         mail_dir = self.mail_dir_for(address)
 
         if not os.path.exists(mail_dir):
@@ -148,13 +555,14 @@ class Mailboxes:
 
         mbox = self.mbox(address)
 
-        for key, msg in mbox.iteritems():
-            summary = {
-                "date": self._date_string(msg),
-                "id": key,
-                "from": msg["from"],
-                "subject": msg["subject"],
-            }
-            summaries[key] = summary
+        if message_ids is None:
+            messages = mbox.iteritems()
+        else:
+            messages = ((key, mbox.get(key)) for key in message_ids)
+
+        for key, msg in messages:
+            if msg is None:
+                continue
+            summaries[key] = message_summary(key, msg)
 
         return summaries
@@ -0,0 +1,419 @@
+import asyncio
+import email.parser
+import email.policy
+import json
+import os
+
+from functools import partial
+
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+
+from . import utils
+from .services import MailboxListener, message_summary
+from .startup import Background
+
+
+# bump when the format of the snapshot or the journal changes
+_FORMAT_VERSION = 1
+
+_header_parser = email.parser.BytesParser(policy=email.policy.default)
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _metadata(message_id, message, size, max_age):
+    """What the snapshot keeps about a message, only its headers are used"""
+    try:
+        summary = message_summary(message_id, message)
+    except (TypeError, ValueError):
+        # no or an invalid Date header, it is summarised when it is listed
+        summary = None
+    else:
+        summary = {
+            "date": summary["date"],
+            "from": _text(summary["from"]),
+            "subject": _text(summary["subject"]),
+        }
+
+    expires = None
+    if max_age is not None:
+        expires = int(message_id.partition(".")[0]) + max_age
+
+    return {"summary": summary, "size": size, "expires": expires}
+
+
+def _apply(mailboxes, change):
+    """Apply a change recorded in the journal to the state in mailboxes
+
+    Applying the same change twice has the same effect as applying it once.
+    """
+    key = change["key"]
+    if change["op"] == "add":
+        mailbox = mailboxes.setdefault(
+            key, {"domain": change["domain"], "messages": {}}
+        )
+        mailbox["messages"][change["id"]] = change["meta"]
+
+    elif change["op"] == "remove":
+        mailbox = mailboxes.get(key)
+        if mailbox is None:
+            return
+        for message_id in change["ids"]:
+            mailbox["messages"].pop(message_id, None)
+        if not mailbox["messages"]:
+            del mailboxes[key]
+
+    elif change["op"] == "forget":
+        mailboxes.pop(key, None)
+
+
+def _copy(mailboxes):
+    """Copy of the state that changes to mailboxes don't affect
+
+    Metadata is never modified once recorded, it is shared.
+    """
+    return {
+        key: {"domain": mailbox["domain"], "messages": dict(mailbox["messages"])}
+        for key, mailbox in mailboxes.items()
+    }
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Snapshot(MailboxListener):
+    """Metadata of the stored messages that is kept across restarts
+
+    For each message its summary (see `services.message_summary`), size and
+    the time it expires at are kept, grouped by mailbox. The state at one
+    point in time is stored in `snapshot.json` and the changes since then are
+    appended to `journal.jsonl`, one JSON object per line. After a crash the
+    last line of the journal may be incomplete, it is skipped. Once the
+    journal has `compact_after` lines a copy of the current state is written
+    to a new snapshot in a thread, it atomically replaces the old one. Then
+    the journal is replaced by one with only the changes made since the copy
+    was taken. Replaying changes that are already in the snapshot does no
+    harm so a crash between these two steps loses nothing.
+
+    The Maildir remains the source of truth. `load` the snapshot in a
+    thread, `restore` it on the IOLoop and then `verify` it against what is
+    stored. Until it has been restored changes are only kept in memory.
+    """
+
+    compact_after = 10_000
+
+    def __init__(self, mailboxes, domains):
+        self.mailboxes = mailboxes
+        self.domains = domains
+        self.path = os.path.join(mailboxes.base_maildir, ".snapshot")
+        self.loaded = False
+
+        # key -> {"domain": domain, "messages": {message ID: metadata}}
+        self._mailboxes = {}
+        self._journal = None
+        self._journal_lines = 0
+        # changes made while a new snapshot is written, they go in the new
+        # journal that replaces the current one
+        self._compacting = None
+        self._since_compaction = []
+        # changes made before the snapshot was restored
+        self._pending = []
+        # messages removed while the snapshot is being verified
+        self._verifying = 0
+        self._removed = set()
+
+    @property
+    def snapshot_file(self):
+        return os.path.join(self.path, "snapshot.json")
+
+    @property
+    def journal_file(self):
+        return os.path.join(self.path, "journal.jsonl")
+
+    def __len__(self):
+        return sum(len(mailbox["messages"]) for mailbox in self._mailboxes.values())
+
+    def load(self):
+        """Read the snapshot and replay the journal on top of it
+
+        This only reads from disk and is safe to run in a thread, pass the
+        result to `restore` on the IOLoop.
+        """
+        mailboxes = {}
+        try:
+            with open(self.snapshot_file, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") == _FORMAT_VERSION:
+                mailboxes = snapshot["mailboxes"]
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            app_log.warning(f"Ignoring corrupt snapshot {self.snapshot_file}")
+
+        lines = 0
+        try:
+            with open(self.journal_file, encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        _apply(mailboxes, json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        # the last line is incomplete after a crash
+                        continue
+        except FileNotFoundError:
+            pass
+
+        return mailboxes, lines
+
+    def restore(self, loaded):
+        """Start using the state returned by `load`"""
+        mailboxes, self._journal_lines = loaded
+        for change in self._pending:
+            _apply(mailboxes, change)
+        self._mailboxes = mailboxes
+
+        os.makedirs(self.path, exist_ok=True)
+        self._journal = open(self.journal_file, "a+", encoding="utf-8")
+        # don't append to an incomplete last line
+        if self._journal.tell():
+            self._journal.seek(self._journal.tell() - 1)
+            if self._journal.read(1) != "\n":
+                self._journal.write("\n")
+
+        pending, self._pending = self._pending, []
+        for change in pending:
+            self._write(change)
+        self.loaded = True
+
+    def compact(self):
+        """Write the current state to a new snapshot and empty the journal
+
+        Returns a future that resolves once done, if this is already being
+        done the future of that is returned.
+        """
+        if self._compacting is None:
+            self._since_compaction = []
+            self._compacting = asyncio.ensure_future(
+                self._compact(_copy(self._mailboxes))
+            )
+        return self._compacting
+
+    async def _compact(self, state):
+        try:
+            await IOLoop.current().run_in_executor(None, self._write_snapshot, state)
+        except Exception:
+            app_log.exception(f"Failed to write snapshot {self.snapshot_file}")
+            # try again once the journal grew as much again
+            self._journal_lines = 0
+            return
+        finally:
+            self._compacting = None
+            since, self._since_compaction = self._since_compaction, []
+
+        tmp_file = self.journal_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(change) + "\n" for change in since)
+        os.replace(tmp_file, self.journal_file)
+        self._journal.close()
+        self._journal = open(self.journal_file, "a", encoding="utf-8")
+        self._journal_lines = len(since)
+
+    def _write_snapshot(self, state):
+        """Atomically replace the snapshot with state, blocks on fsync"""
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"version": _FORMAT_VERSION, "mailboxes": state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        _fsync_dir(self.path)
+
+    def _record(self, change):
+        _apply(self._mailboxes, change)
+        if self._journal is None:
+            self._pending.append(change)
+        else:
+            self._write(change)
+
+    def _write(self, change):
+        self._journal.write(json.dumps(change) + "\n")
+        self._journal.flush()
+        self._journal_lines += 1
+        if self._compacting is not None:
+            self._since_compaction.append(change)
+        elif self._journal_lines >= self.compact_after:
+            self.compact()
+
+    def _max_age(self, domain):
+        return self.domains.get(domain, {}).get("max_email_age")
+
+    def message_added(self, address, message_id, message):
+        domain = address.rpartition("@")[2]
+        path = os.path.join(self.mailboxes.mail_dir_for(address), "new", message_id)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return
+
+        self._record(
+            {
+                "op": "add",
+                "key": utils.address_key(address),
+                "domain": domain,
+                "id": message_id,
+                "meta": _metadata(message_id, message, size, self._max_age(domain)),
+            }
+        )
+
+    def messages_removed(self, key, message_ids):
+        if self._verifying:
+            self._removed.update(message_ids)
+
+        # before the snapshot is restored we don't know what is in it
+        if self.loaded:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None:
+                return
+            message_ids = [i for i in message_ids if i in mailbox["messages"]]
+            if not message_ids:
+                return
+
+        self._record({"op": "remove", "key": key, "ids": list(message_ids)})
+
+    def messages_imported(self, key, message_ids):
+        # we don't know the domain of the mailbox or what the messages are
+        # about, fall back to reading them from disk
+        self._record({"op": "forget", "key": key})
+
+    def summaries(self, address, message_ids):
+        """Summaries of those of message_ids that the snapshot knows about"""
+        mailbox = self._mailboxes.get(utils.address_key(address))
+        if mailbox is None:
+            return {}
+
+        summaries = {}
+        for message_id in message_ids:
+            metadata = mailbox["messages"].get(message_id)
+            if metadata is not None and metadata["summary"] is not None:
+                summaries[message_id] = dict(metadata["summary"], id=message_id)
+        return summaries
+
+    def next_expiry(self, domain):
+        """Earliest time a message of domain expires at, `None` if there is none"""
+        return min(
+            (
+                metadata["expires"]
+                for mailbox in self._mailboxes.values()
+                if mailbox["domain"] == domain
+                for metadata in mailbox["messages"].values()
+                if metadata["expires"] is not None
+            ),
+            default=None,
+        )
+
+    def known_ids(self, domain):
+        """IDs of the messages of each mailbox of domain in the snapshot"""
+        return {
+            key: set(mailbox["messages"])
+            for key, mailbox in self._mailboxes.items()
+            if mailbox["domain"] == domain
+        }
+
+    def scan_domain(self, domain, known):
+        """Find the messages of domain that are stored
+
+        Messages that aren't in known, see `known_ids`, are read to find out
+        their metadata, for all others it is `None`. This only reads from disk
+        and is safe to run in a thread, pass the result to `reconcile` on the
+        IOLoop.
+        """
+        domain_path = utils.domain_to_path(domain)
+        max_age = self._max_age(domain)
+
+        found = {}
+        for key, _ in self.mailboxes.mailbox_dirs(domain):
+            known_ids = known.get(key, ())
+            messages = found.setdefault(key, {})
+            try:
+                paths = self.mailboxes.message_paths_for_key(domain_path, key)
+            except FileNotFoundError:
+                continue
+
+            for message_id, path in paths:
+                if message_id in known_ids:
+                    messages[message_id] = None
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        message = _header_parser.parse(f, headersonly=True)
+                        size = os.fstat(f.fileno()).st_size
+                except FileNotFoundError:
+                    continue
+                messages[message_id] = _metadata(message_id, message, size, max_age)
+
+        return {"domain": domain, "mailboxes": found}
+
+    def reconcile(self, known, found):
+        """Bring the snapshot in line with what `scan_domain` found"""
+        domain = found["domain"]
+        stored = found["mailboxes"]
+
+        for key, message_ids in known.items():
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None:
+                continue
+            missing = [
+                message_id
+                for message_id in message_ids
+                if message_id not in stored.get(key, {})
+                and message_id in mailbox["messages"]
+            ]
+            if missing:
+                self._record({"op": "remove", "key": key, "ids": missing})
+
+        for key, messages in stored.items():
+            for message_id, metadata in messages.items():
+                if metadata is None or message_id in self._removed:
+                    continue
+                mailbox = self._mailboxes.get(key)
+                if mailbox is not None and message_id in mailbox["messages"]:
+                    continue
+                self._record(
+                    {
+                        "op": "add",
+                        "key": key,
+                        "domain": domain,
+                        "id": message_id,
+                        "meta": metadata,
+                    }
+                )
+
+    def verify(self):
+        """Check the snapshot against the Maildir of all domains in parallel"""
+        for domain in self.domains:
+            known = self.known_ids(domain)
+            self._verifying += 1
+            IOLoop.current().add_future(
+                Background(
+                    f"verify snapshot of {domain}",
+                    partial(self.scan_domain, domain, known),
+                ).start(),
+                partial(self._verified, known),
+            )
+
+    def _verified(self, known, future):
+        self._verifying -= 1
+        try:
+            self.reconcile(known, future.result())
+        finally:
+            if not self._verifying:
+                self._removed.clear()
+                self.compact()
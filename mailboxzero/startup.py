@@ -0,0 +1,115 @@
+"""Keep startup fast by doing expensive work lazily or in the background
+
+Only the standard library may be imported here as this module is imported
+before everything else to measure how long the other imports take.
+"""
+import asyncio
+import importlib
+import threading
+import time
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+class StartupProfile:
+    """Record how long each component takes to import and initialise"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = []
+        self.marks = []
+        self.background = []
+        self._lock = threading.Lock()
+
+    def mark(self, event):
+        """Record that event happened, relative to when we started"""
+        self.marks.append((event, time.perf_counter() - self.started))
+
+    @contextmanager
+    def measure(self, component, background=False):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.timings.append(
+                    (component, time.perf_counter() - start, background)
+                )
+
+    def report(self):
+        """Human readable summary of the timings"""
+        lines = ["Startup profile:"]
+        for component, duration, background in self.timings:
+            where = " (background)" if background else ""
+            lines.append(f"  {1000 * duration:8.1f}ms  {component}{where}")
+        for event, since_start in self.marks:
+            lines.append(f"  {1000 * since_start:8.1f}ms  until {event}")
+        return "\n".join(lines)
+
+    async def background_done(self):
+        """Wait for all work started in the background to finish"""
+        await asyncio.gather(
+            *(asyncio.wrap_future(f) for f in self.background),
+            return_exceptions=True,
+        )
+
+
+profile = StartupProfile()
+
+
+class Background:
+    """Compute a value in a thread the first time it is asked for
+
+    Calling `start()` early means the value is usually ready by the time it
+    is needed.
+    """
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self._future = None
+        self._lock = threading.Lock()
+
+    def _run(self, future):
+        try:
+            with profile.measure(self.name, background=True):
+                result = self.func()
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def start(self):
+        with self._lock:
+            if self._future is None:
+                self._future = Future()
+                threading.Thread(
+                    target=self._run, args=(self._future,), daemon=True
+                ).start()
+                profile.background.append(self._future)
+        return self._future
+
+    def done(self):
+        return self._future is not None and self._future.done()
+
+    def result(self):
+        """Wait for the value, blocking the calling thread"""
+        return self.start().result()
+
+    async def get(self):
+        """Wait for the value without blocking the event loop"""
+        return await asyncio.wrap_future(self.start())
+
+
+def import_module(name):
+    with profile.measure(f"import {name}", background=True):
+        return importlib.import_module(name)
+
+
+def preload(*names):
+    """Import modules in a background thread"""
+    return Background(
+        "preload " + ", ".join(names),
+        lambda: [import_module(name) for name in names],
+    ).start()
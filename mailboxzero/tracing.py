@@ -0,0 +1,122 @@
+"""Span-style tracing of messages through the delivery pipeline
+
+Each SMTP session and each message gets a trace ID. The ID of a message is
+stored in the `X-MailboxZero-Trace-Id` header so that HTTP requests that
+read the message later can be added to its trace.
+"""
+import json
+import os
+import re
+import time
+
+from contextlib import contextmanager
+
+
+TRACE_HEADER = "X-MailboxZero-Trace-Id"
+
+_TRACE_HEADER_LINE = re.compile(
+    rb"^" + TRACE_HEADER.encode() + rb":\s*([0-9a-f]+)",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def new_id(size=16):
+    return os.urandom(size).hex()
+
+
+def read_trace_id(path, limit=64 * 1024):
+    """Trace ID stored in the headers of a message, without parsing it"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(limit)
+    except FileNotFoundError:
+        return None
+
+    headers = head.split(b"\n\n", maxsplit=1)[0]
+    match = _TRACE_HEADER_LINE.search(headers)
+    if match:
+        return match.group(1).decode()
+
+
+class JSONLinesExporter:
+    """Append each span as a line of JSON to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+
+    def export(self, span):
+        self._file.write(json.dumps(span) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """Record spans for a sample of traces
+
+    Whether a trace is sampled only depends on its ID, so spans recorded
+    for the same trace at different times (delivery and later reads) are
+    either all kept or all dropped. Without an exporter nothing is recorded.
+    """
+
+    def __init__(self, exporter=None, sample_rate=1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def sampled(self, trace_id):
+        if not self.enabled or not trace_id:
+            return False
+        return int(trace_id[:8], 16) < self.sample_rate * 2**32
+
+    def record(self, span, start, duration):
+        """Export a span that started at `start` and took `duration` seconds"""
+        if not self.sampled(span.trace_id):
+            return
+
+        self.exporter.export(
+            {
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "name": span.name,
+                "start": start,
+                "duration_ms": 1000 * duration,
+                "attributes": span.attributes,
+            }
+        )
+
+    @contextmanager
+    def span(self, name, trace_id, parent=None, **attributes):
+        """Measure the duration of the block as a span of trace_id"""
+        span = Span(
+            name,
+            trace_id,
+            parent_id=parent.span_id if parent is not None else None,
+            attributes=attributes,
+        )
+        start = time.time()
+        perf_start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            self.record(span, start, time.perf_counter() - perf_start)
@@ -1,24 +1,61 @@
 import hashlib
 import os
 
-from bs4 import BeautifulSoup
-
 
 def domain_to_path(domain):
     return hashlib.sha1(domain.lower().strip().encode()).hexdigest()
 
 
-def adddress_to_path(address):
+def address_key(address):
+    """Name of the directory the mailbox for address is stored in"""
+    return hashlib.sha1(address.lower().strip().encode()).hexdigest()
+
+
+# length of the keys returned by `address_key` and `domain_to_path`
+KEY_LENGTH = 40
+
+
+def key_to_shards(key, fanout=0):
+    """Names of the `fanout` levels of directories a mailbox is nested in
+
+    With a fanout of two the mailbox with key "3a8f..." is stored in
+    "3a/8f/3a8f...".
+    """
+    return [key[2 * level : 2 * level + 2] for level in range(fanout)]
+
+
+def key_in_range(key, start, end=None):
+    """Whether key is in [start, end), an empty end means no upper bound
+
+    Keys are hex digests of the same length so comparing them as strings
+    orders them by their value. start and end can be prefixes like "8".
+    """
+    return start <= key and (not end or key < end)
+
+
+def adddress_to_path(address, fanout=0):
     # XXX maybe remove the "plus" part of the local address?
     local, _, domain = address.partition("@")
-    return os.path.join(
-        domain_to_path(domain),
-        hashlib.sha1(address.lower().strip().encode()).hexdigest(),
-    )
+    key = address_key(address)
+    return os.path.join(domain_to_path(domain), *key_to_shards(key, fanout), key)
+
+
+def body_text(message):
+    """Plain text (or failing that HTML) body of a message"""
+    body = message.get_body(preferencelist=("plain", "html"))
+    if body is None:
+        return ""
+    try:
+        return body.get_content()
+    except (KeyError, LookupError):
+        return ""
 
 
 def rewrite_html(html_document, content_url, make_static_url):
     """Rewrite input HTML to make it more privacy friendly"""
+    # imported here as it takes a while and is only needed to display emails
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html_document, "html.parser")
 
     for node in soup.find_all(["a"]):
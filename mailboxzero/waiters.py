@@ -0,0 +1,147 @@
+import asyncio
+import re
+
+from collections import defaultdict
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+from . import utils
+from .services import MailboxListener
+
+
+# Filters run on the IOLoop for every delivered message, so patterns and the
+# text they are matched against are kept small enough to never stall it.
+MAX_PATTERN_LENGTH = 200
+MAX_VARIABLE_REPEATS = 2
+MAX_HEADER_LENGTH = 1000
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+_SINGLE_CHARACTER = {
+    sre_constants.LITERAL,
+    sre_constants.NOT_LITERAL,
+    sre_constants.ANY,
+    sre_constants.IN,
+}
+
+
+def _variable_repeats(parsed):
+    """Count repetitions of variable length in `parsed`
+
+    Raise `re.error` for constructs that can backtrack catastrophically:
+    repetitions of anything but a single character and backreferences.
+    """
+    count = 0
+    for op, av in parsed:
+        if op in _REPEATS:
+            low, high, item = av
+            if len(item) != 1 or item[0][0] not in _SINGLE_CHARACTER:
+                raise re.error("only single characters may be repeated")
+            if high != low:
+                count += 1
+        elif op == sre_constants.SUBPATTERN:
+            count += _variable_repeats(av[-1])
+        elif op == sre_constants.BRANCH:
+            count += sum(_variable_repeats(branch) for branch in av[1])
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            count += _variable_repeats(av[1])
+        elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            raise re.error("backreferences are not supported")
+    return count
+
+
+def compile_filter(pattern):
+    """Compile a user supplied regular expression to filter emails by
+
+    Only patterns that match in roughly linear time are accepted, anything
+    else raises `re.error` like an invalid pattern would.
+    """
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise re.error(f"longer than {MAX_PATTERN_LENGTH} characters")
+
+    if _variable_repeats(sre_parse.parse(pattern)) > MAX_VARIABLE_REPEATS:
+        raise re.error(f"more than {MAX_VARIABLE_REPEATS} variable repetitions")
+
+    return re.compile(pattern)
+
+
+def _header(message, name):
+    return str(message[name] or "")[:MAX_HEADER_LENGTH]
+
+
+class Waiter:
+    """A pending request for the next email matching a set of filters"""
+
+    def __init__(self, address, subject=None, sender=None, body=None):
+        self.address = address.lower()
+        self.subject = compile_filter(subject) if subject else None
+        self.sender = compile_filter(sender) if sender else None
+        self.body = body
+        self.future = asyncio.get_event_loop().create_future()
+
+    @property
+    def needs_body(self):
+        return self.body is not None
+
+    def matches(self, message, body_text=None):
+        """Check if `message` satisfies all filters of this waiter"""
+        if self.subject is not None:
+            if not self.subject.search(_header(message, "subject")):
+                return False
+
+        if self.sender is not None:
+            if not self.sender.search(_header(message, "from")):
+                return False
+
+        if self.body is not None:
+            if body_text is None or self.body not in body_text:
+                return False
+
+        return True
+
+
+class Waiters(MailboxListener):
+    """Registry of clients waiting for an email to arrive
+
+    Filters are evaluated once when a message is delivered instead of
+    rescanning the mailbox each time a client asks.
+    """
+
+    def __init__(self):
+        self._waiting = defaultdict(set)
+
+    def __len__(self):
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    def add(self, waiter):
+        self._waiting[waiter.address].add(waiter)
+        return waiter
+
+    def remove(self, waiter):
+        waiters = self._waiting.get(waiter.address)
+        if waiters is None:
+            return
+
+        waiters.discard(waiter)
+        if not waiters:
+            del self._waiting[waiter.address]
+
+    def message_added(self, address, message_id, message):
+        """Resolve all waiters for `address` that match `message`"""
+        waiters = self._waiting.get(address.lower())
+        if not waiters:
+            return
+
+        body_text = None
+        if any(w.needs_body for w in waiters):
+            body_text = utils.body_text(message)
+
+        for waiter in list(waiters):
+            if waiter.future.done():
+                continue
+            if waiter.matches(message, body_text):
+                waiter.future.set_result(message_id)
+                self.remove(waiter)
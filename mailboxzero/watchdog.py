@@ -0,0 +1,150 @@
+"""Find out what blocks the event loop
+
+A heartbeat is scheduled on the event loop and a thread checks that it runs
+on time. When it is late by more than a threshold the thread takes a sample
+of the stack of the event loop's thread, which tells us which handler or
+callback is blocking it.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+from collections import defaultdict, deque
+
+from tornado.log import app_log
+
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# every callback run by the event loop is called from this function
+_HANDLE_RUN_CODE = asyncio.events.Handle._run.__code__
+
+
+def _name(code):
+    # co_qualname includes the class, it only exists from Python 3.11 onwards
+    return getattr(code, "co_qualname", code.co_name)
+
+
+def blocking_label(frame):
+    """Name of the handler or callback that frame is part of
+
+    This is the outermost function of mailboxzero on the stack, for example
+    `ViewEMailHandler.get`, or else the callback the event loop is running.
+    """
+    label = None
+    callback = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename.startswith(_PACKAGE_DIR):
+            label = _name(code)
+        if frame.f_back is not None and frame.f_back.f_code is _HANDLE_RUN_CODE:
+            callback = _name(code)
+        frame = frame.f_back
+    return label or callback or "unknown"
+
+
+class Watchdog:
+    """Record stalls of the event loop longer than threshold seconds"""
+
+    # number of stalls, with their stack, kept to be looked at later
+    max_recent = 50
+    # number of frames of each stack that are kept
+    stack_limit = 30
+
+    def __init__(self, threshold=0.1):
+        self.threshold = threshold
+        self.recent = deque(maxlen=self.max_recent)
+        self.by_label = defaultdict(lambda: {"count": 0, "total": 0.0, "max": 0.0})
+        self.stalls = 0
+
+        self._loop = None
+        self._thread_id = None
+        self._beat_due = None
+        # (when the beat was due, label, stack) sampled during a stall
+        self._sample = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start watching the event loop of the calling thread"""
+        self._loop = asyncio.get_event_loop()
+        self._thread_id = threading.get_ident()
+        self._schedule_beat()
+        threading.Thread(target=self._watch, name="watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _schedule_beat(self):
+        self._beat_due = time.monotonic() + self.threshold
+        self._loop.call_later(self.threshold, self._beat)
+
+    def _beat(self):
+        if self._stopped.is_set():
+            return
+
+        due = self._beat_due
+        late = time.monotonic() - due
+        if late > self.threshold:
+            sample = self._sample
+            if sample is not None and sample[0] == due:
+                _, label, stack = sample
+            else:
+                # the thread didn't get to take a sample in time
+                label, stack = "unknown", ""
+            self._record(late, label, stack)
+        self._schedule_beat()
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 4):
+            if self._loop.is_closed():
+                return
+
+            due = self._beat_due
+            if time.monotonic() - due < self.threshold:
+                continue
+            if self._sample is not None and self._sample[0] == due:
+                # already sampled this stall
+                continue
+
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=self.stack_limit))
+            self._sample = (due, blocking_label(frame), stack)
+
+    def _record(self, duration, label, stack):
+        self.stalls += 1
+        stats = self.by_label[label]
+        stats["count"] += 1
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration)
+        self.recent.append(
+            {
+                "time": time.time() - duration,
+                "duration_ms": 1000 * duration,
+                "label": label,
+                "stack": stack,
+            }
+        )
+        app_log.warning(
+            f"Event loop blocked for {1000 * duration:.0f}ms by {label}\n{stack}"
+        )
+
+    def stats(self):
+        return {
+            "threshold_ms": 1000 * self.threshold,
+            "stalls": self.stalls,
+            "by_label": {
+                label: {
+                    "count": stats["count"],
+                    "total_ms": 1000 * stats["total"],
+                    "max_ms": 1000 * stats["max"],
+                }
+                for label, stats in sorted(
+                    self.by_label.items(), key=lambda item: -item[1]["total"]
+                )
+            },
+            "recent": list(self.recent),
+        }
@@ -0,0 +1,103 @@
+"""Parse and render large emails in a pool of processes
+
+Parsing MIME and rewriting HTML holds the GIL, while one large newsletter is
+being processed no other request is served. The jobs in here are plain
+functions that take and return builtin types, so that they can run in
+another process. Small emails are processed inline as sending them to
+another process costs more than processing them.
+"""
+import asyncio
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from . import rewrite
+from . import services
+
+
+def render_email(base_maildir, fanout, address, message_id, content_url, css_url):
+    """Subject, HTML body and attachments to display message_id"""
+    mailboxes = services.Mailboxes(base_maildir, fanout=fanout)
+    message = mailboxes.get_message(address, message_id)
+    attachments = mailboxes.get_attachment_summaries(address, message_id)
+
+    if message["richestBody"]["content-type"] == "text/html":
+        message_html = rewrite.rewrite_html(
+            message["richestBody"]["content"],
+            content_url,
+            make_static_url=lambda path: css_url,
+        )
+
+    else:
+        message_html = rewrite.linkify_text(message["richestBody"]["content"])
+
+    return {
+        "subject": message["subject"],
+        "html": message_html,
+        "attachments": attachments,
+    }
+
+
+def parse_email(base_maildir, fanout, address, message_id):
+    """The message as returned by `services.Mailboxes.get_message`"""
+    mailboxes = services.Mailboxes(base_maildir, fanout=fanout)
+    return mailboxes.get_message(address, message_id)
+
+
+def extract_content(base_maildir, fanout, address, message_id, content_id):
+    """Content type and content of the MIME part labelled with content_id
+
+    Returns `None` if there is no such part.
+    """
+    mailboxes = services.Mailboxes(base_maildir, fanout=fanout)
+    content = mailboxes.get_content(address, message_id, content_id)
+    if content is None:
+        return None
+    return content.get_content_type(), content.get_content()
+
+
+def _ready():
+    return os.getpid()
+
+
+class Workers:
+    """Run jobs on emails larger than threshold bytes in a pool of processes
+
+    Without processes all jobs run inline.
+    """
+
+    def __init__(self, processes=0, threshold=256 * 1024):
+        self.processes = processes
+        self.threshold = threshold
+        self.inline = 0
+        self.offloaded = 0
+
+        self._executor = None
+        if processes:
+            # forking a process with threads running, like the ones of the
+            # default executor, is not safe
+            self._executor = ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def start(self):
+        """Start all processes now instead of when the first job arrives"""
+        if self._executor is None:
+            return
+        for _ in range(self.processes):
+            self._executor.submit(_ready)
+
+    async def run(self, size, job, *args):
+        """Run job with args, in another process if size is above threshold"""
+        if self._executor is None or size < self.threshold:
+            self.inline += 1
+            return job(*args)
+
+        self.offloaded += 1
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, job, *args)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -32,6 +32,7 @@ setuptools.setup(
     entry_points={
         "console_scripts": [
             "mailboxzero = mailboxzero:main",
+            "mailboxzero-router = mailboxzero.cluster:main",
         ],
     },
 )
@@ -33,6 +33,12 @@ def _random_port():
     return port
 
 
+@pytest.fixture
+def random_port():
+    """Get more ports than `http_port` and `smtp_port` by calling this"""
+    return _random_port
+
+
 @pytest.fixture
 def http_port():
     return _random_port()
@@ -67,9 +73,29 @@ def web_app():
 
 
 @pytest.fixture
-def mailbox_server(request, event_loop, http_port, smtp_port):
+def admin_token():
+    return "secret-admin-token"
+
+
+@pytest.fixture
+def lmtp_socket():
+    with tempfile.TemporaryDirectory() as d:
+        yield os.path.join(d, "lmtp.sock")
+
+
+@pytest.fixture
+def mailbox_server(
+    request, event_loop, http_port, smtp_port, admin_token, lmtp_socket
+):
     with tempfile.TemporaryDirectory() as d:
-        mailboxzero.start_all(base_maildir=d, http_port=http_port, smtp_port=smtp_port)
+        mailboxzero.start_all(
+            base_maildir=d,
+            http_port=http_port,
+            smtp_port=smtp_port,
+            admin_token=admin_token,
+            stall_threshold=1.0,
+            lmtp_socket=lmtp_socket,
+        )
         yield
 
 
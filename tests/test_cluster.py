@@ -0,0 +1,254 @@
+import asyncio
+import json
+import subprocess
+import sys
+
+from email.message import EmailMessage
+
+import pytest
+
+from aiosmtplib import SMTP as SMTPClient
+
+from mailboxzero import services, utils
+from mailboxzero.cluster import Layout, Node, Router, start_router
+
+from utils import async_requests, wait_for_ports
+
+
+def _node(name, start, http_port=1, smtp_port=1):
+    return Node(name, start, f"http://127.0.0.1:{http_port}", f"127.0.0.1:{smtp_port}")
+
+
+def test_layout_owner():
+    layout = Layout([_node("b", "8"), _node("a", "0")])
+
+    assert layout.owner("0" * 40).name == "a"
+    assert layout.owner("7" + "f" * 39).name == "a"
+    assert layout.owner("8" + "0" * 39).name == "b"
+    assert layout.owner("f" * 40).name == "b"
+
+    # the last node owns the keys below the first start
+    layout = Layout([_node("a", "4"), _node("b", "c")])
+    assert layout.owner("0" * 40).name == "b"
+
+
+def test_layout_moves():
+    old = Layout([_node("a", ""), _node("b", "8")])
+    new = Layout([_node("a", ""), _node("c", "4"), _node("b", "8")])
+
+    moves = [(start, end, a.name, b.name) for start, end, a, b in old.moves(new)]
+    assert moves == [("4", "8", "a", "c")]
+    assert old.moves(old) == []
+
+    with pytest.raises(ValueError):
+        Layout([_node("a", "0"), _node("b", "0")])
+
+
+@pytest.fixture
+def cluster_nodes(tmp_path, admin_token, random_port):
+    """Two mailboxzero servers running in their own processes"""
+    nodes = {}
+    processes = []
+    for name in ("a", "b"):
+        http_port = random_port()
+        smtp_port = random_port()
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    "import mailboxzero; mailboxzero.main()",
+                    f"--base-maildir={tmp_path / name}",
+                    f"--http-port={http_port}",
+                    f"--smtp-port={smtp_port}",
+                    f"--admin-token={admin_token}",
+                ]
+            )
+        )
+        nodes[name] = (tmp_path / name, http_port, smtp_port)
+
+    try:
+        for _, http_port, smtp_port in nodes.values():
+            wait_for_ports(smtp_port, http_port)
+        yield nodes
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+@pytest.fixture
+def layout_file(tmp_path):
+    return tmp_path / "layout.json"
+
+
+@pytest.fixture
+def router(event_loop, cluster_nodes, http_port, smtp_port, admin_token, layout_file):
+    _, a_http, a_smtp = cluster_nodes["a"]
+    return start_router(
+        Layout([_node("a", "", a_http, a_smtp)]),
+        http_port=http_port,
+        smtp_port=smtp_port,
+        admin_token=admin_token,
+        layout_file=str(layout_file),
+    )
+
+
+def _addresses(n):
+    """n addresses with keys below "8" followed by n with keys above"""
+    low = []
+    high = []
+    i = 0
+    while len(low) < n or len(high) < n:
+        address = f"user{i}@mb0.wtte.ch"
+        i += 1
+        if utils.address_key(address) < "8":
+            if len(low) < n:
+                low.append(address)
+        elif len(high) < n:
+            high.append(address)
+    return low, high
+
+
+async def _send(smtp_port, address):
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = address
+    message["Subject"] = "Hello World!"
+    message.set_content("You have mail!")
+
+    client = SMTPClient(hostname="127.0.0.1", port=smtp_port)
+    await client.connect()
+    await client.send_message(message)
+    await client.quit()
+
+
+async def test_rebalance_keeps_layout_if_listing_fails(event_loop):
+    old = Layout([_node("a", "")])
+    router = Router(old)
+    # nothing listens on port 1
+    await router.rebalance(Layout([_node("a", ""), _node("b", "8")]))
+
+    assert router.layout is old
+    assert router.moving == {}
+    assert router.failed == 1
+
+
+def test_router_resumes_moving():
+    source = _node("a", "")
+    router = Router(
+        Layout([source, _node("b", "8")]),
+        moving=[{"key": "9" * 40, "domain": "d" * 40, "node": source.to_json()}],
+    )
+
+    assert router.node_for_key("9" * 40).name == "a"
+    assert router.node_for_key("a" * 40).name == "b"
+
+
+@pytest.fixture
+def unavailable_router(event_loop, http_port, smtp_port, admin_token):
+    # nothing listens on port 1
+    return start_router(
+        Layout([_node("a", "")]),
+        http_port=http_port,
+        smtp_port=smtp_port,
+        admin_token=admin_token,
+    )
+
+
+async def test_failed_moves_are_kept_and_retried(event_loop, layout_file):
+    # nothing listens on port 1
+    source = _node("a", "")
+    router = Router(
+        Layout([source, _node("b", "8")]),
+        layout_file=str(layout_file),
+        moving=[{"key": "9" * 40, "domain": "d" * 40, "node": source.to_json()}],
+    )
+    router.retry_interval = 0.01
+    moving = router.resume_rebalance()
+    try:
+        for _ in range(500):
+            if router.failed >= 2:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        moving.cancel()
+
+    assert router.failed >= 2
+    assert router.node_for_key("9" * 40).name == "a"
+    assert len(router.moving) == 1
+    assert len(json.loads(layout_file.read_text())["moving"]) == 1
+
+
+async def test_delete_domain_with_node_down(
+    unavailable_router, http_port, admin_token
+):
+    r = await async_requests.delete(
+        f"http://127.0.0.1:{http_port}/admin/domains/mb0.wtte.ch",
+        headers={"Authorization": f"token {admin_token}"},
+        timeout=30,
+    )
+    assert r.status_code == 502
+    assert r.json()["message"] == "Node a is not available."
+
+
+async def test_cluster(
+    cluster_nodes, router, http_port, smtp_port, admin_token, layout_file
+):
+    base_url = f"http://127.0.0.1:{http_port}"
+    a_dir, _, _ = cluster_nodes["a"]
+    b_dir, b_http, b_smtp = cluster_nodes["b"]
+    low, high = _addresses(2)
+
+    for address in low + high:
+        await _send(smtp_port, address)
+
+    email_ids = {}
+    for address in low + high:
+        r = await async_requests.get(f"{base_url}/api/{address}")
+        r.raise_for_status()
+        email_ids[address] = r.json()["emails"]
+        assert len(email_ids[address]) == 1
+        assert services.Mailboxes(str(a_dir)).email_ids(address) == email_ids[address]
+
+    # add a second node that takes over the upper half of the keys
+    layout = router.layout.to_json()
+    layout["nodes"].append(_node("b", "8", b_http, b_smtp).to_json())
+    headers = {"Authorization": f"token {admin_token}"}
+    r = await async_requests.put(
+        f"{base_url}/admin/cluster", json=layout, headers=headers
+    )
+    assert r.status_code == 202
+
+    for _ in range(100):
+        r = await async_requests.get(f"{base_url}/admin/cluster", headers=headers)
+        status = r.json()
+        if not status["rebalancing"]:
+            break
+        await asyncio.sleep(0.1)
+    assert status["moved"] == len(high)
+    assert status["failed"] == 0
+    # nothing left to move once rebalancing is done
+    assert json.loads(layout_file.read_text()) == layout
+
+    for address in low + high:
+        r = await async_requests.get(f"{base_url}/api/{address}")
+        assert r.json()["emails"] == email_ids[address]
+
+        stored_on, other = (b_dir, a_dir) if address in high else (a_dir, b_dir)
+        stored = services.Mailboxes(str(stored_on)).email_ids(address)
+        assert stored == email_ids[address]
+        assert not services.Mailboxes(str(other)).exists(address)
+
+    # new email goes to the new owner
+    await _send(smtp_port, high[0])
+    assert len(services.Mailboxes(str(b_dir)).email_ids(high[0])) == 2
+
+    message_id = email_ids[high[0]][0]
+    r = await async_requests.get(f"{base_url}/api/{high[0]}/{message_id}/raw")
+    r.raise_for_status()
+    assert int(r.headers["content-length"]) == len(r.content)
+    assert b"Subject: Hello World!" in r.content
+
+    r = await async_requests.get(f"{base_url}/admin/cluster")
+    assert r.status_code == 403
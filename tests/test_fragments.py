@@ -0,0 +1,19 @@
+from mailboxzero.fragments import FragmentCache
+
+
+def test_fragment_cache():
+    cache = FragmentCache(max_entries=2)
+    cache.set("1", "v1", b"one")
+    cache.set("2", "v1", b"two")
+
+    assert cache.get("1", "v1") == b"one"
+    # a new version of the template invalidates the fragment
+    assert cache.get("1", "v2") is None
+
+    # "2" is the least recently used entry
+    cache.set("3", "v1", b"three")
+    assert cache.get("2", "v1") is None
+    assert len(cache) == 2
+
+    cache.messages_removed("key", ["1", "3"])
+    assert len(cache) == 0
@@ -0,0 +1,94 @@
+import mailbox
+import os
+
+from email.message import EmailMessage
+
+from mailboxzero import services, utils
+
+from utils import deliver
+
+
+def test_sharded_path():
+    key = utils.address_key("someone@mb0.wtte.ch")
+    path = utils.adddress_to_path("someone@mb0.wtte.ch", fanout=2)
+
+    assert path.split(os.sep) == [
+        utils.domain_to_path("mb0.wtte.ch"),
+        key[:2],
+        key[2:4],
+        key,
+    ]
+
+
+def test_read_both_layouts_and_migrate(tmp_path):
+    flat = services.Mailboxes(str(tmp_path))
+    sharded = services.Mailboxes(str(tmp_path), fanout=2)
+
+    old_id = deliver(flat, "old@mb0.wtte.ch")
+    new_id = deliver(sharded, "new@mb0.wtte.ch")
+
+    # both mailboxes are visible before the migration
+    assert sharded.email_ids("old@mb0.wtte.ch") == [old_id]
+    assert sharded.email_ids("new@mb0.wtte.ch") == [new_id]
+    assert sorted(key for key, _ in sharded.mailbox_dirs("mb0.wtte.ch")) == sorted(
+        [utils.address_key("old@mb0.wtte.ch"), utils.address_key("new@mb0.wtte.ch")]
+    )
+
+    assert sharded.migrate("mb0.wtte.ch", limit=10) == 1
+    assert sharded.migrate("mb0.wtte.ch", limit=10) == 0
+
+    assert sharded.mail_dir_for("old@mb0.wtte.ch") == os.path.join(
+        str(tmp_path), utils.adddress_to_path("old@mb0.wtte.ch", fanout=2)
+    )
+    assert sharded.email_ids("old@mb0.wtte.ch") == [old_id]
+    assert not os.path.exists(flat.mail_dir_for("old@mb0.wtte.ch"))
+
+
+def test_migrate_merges_existing_mailbox(tmp_path):
+    flat = services.Mailboxes(str(tmp_path))
+    sharded = services.Mailboxes(str(tmp_path), fanout=2)
+
+    first = deliver(flat, "someone@mb0.wtte.ch")
+    # a mailbox that exists in both layouts
+    sharded_dir = os.path.join(
+        str(tmp_path), utils.adddress_to_path("someone@mb0.wtte.ch", fanout=2)
+    )
+    os.makedirs(os.path.dirname(sharded_dir))
+    second = mailbox.Maildir(sharded_dir).add(EmailMessage())
+
+    assert sharded.migrate("mb0.wtte.ch") == 1
+    assert sharded.email_ids("someone@mb0.wtte.ch") == sorted([first, second])
+
+
+def test_trash_and_empty(tmp_path):
+    mailboxes = services.Mailboxes(str(tmp_path), fanout=2)
+    message_id = deliver(mailboxes, "someone@mb0.wtte.ch")
+    deliver(mailboxes, "other@mb0.wtte.ch")
+
+    trashed = mailboxes.trash_mailbox("someone@mb0.wtte.ch")
+    assert not mailboxes.exists("someone@mb0.wtte.ch")
+    assert mailboxes.trashed() == trashed
+
+    trashed += mailboxes.trash_domain("mb0.wtte.ch")
+    assert not mailboxes.exists("other@mb0.wtte.ch")
+
+    removed = mailboxes.empty_trash(trashed)
+    assert removed[utils.address_key("someone@mb0.wtte.ch")] == [message_id]
+    assert len(removed[utils.address_key("other@mb0.wtte.ch")]) == 1
+    assert mailboxes.trashed() == []
+
+
+def test_remove_messages_keeps_others(tmp_path):
+    mailboxes = services.Mailboxes(str(tmp_path), fanout=2)
+    address = "someone@mb0.wtte.ch"
+    domain_path = utils.domain_to_path("mb0.wtte.ch")
+    key = utils.address_key(address)
+    copied = deliver(mailboxes, address)
+    # arrived after the mailbox was copied
+    late = deliver(mailboxes, address)
+
+    assert mailboxes.remove_messages(domain_path, key, [copied]) == ([copied], 1)
+    assert mailboxes.email_ids(address) == [late]
+
+    assert mailboxes.remove_messages(domain_path, key, [late]) == ([late], 0)
+    assert not mailboxes.exists(address)
@@ -0,0 +1,115 @@
+import heapq
+import os
+
+from mailboxzero import services, utils
+from mailboxzero.quota import Quotas, _Usage
+
+from utils import deliver, make_message
+
+
+def _deliver(quotas, address, size=1000):
+    message = make_message("x" * size, to=address)
+    mail_dir = quotas.mailboxes.mail_dir_for(address)
+    evicted = quotas.make_room(address, mail_dir, len(message.as_bytes()))
+    message_id = deliver(quotas.mailboxes, address, message, listener=quotas)
+    return message_id, evicted
+
+
+def test_max_messages_evicts_oldest(tmp_path):
+    quotas = Quotas(
+        services.Mailboxes(str(tmp_path)), {"mb0.wtte.ch": {"max_messages": 2}}
+    )
+
+    first, _ = _deliver(quotas, "someone@mb0.wtte.ch")
+    second, _ = _deliver(quotas, "someone@mb0.wtte.ch")
+    third, evicted = _deliver(quotas, "someone@mb0.wtte.ch")
+
+    assert evicted == {utils.address_key("someone@mb0.wtte.ch"): [first]}
+    assert quotas.mailboxes.email_ids("someone@mb0.wtte.ch") == sorted(
+        [second, third]
+    )
+
+
+def test_evicts_messages_moved_to_cur(tmp_path):
+    quotas = Quotas(
+        services.Mailboxes(str(tmp_path)), {"mb0.wtte.ch": {"max_messages": 2}}
+    )
+
+    first, _ = _deliver(quotas, "someone@mb0.wtte.ch")
+    second, _ = _deliver(quotas, "someone@mb0.wtte.ch")
+    # a mail client read the first message and moved it to cur/
+    mail_dir = quotas.mailboxes.mail_dir_for("someone@mb0.wtte.ch")
+    os.rename(
+        os.path.join(mail_dir, "new", first),
+        os.path.join(mail_dir, "cur", first + ":2,S"),
+    )
+
+    third, evicted = _deliver(quotas, "someone@mb0.wtte.ch")
+
+    assert evicted == {utils.address_key("someone@mb0.wtte.ch"): [first]}
+    assert quotas.mailboxes.email_ids("someone@mb0.wtte.ch") == sorted(
+        [second, third]
+    )
+
+
+def test_max_domain_bytes_evicts_oldest_of_domain(tmp_path):
+    quotas = Quotas(
+        services.Mailboxes(str(tmp_path)),
+        {"mb0.wtte.ch": {"max_domain_bytes": 5000}},
+    )
+
+    first, _ = _deliver(quotas, "one@mb0.wtte.ch", size=2000)
+    second, _ = _deliver(quotas, "two@mb0.wtte.ch", size=2000)
+    assert quotas.domain_bytes("mb0.wtte.ch") < 5000
+
+    third, evicted = _deliver(quotas, "two@mb0.wtte.ch", size=2000)
+
+    assert evicted == {utils.address_key("one@mb0.wtte.ch"): [first]}
+    assert quotas.mailboxes.email_ids("one@mb0.wtte.ch") == []
+    assert len(quotas.mailboxes.email_ids("two@mb0.wtte.ch")) == 2
+    assert quotas.domain_bytes("mb0.wtte.ch") < 5000
+
+
+def test_gc_interval_shrinks_under_pressure(tmp_path):
+    quotas = Quotas(
+        services.Mailboxes(str(tmp_path)),
+        {"mb0.wtte.ch": {"max_domain_bytes": 10000}},
+    )
+    assert quotas.gc_interval("mb0.wtte.ch", 100) == 100
+
+    _deliver(quotas, "one@mb0.wtte.ch", size=7000)
+    assert 10 < quotas.gc_interval("mb0.wtte.ch", 100) < 100
+
+    # messages removed by the GC no longer count
+    key = utils.address_key("one@mb0.wtte.ch")
+    message_ids = quotas.mailboxes.email_ids("one@mb0.wtte.ch")
+    quotas.messages_removed(key, message_ids)
+    assert quotas.domain_bytes("mb0.wtte.ch") == 0
+    assert quotas.gc_interval("mb0.wtte.ch", 100) == 100
+
+
+def test_merge_large_scan_heapifies_once(tmp_path, monkeypatch):
+    quotas = Quotas(
+        services.Mailboxes(str(tmp_path)), {"mb0.wtte.ch": {"max_messages": 10}}
+    )
+
+    usages = {}
+    for n in range(2000):
+        usage = _Usage("mb0.wtte.ch", str(tmp_path / str(n)))
+        for m in range(10):
+            usage.sizes[f"{1000000 + (n * 7919 + m) % 20000}.M{n}P{m}.host"] = 100
+        usage.bytes = sum(usage.sizes.values())
+        usages[f"key{n}"] = usage
+
+    heapify_calls = []
+    heapify = heapq.heapify
+    monkeypatch.setattr(
+        heapq, "heapify", lambda heap: heapify_calls.append(1) or heapify(heap)
+    )
+    quotas.merge(usages)
+
+    assert len(heapify_calls) == 1
+    assert quotas.domain_bytes("mb0.wtte.ch") == 2000 * 10 * 100
+    heap = quotas._oldest["mb0.wtte.ch"]
+    assert len(heap) == 2000 * 10
+    assert all(heap[(i - 1) // 2] <= heap[i] for i in range(1, len(heap)))
@@ -0,0 +1,79 @@
+import bleach
+import pytest
+
+from mailboxzero import rewrite, utils
+
+
+NEWSLETTER = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>Weekly news</title>
+<!--[if mso]><style>table {border-collapse: collapse;}</style><![endif]-->
+<style type="text/css">
+  body { margin: 0; }  a > img { border: 0 }
+</style>
+</head>
+<body class=" body  wide ">
+<table role="presentation" width="100%"><tr><td headers=" a  b " align="center">
+  <a href="https://example.com/?utm_source=news&amp;id=1" target="_self"><img
+     src="cid:logo@example.com" alt="Logo" width=120></a>
+  <p>Hello&nbsp;there, this week&#8217;s <b><i>news</b> &copy 2024</p>
+  <img src="https://tracker.example.com/open.gif" height="1" width="1"><br>
+  <pre>  keep
+    this  </pre>
+  <![if !mso]><p>Not in Outlook</p><![endif]>
+</td></tr></table>
+<!---->
+</body>
+</html>
+"""
+
+
+def static_url(path):
+    return "/static/" + path
+
+
+@pytest.mark.parametrize(
+    "document",
+    [
+        NEWSLETTER,
+        "<p>No head here <a href='x'>link</a></p>",
+        "<html><body><head></head><p>late head<p/></body></html>",
+        "<div><span>unclosed <br></br> <img src=cid:a>",
+        "<p title='a\"b' data-x=\"it's\">&#128;&#0;&nosuch;</p></div>",
+        "<meta charset=latin1><script>if (a<b) {}</div></script><style> </style>",
+        "",
+    ],
+)
+def test_rewrite_html_same_as_beautifulsoup(document):
+    expected = utils.rewrite_html(document, "/content/a/b/", static_url)
+    assert rewrite.rewrite_html(document, "/content/a/b/", static_url) == expected
+
+
+def test_rewrite_html():
+    html = rewrite.rewrite_html(NEWSLETTER, "/content/a/b/", static_url)
+
+    assert '<head><link href="/static/dist/main.css" rel="stylesheet"/>' in html
+    assert (
+        '<img alt="Logo" decoding="async" loading="lazy" '
+        'src="/content/a/b/logo@example.com" width="120"/>'
+    ) in html
+    assert 'content="text/html; charset=utf-8" http-equiv="Content-Type"/>' in html
+    assert 'target="_blank"' in html
+    assert 'target="_self"' not in html
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Hello,\n\nread more at https://example.com/news?id=1, or (www.example.org).\n",
+        "Mail mailto:bob@example.com or bob@example.com",
+        "> quoted reply with <b>markup</b> & an entity &amp; http://example.com/a>b",
+        "no links in here",
+    ],
+)
+def test_linkify_text_same_as_bleach(text):
+    expected = bleach.linkify(bleach.clean(text, strip=True))
+    assert rewrite.linkify_text(text) == expected
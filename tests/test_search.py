@@ -0,0 +1,81 @@
+import mailbox
+import os
+
+from email.message import EmailMessage
+
+from mailboxzero import search, services, utils
+
+
+def test_search_index_add_remove():
+    index = search.SearchIndex()
+    index.add_document("key", "1", "Your order", "shop@example.com", "Order A-1")
+    index.add_document("key", "2", "Your invoice", "shop@example.com", "Order A-1")
+
+    assert index.search("key", "order a") == ["1", "2"]
+    assert index.search("key", "invoice") == ["2"]
+    assert index.search("key", "") == []
+    assert index.search("other-key", "order") == []
+
+    index.messages_removed("key", ["2"])
+    assert index.search("key", "invoice") == []
+    assert index.search("key", "order") == ["1"]
+
+    index.messages_removed("key", ["1"])
+    assert len(index) == 0
+
+
+def test_message_tokens_are_bounded():
+    body = " ".join(f"word{n}" for n in range(10 * search.MAX_TOKENS_PER_MESSAGE))
+    tokens = search.message_tokens("Subject", "x" * 1000, body)
+
+    assert len(tokens) == search.MAX_TOKENS_PER_MESSAGE
+    assert tokens[0] == "subject"
+    assert max(len(t) for t in tokens) == search.MAX_TOKEN_LENGTH
+
+
+def test_search_misses_dont_grow_postings():
+    index = search.SearchIndex()
+    index.add_document("key", "1", "Your order", "shop@example.com", "")
+
+    assert index.search("key", "order unknown") == []
+    assert index.search("key", "another") == []
+    assert "unknown" not in index._mailboxes["key"].postings
+    assert "another" not in index._mailboxes["key"].postings
+
+
+async def test_ensure_indexed_only_parses_missing(tmp_path, monkeypatch):
+    mailboxes = services.Mailboxes(str(tmp_path))
+    address = "someone@mb0.wtte.ch"
+    mail_dir = mailboxes.mail_dir_for(address)
+    os.makedirs(os.path.dirname(mail_dir))
+    mbox = mailbox.Maildir(mail_dir)
+
+    message = EmailMessage()
+    message["Subject"] = "Your order"
+    message.set_content("Thank you for order A-12345.")
+    first = mbox.add(message.as_bytes())
+    second = mbox.add(message.as_bytes())
+
+    index = search.SearchIndex()
+    index.add_document(utils.address_key(address), first, "Known", "", "")
+
+    parsed = []
+    plain_text = search._plain_text
+    monkeypatch.setattr(
+        search, "_plain_text", lambda m: parsed.append(m) or plain_text(m)
+    )
+
+    await index.ensure_indexed(address, mailboxes)
+    assert len(parsed) == 1
+    assert index.search(utils.address_key(address), "order") == [second]
+
+    # complete now, nothing is read again
+    await index.ensure_indexed(address, mailboxes)
+    assert len(parsed) == 1
+
+
+def test_html_body_is_indexed_as_text():
+    message = EmailMessage()
+    message.set_content("<p>Your&nbsp;order <b>A-1</b></p>", subtype="html")
+
+    assert search._plain_text(message).split() == ["Your", "order", "A-1"]
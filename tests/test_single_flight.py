@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from mailboxzero.services import SingleFlight
+
+
+async def test_single_flight():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return {"value": value}
+
+    first, second, other = await asyncio.gather(
+        single_flight.run("a", compute, 1),
+        single_flight.run("a", compute, 1),
+        single_flight.run("b", compute, 2),
+    )
+    assert first is second
+    assert first == {"value": 1}
+    assert other == {"value": 2}
+    assert calls == [1, 2]
+    assert single_flight.stats() == {"started": 2, "coalesced": 1, "in_flight": 0}
+
+    # finished computations are not reused
+    assert await single_flight.run("a", compute, 3) == {"value": 3}
+
+
+async def test_single_flight_errors_and_cancelling():
+    single_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise ValueError("broken")
+
+    results = await asyncio.gather(
+        single_flight.run("a", fail),
+        single_flight.run("a", fail),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return 42
+
+    # the computation keeps going for those still waiting for it
+    cancelled = asyncio.ensure_future(single_flight.run("b", compute))
+    waiting = asyncio.ensure_future(single_flight.run("b", compute))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    assert await waiting == 42
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
@@ -1,10 +1,20 @@
+import asyncio
+import os
+import stat
+
+from email.message import EmailMessage
+
 import pytest
 
 import aiosmtplib
+
+from aiosmtpd.smtp import Envelope, Session
 from aiosmtplib import SMTP as SMTPClient
 
 import mailboxzero
 
+from utils import async_requests
+
 
 async def test_smtp_is_alive(mailbox_server, smtp_port):
     # test the SMTP server is alive
@@ -54,3 +64,117 @@ def test_replace_large_parts(large_email):
     ]
     actual_structure = [p.get_content_type() for p in large_email.walk()]
     assert actual_structure == expected_structure
+
+
+@pytest.mark.parametrize(
+    "size, replaced",
+    [
+        (500, False),
+        # larger than the limit once base64 encoded, but not decoded
+        (900, False),
+        (1100, True),
+    ],
+)
+def test_replace_large_parts_limit(size, replaced):
+    message = EmailMessage()
+    message.set_content("x" * 2000)
+    message.add_attachment(
+        b"a" * size, "application", "octet-stream", filename="data.bin"
+    )
+
+    mailboxzero.replace_large_parts(message, limit=1000)
+
+    (attachment,) = message.iter_attachments()
+    if replaced:
+        assert attachment.get_content_type() == "text/plain"
+        assert f"size of {size} bytes" in attachment.get_content()
+    else:
+        assert attachment.get_content() == b"a" * size
+    # the text is larger than the limit as well
+    assert "placeholder" in message.get_body(("plain",)).get_content()
+
+
+async def _reply(reader):
+    """Read one, possibly multi-line, reply and return its code"""
+    while True:
+        line = await reader.readline()
+        if line[3:4] != b"-":
+            return int(line[:3])
+
+
+async def test_lmtp(mailbox_server, base_url, lmtp_socket):
+    assert stat.S_IMODE(os.stat(lmtp_socket).st_mode) == 0o660
+
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = "lmtp1@mb0.wtte.ch, lmtp2@mb0.wtte.ch"
+    message["Subject"] = "Hello World!"
+    message.set_content("You have mail!")
+
+    # smtplib.LMTP only reads the first reply after DATA
+    reader, writer = await asyncio.open_unix_connection(lmtp_socket)
+    assert await _reply(reader) == 220
+    commands = [
+        (b"LHLO localhost", 250),
+        (b"MAIL FROM:<someone@remote.example.com>", 250),
+        (b"RCPT TO:<lmtp1@mb0.wtte.ch>", 250),
+        (b"RCPT TO:<x@example.com>", 550),
+        (b"RCPT TO:<lmtp2@mb0.wtte.ch>", 250),
+        (b"DATA", 354),
+    ]
+    for command, code in commands:
+        writer.write(command + b"\r\n")
+        assert await _reply(reader) == code
+
+    writer.write(message.as_bytes().replace(b"\n", b"\r\n") + b".\r\n")
+    # one reply for each accepted recipient
+    assert [await _reply(reader), await _reply(reader)] == [250, 250]
+    writer.write(b"QUIT\r\n")
+    assert await _reply(reader) == 221
+    writer.close()
+
+    for address in ("lmtp1@mb0.wtte.ch", "lmtp2@mb0.wtte.ch"):
+        r = await async_requests.get(f"{base_url}/{address}")
+        assert len(r.json()["emails"]) == 1
+
+
+def test_lmtp_reply_per_recipient(tmp_path):
+    handler = mailboxzero.LMTPMailboxHandler(str(tmp_path), {"mb0.wtte.ch": {}})
+    # make delivery to one of the recipients fail
+    broken = handler.mailboxes.mail_dir_for("broken@mb0.wtte.ch")
+    os.makedirs(os.path.dirname(broken))
+    open(broken, "w").close()
+
+    message = EmailMessage()
+    message["Subject"] = "Hello World!"
+    message["X-RcptTo"] = "ok@mb0.wtte.ch, broken@mb0.wtte.ch"
+    message.set_content("You have mail!")
+
+    reply = handler.handle_message(message)
+    assert reply.split("\r\n") == [
+        "250 2.0.0 <ok@mb0.wtte.ch> OK",
+        "451 4.3.0 <broken@mb0.wtte.ch> Try again later",
+    ]
+    assert len(handler.mailboxes.email_ids("ok@mb0.wtte.ch")) == 1
+
+
+async def test_lmtp_reply_per_recipient_when_preparing_fails(tmp_path):
+    handler = mailboxzero.LMTPMailboxHandler(str(tmp_path), {"mb0.wtte.ch": {}})
+
+    # a part too large to keep, in a charset we can't decode to replace it
+    message = EmailMessage()
+    message.set_content("x" * (2 * 1024 * 1024))
+    message.set_param("charset", "x-unknown")
+
+    envelope = Envelope()
+    envelope.mail_from = "someone@remote.example.com"
+    envelope.rcpt_tos = ["one@mb0.wtte.ch", "two@mb0.wtte.ch"]
+    envelope.content = message.as_bytes()
+    session = Session(asyncio.get_running_loop())
+    session.peer = ("127.0.0.1", 12345)
+
+    reply = await handler.handle_DATA(None, session, envelope)
+    assert reply.split("\r\n") == [
+        "554 5.6.0 <one@mb0.wtte.ch> Message can't be processed",
+        "554 5.6.0 <two@mb0.wtte.ch> Message can't be processed",
+    ]
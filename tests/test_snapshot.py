@@ -0,0 +1,84 @@
+import json
+import time
+
+from mailboxzero import services, utils
+from mailboxzero.snapshot import Snapshot
+
+from utils import deliver
+
+
+DOMAINS = {"mb0.wtte.ch": {"max_email_age": 600}}
+
+
+def _restart(mailboxes):
+    snapshot = Snapshot(mailboxes, DOMAINS)
+    snapshot.restore(snapshot.load())
+    return snapshot
+
+
+def test_snapshot_survives_restart(tmp_path):
+    mailboxes = services.Mailboxes(str(tmp_path))
+    address = "snap@mb0.wtte.ch"
+    snapshot = _restart(mailboxes)
+    ids = [
+        deliver(mailboxes, address, listener=snapshot, subject=f"Email {i}")
+        for i in range(3)
+    ]
+    snapshot.messages_removed(utils.address_key(address), ids[:1])
+
+    # nothing is read from the Maildir when restoring
+    snapshot = _restart(mailboxes)
+    assert len(snapshot) == 2
+    summaries = snapshot.summaries(address, ids)
+    assert summaries == mailboxes.get_message_summaries(address, ids[1:])
+    expires = min(int(i.partition(".")[0]) for i in ids[1:]) + 600
+    assert snapshot.next_expiry("mb0.wtte.ch") == expires
+    assert snapshot.next_expiry("qmq.ch") is None
+
+
+async def test_snapshot_compaction_and_torn_journal(tmp_path):
+    mailboxes = services.Mailboxes(str(tmp_path))
+    address = "snap@mb0.wtte.ch"
+    snapshot = _restart(mailboxes)
+    snapshot.compact_after = 2
+    ids = [
+        deliver(mailboxes, address, listener=snapshot, subject=f"Email {i}")
+        for i in range(3)
+    ]
+
+    # the third email arrived while the snapshot was written in the background
+    await snapshot.compact()
+    with open(snapshot.snapshot_file) as f:
+        mailboxes_json = json.load(f)["mailboxes"]
+    assert len(mailboxes_json[utils.address_key(address)]["messages"]) == 2
+    with open(snapshot.journal_file) as f:
+        assert [json.loads(line)["id"] for line in f] == [ids[2]]
+    with open(snapshot.journal_file, "a") as f:
+        f.write('{"op": "remove", "key": ')
+
+    # the incomplete change is skipped and doesn't break the next one
+    snapshot = _restart(mailboxes)
+    assert set(snapshot.summaries(address, ids)) == set(ids)
+    ids.append(deliver(mailboxes, address, listener=snapshot, subject="Email 3"))
+
+    snapshot = _restart(mailboxes)
+    assert set(snapshot.summaries(address, ids)) == set(ids)
+
+
+def test_snapshot_verify(tmp_path):
+    mailboxes = services.Mailboxes(str(tmp_path))
+    address = "snap@mb0.wtte.ch"
+    snapshot = _restart(mailboxes)
+    kept = deliver(mailboxes, address, listener=snapshot, subject="kept")
+    gone = deliver(mailboxes, address, listener=snapshot, subject="gone")
+    # changes the snapshot didn't hear about, for example during a crash
+    mailboxes.mbox(address).discard(gone)
+    unseen = deliver(mailboxes, address, subject="unseen")
+
+    snapshot = _restart(mailboxes)
+    known = snapshot.known_ids("mb0.wtte.ch")
+    snapshot.reconcile(known, snapshot.scan_domain("mb0.wtte.ch", known))
+
+    summaries = snapshot.summaries(address, [kept, gone, unseen])
+    assert summaries == mailboxes.get_message_summaries(address, [kept, unseen])
+    assert snapshot.next_expiry("mb0.wtte.ch") <= time.time() + 600
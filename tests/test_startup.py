@@ -0,0 +1,112 @@
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from mailboxzero import startup
+
+
+def test_background_runs_once_and_shares_result():
+    calls = []
+
+    def compute():
+        calls.append(threading.current_thread())
+        return 42
+
+    value = startup.Background("answer", compute)
+    assert not value.done()
+
+    value.start()
+    value.start()
+    assert value.result() == 42
+    assert value.done()
+    assert len(calls) == 1
+    assert calls[0] is not threading.current_thread()
+
+
+def test_background_raises_in_caller():
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError, match="boom"):
+        startup.Background("failing", fail).result()
+
+
+async def test_background_get_doesnt_block_loop():
+    release = threading.Event()
+    value = startup.Background("slow", lambda: release.wait(5) and "ready")
+    waiting = value.get()
+
+    # the loop keeps running while the value is computed
+    release.set()
+    assert await waiting == "ready"
+
+
+def test_preload_imports_in_background():
+    future = startup.preload("json", "csv")
+    modules = future.result(timeout=10)
+
+    assert [m.__name__ for m in modules] == ["json", "csv"]
+    assert "import csv" in [c for c, _, _ in startup.profile.timings]
+
+
+def test_profile_report():
+    profile = startup.StartupProfile()
+    with profile.measure("import something"):
+        pass
+    with profile.measure("load data", background=True):
+        pass
+    profile.mark("listening")
+
+    lines = profile.report().splitlines()
+    assert lines[0] == "Startup profile:"
+    assert lines[1].endswith("ms  import something")
+    assert lines[2].endswith("ms  load data (background)")
+    assert lines[3].endswith("ms  until listening")
+
+
+def test_import_is_lazy():
+    # these are slow to import and only needed once email is rendered
+    code = (
+        "import sys, mailboxzero;"
+        " print(' '.join(m for m in ('bleach', 'bs4', 'urlextract',"
+        " 'friendlywords') if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_profile_startup_option(tmp_path, http_port, smtp_port):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import mailboxzero; mailboxzero.main()",
+            f"--base-maildir={tmp_path}",
+            f"--http-port={http_port}",
+            f"--smtp-port={smtp_port}",
+            "--profile-startup",
+        ],
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    timer = threading.Timer(30, server.kill)
+    timer.start()
+    try:
+        output = []
+        for line in server.stderr:
+            output.append(line)
+            if "until HTTP server listening" in line:
+                break
+    finally:
+        timer.cancel()
+        server.kill()
+        server.wait()
+
+    output = "".join(output)
+    assert "Startup profile:" in output
+    assert "import tornado" in output
+    assert "preload bleach (background)" in output
@@ -0,0 +1,78 @@
+import json
+
+from email.message import EmailMessage
+
+import pytest
+
+import mailboxzero
+from mailboxzero import tracing
+
+from utils import async_requests
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    return tmp_path / "traces.jsonl"
+
+
+@pytest.fixture
+def traced_server(event_loop, http_port, smtp_port, tmp_path, trace_file):
+    mailboxzero.start_all(
+        base_maildir=str(tmp_path / "mail"),
+        http_port=http_port,
+        smtp_port=smtp_port,
+        trace_file=str(trace_file),
+    )
+
+
+def test_sampling_depends_only_on_trace_id(tmp_path):
+    exporter = tracing.JSONLinesExporter(tmp_path / "traces.jsonl")
+    tracer = tracing.Tracer(exporter, sample_rate=0.5)
+
+    assert tracer.sampled("00000000" + "0" * 24)
+    assert not tracer.sampled("ffffffff" + "0" * 24)
+    assert not tracing.Tracer().sampled("00000000" + "0" * 24)
+
+
+async def test_message_trace(traced_server, base_url, smtp_client, trace_file):
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = "traced1@mb0.wtte.ch, traced2@mb0.wtte.ch"
+    message["date"] = "Mon, 14 May 1984 12:34:56 +0000"
+    message["Subject"] = "Hello World!"
+    # a trace ID made up by the sender is replaced
+    message[tracing.TRACE_HEADER] = "0" * 32
+    message.set_content("You have mail!")
+    await smtp_client.send_message(message)
+
+    r = await async_requests.get(base_url + "/traced1@mb0.wtte.ch")
+    email_id = r.json()["emails"][0]
+    r = await async_requests.get(base_url + f"/traced1@mb0.wtte.ch/{email_id}")
+    r.raise_for_status()
+
+    (trace_id,) = [
+        value for name, value in r.json()["headers"] if name == tracing.TRACE_HEADER
+    ]
+    assert trace_id != "0" * 32
+
+    with open(trace_file) as f:
+        spans = [json.loads(line) for line in f]
+
+    names = [s["name"] for s in spans if s["trace_id"] == trace_id]
+    assert sorted(names) == sorted(
+        [
+            "prepare_message",
+            "replace_large_parts",
+            "ensure_attachment_cids",
+            "deliver",
+            "deliver",
+            "handle_DATA",
+            "http EMailHandler",
+        ]
+    )
+
+    (data_span,) = [s for s in spans if s["name"] == "handle_DATA"]
+    session_trace_id = data_span["attributes"]["session_trace_id"]
+    rcpt_spans = [s for s in spans if s["name"] == "handle_RCPT"]
+    assert len(rcpt_spans) == 2
+    assert all(s["trace_id"] == session_trace_id for s in rcpt_spans)
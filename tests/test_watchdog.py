@@ -0,0 +1,31 @@
+import asyncio
+import sys
+import time
+
+from mailboxzero.watchdog import Watchdog, blocking_label
+
+
+def test_blocking_label():
+    # outside of the event loop and mailboxzero there is nothing to name
+    assert blocking_label(sys._getframe()) == "unknown"
+
+
+async def test_watchdog():
+    watchdog = Watchdog(threshold=0.05)
+    watchdog.start()
+
+    def block():
+        time.sleep(0.3)
+
+    await asyncio.sleep(0.1)
+    asyncio.get_running_loop().call_soon(block)
+    await asyncio.sleep(0.2)
+    watchdog.stop()
+
+    stats = watchdog.stats()
+    assert stats["stalls"] == 1
+    (stall,) = stats["recent"]
+    assert stall["duration_ms"] >= 200
+    assert stall["label"].endswith("block")
+    assert "time.sleep(0.3)" in stall["stack"]
+    assert stats["by_label"][stall["label"]]["count"] == 1
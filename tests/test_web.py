@@ -1,3 +1,6 @@
+import io
+import zipfile
+
 import pytest
 
 from email.message import EmailMessage
@@ -174,3 +177,270 @@ async def test_three_recipients(mailbox_server, base_url, smtp_client):
         r1.raise_for_status()
         data = r1.json()
         assert data["subject"] == "Hello World!"
+
+
+async def test_wait_for_email(mailbox_server, base_url, smtp_client):
+    # start waiting before the matching email is sent
+    waiting = async_requests.get(
+        base_url + "/waiting@mb0.wtte.ch/wait",
+        params={"subject": "^Confirm", "body": "token=", "timeout": 10},
+        timeout=30,
+    )
+
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = "waiting@mb0.wtte.ch"
+    message["date"] = "Mon, 14 May 1984 12:34:56 +0000"
+    # doesn't match the subject filter
+    message["Subject"] = "Welcome"
+    message.set_content("Please visit https://example.com/?token=1234")
+    await smtp_client.send_message(message)
+
+    message.replace_header("Subject", "Confirm your address")
+    await smtp_client.send_message(message)
+
+    r = await waiting
+    r.raise_for_status()
+    data = r.json()
+
+    assert data["subject"] == "Confirm your address"
+    assert data["simplestBody"]["urls"] == ["https://example.com/?token=1234"]
+
+    r = await async_requests.get(base_url + "/waiting@mb0.wtte.ch")
+    assert data["id"] in r.json()["emails"]
+
+
+async def test_wait_for_email_timeout(mailbox_server, base_url):
+    r = await async_requests.get(
+        base_url + "/nomail@mb0.wtte.ch/wait", params={"timeout": 0.1}, timeout=30
+    )
+    assert r.status_code == 408
+
+    r = await async_requests.get(
+        base_url + "/nomail@mb0.wtte.ch/wait", params={"subject": "("}, timeout=30
+    )
+    assert r.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "pattern", ["(a+)+$", "(?:x|xx)*y", r"(\w)\1", "a.*b.*c.*d", "a" * 201]
+)
+async def test_wait_for_email_slow_pattern(mailbox_server, base_url, pattern):
+    r = await async_requests.get(
+        base_url + "/nomail@mb0.wtte.ch/wait",
+        params={"subject": pattern, "timeout": 0.1},
+        timeout=30,
+    )
+    assert r.status_code == 400
+
+
+async def test_search(mailbox_server, base_url, smtp_client):
+    message = EmailMessage()
+    message["From"] = "shop@remote.example.com"
+    message["To"] = "searching@mb0.wtte.ch"
+    message["date"] = "Mon, 14 May 1984 12:34:56 +0000"
+    message["Subject"] = "Your order"
+    message.set_content("Thank you for order A-12345.")
+    await smtp_client.send_message(message)
+
+    message.replace_header("Subject", "Reset your password")
+    message.set_content("Follow https://example.com/reset to reset it.")
+    await smtp_client.send_message(message)
+
+    for query, subject in (("a-12345", "Your order"), ("Shop RESET", "Reset your")):
+        r = await async_requests.get(
+            base_url + "/searching@mb0.wtte.ch/search", params={"q": query}
+        )
+        r.raise_for_status()
+        email_ids = r.json()["emails"]
+        assert len(email_ids) == 1
+
+        r = await async_requests.get(
+            base_url + "/searching@mb0.wtte.ch/" + email_ids[0]
+        )
+        assert r.json()["subject"].startswith(subject)
+
+    r = await async_requests.get(
+        base_url + "/searching@mb0.wtte.ch/search", params={"q": "invoice"}
+    )
+    assert r.json() == {"emails": []}
+
+
+async def test_view_mailbox(mailbox_server, base_url, smtp_client):
+    view_url = base_url.replace("/api", "/view") + "/viewing@mb0.wtte.ch/"
+
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = "viewing@mb0.wtte.ch"
+    message["date"] = "Mon, 14 May 1984 12:34:56 +0000"
+    message["Subject"] = "Hello <World>"
+    message.set_content("You have mail!")
+    await smtp_client.send_message(message)
+
+    message.replace_header("Subject", "Second email")
+    await smtp_client.send_message(message)
+
+    r = await async_requests.get(view_url)
+    r.raise_for_status()
+    assert "Hello &lt;World&gt;" in r.text
+    assert "Second email" in r.text
+
+    # the second time the list entries come from the cache
+    r2 = await async_requests.get(view_url)
+    assert r2.text == r.text
+
+    r = await async_requests.get(view_url, params={"q": "second"})
+    r.raise_for_status()
+    assert "Hello &lt;World&gt;" not in r.text
+    assert "Second email" in r.text
+
+
+async def test_raw_email(mailbox_server, base_url, smtp_client):
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = "raw@mb0.wtte.ch"
+    message["date"] = "Mon, 14 May 1984 12:34:56 +0000"
+    message["Subject"] = "Hello World!"
+    message.set_content("You have mail!\nFrom the server\n")
+    await smtp_client.send_message(message)
+    await smtp_client.send_message(message)
+
+    r = await async_requests.get(base_url + "/raw@mb0.wtte.ch")
+    email_ids = r.json()["emails"]
+
+    r = await async_requests.get(base_url + f"/raw@mb0.wtte.ch/{email_ids[0]}/raw")
+    r.raise_for_status()
+    assert r.headers["content-type"] == "message/rfc822"
+    assert int(r.headers["content-length"]) == len(r.content)
+    assert b"Subject: Hello World!" in r.content
+    assert b"X-RcptTo: raw@mb0.wtte.ch" in r.content
+
+    r2 = await async_requests.get(
+        base_url + f"/raw@mb0.wtte.ch/{email_ids[0]}/raw",
+        headers={"If-None-Match": r.headers["etag"]},
+    )
+    assert r2.status_code == 304
+
+    r = await async_requests.get(base_url + "/raw@mb0.wtte.ch/doesnotexist/raw")
+    assert r.status_code == 404
+
+    r = await async_requests.get(
+        base_url + "/raw@mb0.wtte.ch/raw", params={"id": email_ids}
+    )
+    r.raise_for_status()
+    assert r.content.count(b"\nFrom MAILER-DAEMON ") == 1
+    assert r.content.startswith(b"From MAILER-DAEMON ")
+    assert r.content.count(b"\n>From the server\n") == 2
+
+
+async def test_export_mailbox(mailbox_server, base_url, smtp_client):
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = "export@mb0.wtte.ch"
+    message["date"] = "Mon, 14 May 1984 12:34:56 +0000"
+    message["Subject"] = "Hello World!"
+    message.set_content("You have mail!\nFrom the server\n")
+    await smtp_client.send_message(message)
+    await smtp_client.send_message(message)
+
+    r = await async_requests.get(base_url + "/export@mb0.wtte.ch")
+    email_ids = r.json()["emails"]
+
+    r = await async_requests.get(base_url + "/export@mb0.wtte.ch/export")
+    r.raise_for_status()
+    assert r.headers["content-type"] == "application/mbox"
+    assert "export@mb0.wtte.ch.mbox" in r.headers["content-disposition"]
+    assert r.content.count(b"From MAILER-DAEMON ") == 2
+    assert r.content.count(b"\n>From the server\n") == 2
+
+    r = await async_requests.get(
+        base_url + "/export@mb0.wtte.ch/export", params={"format": "zip"}
+    )
+    r.raise_for_status()
+    assert r.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(r.content)) as archive:
+        assert sorted(archive.namelist()) == sorted(f"{id}.eml" for id in email_ids)
+        content = archive.read(f"{email_ids[0]}.eml")
+        assert b"Subject: Hello World!" in content
+        assert b"\nFrom the server\n" in content
+
+    r = await async_requests.get(
+        base_url + "/export@mb0.wtte.ch/export", params={"format": "tar"}
+    )
+    assert r.status_code == 400
+
+
+async def test_delete_mailbox(mailbox_server, base_url, smtp_client, admin_token):
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = "purge1@mb0.wtte.ch, purge2@mb0.wtte.ch"
+    message["date"] = "Mon, 14 May 1984 12:34:56 +0000"
+    message["Subject"] = "Hello World!"
+    message.set_content("You have mail!")
+    await smtp_client.send_message(message)
+
+    r = await async_requests.delete(base_url + "/purge1@mb0.wtte.ch")
+    assert r.status_code == 202
+
+    r = await async_requests.get(base_url + "/purge1@mb0.wtte.ch")
+    assert r.json() == {"emails": []}
+    r = await async_requests.get(base_url + "/purge2@mb0.wtte.ch")
+    assert len(r.json()["emails"]) == 1
+
+    # new email lands in a fresh mailbox
+    await smtp_client.send_message(message)
+    r = await async_requests.get(base_url + "/purge1@mb0.wtte.ch")
+    assert len(r.json()["emails"]) == 1
+
+    admin_url = base_url.replace("/api", "/admin") + "/domains/mb0.wtte.ch"
+    r = await async_requests.delete(admin_url)
+    assert r.status_code == 403
+    r = await async_requests.delete(
+        admin_url, headers={"Authorization": "token not-the-token"}
+    )
+    assert r.status_code == 403
+
+    r = await async_requests.delete(
+        admin_url, headers={"Authorization": f"token {admin_token}"}
+    )
+    assert r.status_code == 202
+    for address in ("purge1@mb0.wtte.ch", "purge2@mb0.wtte.ch"):
+        r = await async_requests.get(base_url + f"/{address}")
+        assert r.json() == {"emails": []}
+
+
+async def test_stalls(mailbox_server, base_url, admin_token):
+    stalls_url = base_url.replace("/api", "/admin") + "/stalls"
+    r = await async_requests.get(stalls_url)
+    assert r.status_code == 403
+
+    r = await async_requests.get(
+        stalls_url, headers={"Authorization": f"token {admin_token}"}
+    )
+    assert r.status_code == 200
+    stats = r.json()
+    assert stats["threshold_ms"] == 1000
+    assert stats["stalls"] == len(stats["recent"])
+
+
+async def test_coalescing_stats(mailbox_server, base_url, smtp_client, admin_token):
+    message = EmailMessage()
+    message["From"] = "someone@remote.example.com"
+    message["To"] = "coalesce@mb0.wtte.ch"
+    message["date"] = "Mon, 14 May 1984 12:34:56 +0000"
+    message["Subject"] = "Hello World!"
+    message.set_content("You have mail!")
+    await smtp_client.send_message(message)
+
+    view_url = base_url.replace("/api", "/view") + "/coalesce@mb0.wtte.ch/"
+    r = await async_requests.get(view_url)
+    assert r.status_code == 200
+    assert "Hello World!" in r.text
+
+    r = await async_requests.get(
+        base_url.replace("/api", "/admin") + "/coalescing",
+        headers={"Authorization": f"token {admin_token}"},
+    )
+    stats = r.json()
+    assert stats["started"] >= 1
+    assert stats["in_flight"] == 0
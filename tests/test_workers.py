@@ -0,0 +1,76 @@
+from mailboxzero import services, workers
+from mailboxzero.workers import Workers
+
+from utils import deliver, make_message
+
+
+def _deliver(base_maildir, address):
+    message = make_message(
+        "Read it at https://example.com/news", to=address, subject="Newsletter"
+    )
+    message.add_alternative(
+        '<p>Read it <a href="https://example.com/news">online</a></p>'
+        '<img src="cid:logo@example.com">',
+        subtype="html",
+    )
+    message.get_payload()[1].add_related(
+        b"\x89PNG", "image", "png", cid="<logo@example.com>"
+    )
+
+    return deliver(services.Mailboxes(base_maildir), address, message)
+
+
+async def test_workers_same_result_as_inline(tmp_path):
+    address = "news@mb0.wtte.ch"
+    message_id = _deliver(str(tmp_path), address)
+    jobs = [
+        (workers.parse_email, str(tmp_path), 0, address, message_id),
+        (
+            workers.render_email,
+            str(tmp_path),
+            0,
+            address,
+            message_id,
+            "/content/a/b/",
+            "/static/dist/main.css",
+        ),
+        (
+            workers.extract_content,
+            str(tmp_path),
+            0,
+            address,
+            message_id,
+            "logo@example.com",
+        ),
+        (workers.extract_content, str(tmp_path), 0, address, message_id, "nope"),
+    ]
+
+    inline = Workers()
+    pool = Workers(processes=1, threshold=100)
+    try:
+        for job, *args in jobs:
+            expected = await inline.run(1000, job, *args)
+            assert await pool.run(1000, job, *args) == expected
+            # small emails are processed inline
+            assert await pool.run(10, job, *args) == expected
+    finally:
+        pool.shutdown()
+
+    assert inline.offloaded == 0
+    assert pool.offloaded == pool.inline == len(jobs)
+
+
+def test_job_results_are_builtin_types(tmp_path):
+    address = "news@mb0.wtte.ch"
+    message_id = _deliver(str(tmp_path), address)
+
+    message = workers.parse_email(str(tmp_path), 0, address, message_id)
+    assert type(message["subject"]) is str
+    assert type(message["from"]) is str
+    assert message["x-mailfrom"] is None
+    assert all(type(v) is str for _, v in message["headers"])
+
+    rendered = workers.render_email(
+        str(tmp_path), 0, address, message_id, "/content/a/b/", "/static/main.css"
+    )
+    assert type(rendered["subject"]) is str
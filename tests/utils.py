@@ -1,6 +1,11 @@
 import asyncio
+import mailbox
+import os
+import socket
+import time
 
 from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
 
 import requests
 
@@ -26,3 +31,52 @@ class _AsyncRequests:
 
 
 async_requests = _AsyncRequests()
+
+
+def wait_for_ports(*ports, timeout=10):
+    """Wait until something accepts connections on all ports"""
+    deadline = time.monotonic() + timeout
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+
+def make_message(content="You have mail!", **headers):
+    """An email with content as body and the headers given as arguments
+
+    Underscores in argument names stand for dashes in header names. From,
+    Date and Subject get a default value unless they are given.
+    """
+    headers = {name.replace("_", "-").lower(): value for name, value in headers.items()}
+    headers.setdefault("from", "someone@remote.example.com")
+    headers.setdefault("date", "Mon, 14 May 1984 12:34:56 +0000")
+    headers.setdefault("subject", "Hello World!")
+
+    message = EmailMessage()
+    for name, value in headers.items():
+        message[name] = value
+    message.set_content(content)
+    return message
+
+
+def deliver(mailboxes, address, message=None, listener=None, **headers):
+    """Store an email for address straight in its Maildir, returns its ID
+
+    Without message one is made with `make_message(**headers)`. If given,
+    listener is told about the new message like after an SMTP delivery.
+    """
+    if message is None:
+        message = make_message(to=address, **headers)
+
+    mail_dir = mailboxes.mail_dir_for(address)
+    os.makedirs(os.path.dirname(mail_dir), exist_ok=True)
+    message_id = mailbox.Maildir(mail_dir).add(message.as_bytes())
+    if listener is not None:
+        listener.message_added(address, message_id, message)
+    return message_id